@@ -0,0 +1,288 @@
+#####################################################
+#                                                   #
+#                   Lorenzo Pace                    #
+#      Università degli Studi di Perugia            #
+#   Corso di Metodi Computazionali per la Fisica    #
+#                                                   #
+#---------------------------------------------------#
+#                                                   #
+#              Progetto finale                      #
+#  Deriva di particelle in campi elettromagnetici   #
+#                                                   #
+#      Script per la misura delle prestazioni       #
+#                                                   #
+#####################################################
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') #le figure degli istogrammi non vengono mostrate
+import os
+import io
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import mod
+
+#Regimi di campo misurati: (E0, B0, grad)
+REGIMI = {
+    'exb': ([0.01, 0.01, 0], [0, 0, 0.0001], '0'),
+    'grad': ([0, 0, 0], [0, 0, 0], '1'),
+    'both': ([0.01, 0.01, 0], [0, 0, 0], '1')
+}
+
+#Comandi di avvio misurati in un processo nuovo: dall'avvio dell'interprete al primo passo di simulazione
+AVVIO = {
+    'import mod': "import mod",
+    'primo passo': "import mod, numpy as np; mod.avanzamento([0.01, 0.01, 0], [0, 0, 0.0001], np.zeros(3), np.ones(3), "
+                   "mod.particella_da_sigla('p'), 2, 1, '0')",
+    'progetto --help': "import sys, runpy; sys.argv = ['progetto.py', '--help']; runpy.run_path('progetto.py', run_name='__main__')"
+}
+
+#Librerie pesanti di cui si controlla l'importazione all'avvio
+LIBRERIE_PESANTI = ('matplotlib', 'scipy', 'numba')
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(description='Misura dei tempi di esecuzione e della memoria di avanzamento e delle funzioni di analisi.',
+                                     usage='python3 benchmark.py -N 10 100 1000 --passi 1000 10000 [opzioni]')
+
+    parser.add_argument("-N", "--numero", type=int, nargs='+', default=[10, 100, 1000],
+                        help="Numeri di particelle della griglia di scala.")
+
+    parser.add_argument("--passi", type=int, nargs='+', default=[1000, 10000],
+                        help="Numeri di passi della griglia di scala.")
+
+    parser.add_argument("-r", "--regimi", choices=list(REGIMI), nargs='+', default=list(REGIMI),
+                        help="Regimi di campo da misurare.")
+
+    parser.add_argument("-i", "--integratori", choices=list(mod.integratori), nargs='+', default=['eulero'],
+                        help="Integratori da misurare.")
+
+    parser.add_argument("--jit", action="store_true",
+                        help="Misura anche il nucleo compilato con Numba (integratori eulero e boris).")
+
+    parser.add_argument("--ripetizioni", type=int, default=3,
+                        help="Ripetizioni di ciascuna misura: si registra il tempo minore.")
+
+    parser.add_argument("--senza-memoria", dest="memoria", action="store_false",
+                        help="Non misura il picco di memoria (evita l'esecuzione aggiuntiva con tracemalloc).")
+
+    parser.add_argument("--senza-avvio", dest="avvio", action="store_false",
+                        help="Non misura il tempo di avvio (import di mod e primo passo di simulazione).")
+
+    parser.add_argument("--solo-avvio", action="store_true",
+                        help="Misura solo il tempo di avvio, senza la griglia di avanzamento e analisi.")
+
+    parser.add_argument("--seme", type=int, default=1,
+                        help="Seme delle condizioni iniziali casuali.")
+
+    parser.add_argument("--uscita", default='benchmark.json',
+                        help="File JSON in cui scrivere i risultati.")
+
+    parser.add_argument("--confronta", default=None,
+                        help="File JSON di una misura precedente con cui confrontare i tempi.")
+
+    return parser.parse_args()
+
+def misura(funzione, ripetizioni, memoria):
+    """
+    Esegue una funzione senza argomenti più volte e ne misura il tempo migliore e, con
+    un'esecuzione aggiuntiva sotto tracemalloc, il picco di memoria allocata.
+    -------------------------------------------
+    Parametri:
+    funzione: funzione da misurare
+    ripetizioni: numero di esecuzioni cronometrate
+    memoria: se True misura anche il picco di memoria
+    -------------------------------------------
+    Restituisce:
+    tempo minimo [s], picco di memoria [byte] (None se non misurato), risultato della funzione
+    """
+    tempi = []
+    for _ in range(max(1, ripetizioni)):
+        inizio = time.perf_counter()
+        risultato = funzione()
+        tempi.append(time.perf_counter() - inizio)
+    picco = None
+    if memoria:
+        tracemalloc.start()
+        funzione()
+        picco = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return min(tempi), picco, risultato
+
+def caso(funzione, regime, integratore, jit, N, passi, tempo, picco):
+    """
+    Dizionario di una misura, con la velocità in passi-particella al secondo.
+    """
+    return {
+        'funzione': funzione, 'regime': regime, 'integratore': integratore, 'jit': jit,
+        'N': N, 'passi': passi, 'tempo': tempo,
+        'passi_particella_al_secondo': N * passi / tempo if tempo > 0 else None,
+        'picco_memoria': picco
+    }
+
+def esegui_benchmark(args):
+    """
+    Misura avanzamento su tutta la griglia (regime, integratore, nucleo, N, passi) e, una volta per
+    regime, N e passi, le funzioni di analisi applicate al suo risultato: vel_drift, la velocità
+    teorica (teorica_exb, teorica_grad o teorica_both) e istogramma_vdrift.
+    -------------------------------------------
+    Restituisce:
+    lista dei dizionari delle misure
+    """
+    particella = mod.particella_da_sigla('p')
+    nuclei = [False]
+    if args.jit:
+        if mod.numba_disponibile:
+            nuclei.append(True)
+            mod.nucleo_compilato()(np.zeros((1, 3)), np.ones((1, 3)), np.zeros(3), np.array([0, 0, 1.0]), 0.0, 1.0,
+                                       0.0001, 2, 1, False) #compilazione, esclusa dalle misure
+        else:
+            print("Numba non è installato: il nucleo compilato non viene misurato.")
+
+    risultati = []
+    for regime in args.regimi:
+        E0, B0, grad = REGIMI[regime]
+        for N in args.numero:
+            rng = np.random.default_rng(args.seme)
+            x0 = mod.posizioni_montecarlo(N, rng)
+            v0 = mod.velocita_montecarlo(N, rng)
+            for passi in args.passi:
+                tr = None
+                for integratore in args.integratori:
+                    for jit in nuclei:
+                        if (jit and integratore not in ('eulero', 'boris')) or (integratore == 'esatto' and grad != '0'):
+                            continue
+                        tempo, picco, (tr_caso, tempi_caso) = misura(
+                            lambda: mod.avanzamento(E0, B0, x0, v0, particella, passi, N, grad, integratore=integratore, jit=jit),
+                            args.ripetizioni, args.memoria)
+                        risultati.append(caso('avanzamento', regime, integratore, jit, N, passi, tempo, picco))
+                        stampa(risultati[-1])
+                        if tr is None:
+                            tr, tempi = np.reshape(tr_caso, (passi, N, 3)), np.reshape(tempi_caso, (passi, N))
+
+                #funzioni di analisi, sul risultato del primo integratore
+                if tr is None:
+                    continue
+                if regime == 'exb':
+                    teorica = lambda: mod.teorica_exb(E0, B0)
+                elif regime == 'grad':
+                    teorica = lambda: mod.teorica_grad(tr, particella, grad)
+                else:
+                    teorica = lambda: mod.teorica_both(tr, particella, grad, E0)
+                analisi = [
+                    ('vel_drift', lambda: mod.vel_drift(tr, tempi)),
+                    ('teorica_' + regime, teorica),
+                    ('istogramma_vdrift', lambda: mod.istogramma_vdrift(tr, tempi, '', regime, teorica(), particella,
+                                                                        salva=io.BytesIO()))
+                ]
+                for nome, funzione in analisi:
+                    tempo, picco, _ = misura(funzione, args.ripetizioni, args.memoria)
+                    risultati.append(caso(nome, regime, None, False, N, passi, tempo, picco))
+                    stampa(risultati[-1])
+
+    return risultati
+
+def misura_avvio(ripetizioni):
+    """
+    Misura il tempo di avvio dei comandi di AVVIO, ciascuno in un processo Python nuovo (il tempo
+    minore su più ripetizioni), e controlla quali librerie pesanti sono caricate dal solo import di mod.
+    -------------------------------------------
+    Parametri:
+    ripetizioni: numero di esecuzioni di ciascun comando
+    -------------------------------------------
+    Restituisce:
+    dizionario con i tempi per comando [s] e la lista delle librerie pesanti importate
+    """
+    cartella = os.path.dirname(os.path.abspath(__file__))
+    tempi = {}
+    for nome, codice in AVVIO.items():
+        durate = []
+        for _ in range(max(1, ripetizioni)):
+            inizio = time.perf_counter()
+            subprocess.run([sys.executable, '-c', codice], cwd=cartella, capture_output=True, check=True)
+            durate.append(time.perf_counter() - inizio)
+        tempi[nome] = min(durate)
+        print(f"{'avvio':<18}{nome:<34}{tempi[nome]:10.4f} s")
+    controllo = f"import sys, json, mod; print(json.dumps([m for m in {LIBRERIE_PESANTI!r} if m in sys.modules]))"
+    importate = json.loads(subprocess.run([sys.executable, '-c', controllo], cwd=cartella, capture_output=True,
+                                          text=True, check=True).stdout)
+    print(f"Librerie pesanti importate da 'import mod': {', '.join(importate) if importate else 'nessuna'}")
+
+    return {'tempi': tempi, 'librerie_importate': importate}
+
+def stampa(misura):
+    """
+    Stampa una riga con il risultato di una misura.
+    """
+    memoria = '' if misura['picco_memoria'] is None else f"{misura['picco_memoria'] / 2**20:9.1f} MiB"
+    backend = '' if misura['integratore'] is None else misura['integratore'] + (' (jit)' if misura['jit'] else '')
+    velocita = misura['passi_particella_al_secondo']
+    print(f"{misura['funzione']:<18}{misura['regime']:<6}{backend:<14}N = {misura['N']:<8}passi = {misura['passi']:<9}"
+          f"{misura['tempo']:10.4f} s{velocita:12.3e} passi·particella/s {memoria}")
+
+def descrizione_ambiente():
+    """
+    Restituisce le informazioni sull'ambiente di esecuzione, per confrontare misure fatte su
+    commit o macchine diverse.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'data': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': mod.numba_disponibile,
+        'macchina': platform.platform(),
+        'processore': platform.processor()
+    }
+
+def confronta(risultati, percorso):
+    """
+    Stampa il rapporto fra i tempi di una misura precedente e quelli attuali per i casi comuni
+    (valori maggiori di 1 indicano un miglioramento).
+    -------------------------------------------
+    Parametri:
+    risultati: dizionario delle misure attuali, come scritto nel file JSON
+    percorso: file JSON della misura precedente
+    """
+    with open(percorso) as file:
+        riferimento = json.load(file)
+    print(f"\nConfronto con {percorso} (commit {riferimento['ambiente'].get('commit')}):")
+    if risultati['avvio'] is not None and riferimento.get('avvio') is not None:
+        for nome, tempo in risultati['avvio']['tempi'].items():
+            if nome in riferimento['avvio']['tempi']:
+                print(f"{'avvio':<18}{nome:<34}x{riferimento['avvio']['tempi'][nome] / tempo:.2f}")
+    chiave = lambda m: (m['funzione'], m['regime'], m['integratore'], m['jit'], m['N'], m['passi'])
+    precedenti = {chiave(m): m for m in riferimento['risultati']}
+    for m in risultati['risultati']:
+        if chiave(m) in precedenti:
+            rapporto = precedenti[chiave(m)]['tempo'] / m['tempo'] if m['tempo'] > 0 else float('inf')
+            backend = '' if m['integratore'] is None else m['integratore'] + (' (jit)' if m['jit'] else '')
+            print(f"{m['funzione']:<18}{m['regime']:<6}{backend:<14}N = {m['N']:<8}passi = {m['passi']:<9}"
+                  f"x{rapporto:.2f}")
+
+def main():
+    args = parse_arguments()
+    risultati = {
+        'ambiente': descrizione_ambiente(),
+        'avvio': misura_avvio(args.ripetizioni) if args.avvio or args.solo_avvio else None,
+        'risultati': [] if args.solo_avvio else esegui_benchmark(args)
+    }
+    with open(args.uscita, 'w') as file:
+        json.dump(risultati, file, indent=2)
+    print(f"\nRisultati scritti in {args.uscita}")
+    if args.confronta is not None:
+        confronta(risultati, args.confronta)
+
+if __name__ == "__main__":
+    main()
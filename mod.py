@@ -14,13 +14,18 @@
 #####################################################
 
 import numpy as np
-import matplotlib.pyplot as plt
-import sys
-import scipy
 import sys,os
-import argparse
-from scipy.stats import norm
-import matplotlib.colors as mcolors
+import copy
+import time
+import json
+import hashlib
+import functools
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+#Il nucleo della simulazione richiede solo NumPy: matplotlib è importato dalle funzioni grafiche
+#alla prima chiamata e Numba (dipendenza facoltativa) solo quando si usa il nucleo compilato.
+numba_disponibile = importlib.util.find_spec('numba') is not None
 
 #Classi e funzioni varie utili
 
@@ -28,6 +33,8 @@ class Particella():
     """
     Classe che definisce una particella di cui simulare il moto.
     Massa e carica sono espresse in unità del sistema internazionale. 
+    Massa e carica possono anche essere array con un valore per particella, per simulare insieme
+    specie diverse (si veda insieme_particelle).
     -------------------------------------------
     Parametri:
     singolare : nome singolare
@@ -51,16 +58,123 @@ def periodo_larmor (particella, B):
     -------------------------------------------
     Parametri:
     particella: elemento della classe omonima
-    B : vettore campo magnetico
+    B : vettore campo magnetico, oppure matrice Nx3 con un vettore per riga
     """
     if not isinstance(particella, Particella):
         raise TypeError("Il primo argomento deve essere un oggetto della classe Particella.")
 
-    intB = np.linalg.norm(B) #modulo del vettore campo magnetico
+    intB = np.linalg.norm(B, axis=-1) #modulo del vettore campo magnetico (uno per riga)
     T = 2*np.pi*particella.m/(intB * np.abs(particella.q))
 
     return T
 
+def colonna (valori):
+    """
+    Restituisce una grandezza con un valore per particella (massa, carica, q/m) come colonna Nx1, così
+    che moltiplichi le righe delle matrici Nx3; gli scalari sono restituiti invariati.
+    """
+    return np.reshape(valori, (-1, 1)) if np.ndim(valori) > 0 else valori
+
+def insieme_particelle (specie):
+    """
+    Riunisce in un solo elemento della classe Particella una lista di particelle, anche di specie
+    diverse, con massa e carica come array di un valore per particella: le simulazioni le fanno
+    avanzare insieme come un unico insieme.
+    -------------------------------------------
+    Parametri:
+    specie : lista di elementi della classe Particella
+    """
+    nomi = sorted({p.plurale for p in specie})
+    return Particella(', '.join(nomi), ', '.join(nomi), np.array([p.m for p in specie], dtype=float),
+                      np.array([p.q for p in specie], dtype=float))
+
+#Misura dei tempi di esecuzione per fase
+
+class Profilo():
+    """
+    Registro dei tempi di esecuzione per fase della simulazione e dell'analisi: per ogni fase sono
+    sommati il tempo di orologio e il numero di chiamate, solo quando attivo è True (altrimenti le
+    funzioni misurate non hanno costi aggiuntivi). Le fasi possono essere annidate: il tempo di
+    avanzamento comprende quelli di campo, dt e passo. Con progresso, i cicli dei passi scrivono su
+    stderr avanzamento, passi al secondo e tempo restante stimato.
+    Nelle simulazioni distribuite su più processi le fasi interne ai processi non sono registrate.
+    """
+
+    def __init__(self):
+        self.attivo = False
+        self.progresso = False
+        self.fasi = {}
+        self.inizio = time.perf_counter()
+
+    def aggiungi(self, fase, durata, chiamate=1):
+        tempo, n = self.fasi.get(fase, (0.0, 0))
+        self.fasi[fase] = (tempo + durata, n + chiamate)
+
+    def misurata(self, fase, funzione):
+        """
+        Restituisce la funzione che esegue funzione registrandone il tempo nella fase indicata.
+        """
+        def misurata(*argomenti, **opzioni):
+            inizio = time.perf_counter()
+            risultato = funzione(*argomenti, **opzioni)
+            self.aggiungi(fase, time.perf_counter() - inizio)
+            return risultato
+        return misurata
+
+    def indicatore(self, passi, descrizione='avanzamento', intervallo=1.0):
+        """
+        Restituisce la funzione da chiamare al passo j (da 0 a passi - 1) di un ciclo per scriverne
+        l'avanzamento su stderr al più una volta ogni intervallo secondi, oppure None se progresso
+        non è attivo.
+        """
+        if not self.progresso or passi < 1:
+            return None
+        inizio = time.perf_counter()
+        ultimo = [inizio]
+        def aggiorna(j):
+            adesso = time.perf_counter()
+            if adesso - ultimo[0] < intervallo and j < passi - 1:
+                return
+            ultimo[0] = adesso
+            velocita = (j + 1) / max(adesso - inizio, 1e-9)
+            sys.stderr.write(f"\r{descrizione}: passo {j + 1}/{passi} ({(j + 1) / passi:.0%}), {velocita:.0f} passi/s, "
+                             f"tempo restante {(passi - 1 - j) / velocita:.0f} s ")
+            if j == passi - 1:
+                sys.stderr.write('\n')
+        return aggiorna
+
+    def rapporto(self):
+        """
+        Restituisce il rapporto dei tempi come dizionario serializzabile in JSON, con le fasi in
+        ordine di tempo decrescente.
+        """
+        totale = time.perf_counter() - self.inizio
+        fasi = sorted(self.fasi.items(), key=lambda voce: -voce[1][0])
+        return {
+            'tempo_totale': totale,
+            'fasi': {fase: {'tempo': tempo, 'chiamate': n, 'tempo_per_chiamata': tempo / n, 'frazione': tempo / totale}
+                     for fase, (tempo, n) in fasi}
+        }
+
+profilo = Profilo() #registro usato da tutte le funzioni del modulo
+
+def cronometrato(fase):
+    """
+    Decoratore che registra in profilo il tempo di ogni chiamata della funzione nella fase indicata.
+    """
+    def decoratore(funzione):
+        @functools.wraps(funzione)
+        def misurata(*argomenti, **opzioni):
+            if not profilo.attivo:
+                return funzione(*argomenti, **opzioni)
+            inizio = time.perf_counter()
+            try:
+                return funzione(*argomenti, **opzioni)
+            finally:
+                profilo.aggiungi(fase, time.perf_counter() - inizio)
+        return misurata
+    return decoratore
+
 #Funzioni di inserimento e scelta
 
 def inserimento_vettori ():
@@ -86,6 +200,24 @@ def inserimento_coppie ():
     vec[2] = 0
     return vec
 
+particelle = {
+    'e': Particella('elettrone', 'elettroni', 9.10938356e-31, -1.60217663e-19),
+    'ae': Particella('positrone', 'positroni', 9.10938356e-31, 1.60217663e-19),
+    'p': Particella('protone', 'protoni', 1.6726219e-27, 1.60217663e-19),
+    'ap': Particella('antiprotone', 'antiprotoni', 1.6726219e-27, -1.60217663e-19)
+}
+
+def particella_da_sigla (sigla):
+    """
+    Restituisce una particella fra quelle preimpostate a partire dalla sua sigla, senza input da terminale.
+    -------------------------------------------
+    Parametri:
+    sigla : una fra 'e', 'ae', 'p', 'ap'
+    """
+    if sigla.lower() not in particelle:
+        raise ValueError(f"Particella non valida: {sigla}. Inserire una fra e, ae, p, ap.")
+    return particelle[sigla.lower()]
+
 def inserimento_particella ():
     """
     Permette di inserire in input una particella fra quelle preimpostate.
@@ -94,19 +226,13 @@ def inserimento_particella ():
     - 'p': protone
     - 'ap': antiprotone
     """
-    lista = {
-        'e': Particella('elettrone', 'elettroni', 9.10938356e-31, -1.60217663e-19),
-        'ae': Particella('positrone', 'positroni', 9.10938356e-31, 1.60217663e-19),
-        'p': Particella('protone', 'protoni', 1.6726219e-27, 1.60217663e-19),
-        'ap': Particella('antiprotone', 'antiprotoni', 1.6726219e-27, -1.60217663e-19)
-    }
     scelta = ""
-    while scelta not in lista:
+    while scelta not in particelle:
         scelta = input("Inserire la specie della particella (e: elettrone, ae: positrone, p: protone, ap: antiprotone): ").lower()
-        if scelta not in lista:
+        if scelta not in particelle:
             print("Scelta non valida. Inserire una delle seguenti: e, ae, p, ap.")
 
-    return lista[scelta]
+    return particelle[scelta]
 
 def scelta_gradiente():
     """
@@ -126,14 +252,351 @@ def scelta_gradiente():
 
 #Funzione di simulazione
 
-def avanzamento(E0, B0, x0, v0, particella, passi, N, grad):
+#Integratori del moto: ciascuno restituisce posizioni e velocità al passo successivo
+
+def passo_eulero(x, v, dt, campo, B, particella):
+    """
+    Passo di Eulero esplicito: la posizione avanza con la velocità del passo corrente (moto
+    rettilineo uniforme), la velocità con la forza di Lorentz del passo corrente.
+    -------------------------------------------
+    Parametri:
+    - x, v : matrici Nx3 di posizioni e velocità
+    - dt : array degli N intervalli temporali
+    - campo : modello di campo (oggetto Campo), per i metodi che rivalutano i campi
+    - B : matrice Nx3 del campo magnetico nelle posizioni x [T]
+    - particella : elemento della classe omonima
+    """
+    E = campo.E(x)
+    f_lorentz = colonna(particella.q) * (E + np.cross(v, B))  #forza di Lorentz
+    x_nuova = v * dt[:, None] + x  #passi di moto rettilineo uniforme
+    v_nuova = v + f_lorentz / colonna(particella.m) * dt[:, None]  #aggiornamento del vettore velocità
+    return x_nuova, v_nuova
+
+def passo_boris(x, v, dt, campo, B, particella):
+    """
+    Passo del Boris pusher: mezza accelerazione elettrica, rotazione esatta attorno a B e seconda
+    mezza accelerazione elettrica; la rotazione conserva il modulo della velocità, per cui
+    l'energia non deriva anche con dt molto più grandi di quelli richiesti da Eulero.
+    -------------------------------------------
+    Parametri:
+    - come per passo_eulero
+    """
+    E = campo.E(x)
+    qm_mezzi = colonna(particella.q / particella.m) * dt[:, None] / 2
+    v_meno = v + qm_mezzi * E  #prima mezza accelerazione elettrica
+    t = qm_mezzi * B
+    s = 2 * t / (1 + np.sum(t * t, axis=1))[:, None]
+    v_primo = v_meno + np.cross(v_meno, t)
+    v_piu = v_meno + np.cross(v_primo, s)  #rotazione attorno a B
+    v_nuova = v_piu + qm_mezzi * E  #seconda mezza accelerazione elettrica
+    x_nuova = x + v_nuova * dt[:, None]
+    return x_nuova, v_nuova
+
+def passo_rk4(x, v, dt, campo, B, particella):
+    """
+    Passo di Runge-Kutta del quarto ordine, con il campo magnetico rivalutato nelle posizioni
+    intermedie (rilevante in presenza di gradiente).
+    -------------------------------------------
+    Parametri:
+    - come per passo_eulero
+    """
+    qm = colonna(particella.q / particella.m)
+    h = dt[:, None]
+    def accelerazione(xi, vi, Bi):
+        return qm * (campo.E(xi) + np.cross(vi, Bi))
+    k1x, k1v = v, accelerazione(x, v, B)
+    x2, v2 = x + k1x * h / 2, v + k1v * h / 2
+    k2x, k2v = v2, accelerazione(x2, v2, campo.B(x2))
+    x3, v3 = x + k2x * h / 2, v + k2v * h / 2
+    k3x, k3v = v3, accelerazione(x3, v3, campo.B(x3))
+    x4, v4 = x + k3x * h, v + k3v * h
+    k4x, k4v = v4, accelerazione(x4, v4, campo.B(x4))
+    x_nuova = x + h / 6 * (k1x + 2 * k2x + 2 * k3x + k4x)
+    v_nuova = v + h / 6 * (k1v + 2 * k2v + 2 * k3v + k4v)
+    return x_nuova, v_nuova
+
+def orbita_esatta(E0, B0, x0, v0, particella, tempi):
+    """
+    Soluzione analitica del moto in campi E e B uniformi e costanti: moto uniformemente accelerato
+    lungo B (per la componente di E parallela), deriva E x B di teorica_exb e rotazione esatta
+    della velocità nel sistema del drift attorno a B con la frequenza di ciclotrone q|B|/m.
+    Posizioni e velocità sono calcolate direttamente negli istanti richiesti, con un costo
+    indipendente dal tempo trascorso, per tutte le particelle insieme.
+    -------------------------------------------
+    Parametri:
+    - E0 : campo elettrico (array 3d, oppure matrice Nx3) [V/m]
+    - B0 : campo magnetico (array 3d, oppure matrice Nx3) [T], non nullo
+    - x0, v0 : matrici Nx3 di posizioni e velocità all'istante 0
+    - particella : elemento della classe omonima
+    - tempi : array degli M istanti comuni a tutte le particelle, oppure matrice (M, N) [s]
+    -------------------------------------------
+    Restituisce:
+    - x, v : array (M, N, 3) di posizioni e velocità negli istanti richiesti
+    """
+    x0 = np.reshape(np.asarray(x0, dtype=float), (-1, 3))
+    v0 = np.reshape(np.asarray(v0, dtype=float), (-1, 3))
+    E0 = np.asarray(E0, dtype=float)
+    B0 = np.asarray(B0, dtype=float)
+    t = np.asarray(tempi, dtype=float)
+    t = (t[:, None] if t.ndim == 1 else t)[..., None] #(M, N o 1, 1)
+    qm = colonna(particella.q / particella.m)
+    intB = np.linalg.norm(B0, axis=-1, keepdims=True)
+    b = B0 / intB #direzione del campo
+    omega = qm * intB #frequenza di ciclotrone con segno
+    v_E = teorica_exb(E0, B0)
+    v_parallela = np.sum(v0 * b, axis=-1, keepdims=True) * b
+    a_parallela = qm * np.sum(E0 * b, axis=-1, keepdims=True) * b
+    w0 = v0 - v_parallela - v_E #velocità di girazione nel sistema del drift
+    u0 = np.cross(w0, b)
+    fase = omega * t
+    seno = np.sin(fase)
+    v = v_E + v_parallela + a_parallela * t + w0 * np.cos(fase) + u0 * seno
+    x = x0 + (v_E + v_parallela) * t + a_parallela * t**2 / 2 + (w0 * seno + u0 * 2 * np.sin(fase / 2)**2) / omega
+    return x, v
+
+def passo_esatto(x, v, dt, campo, B, particella):
+    """
+    Passo con la soluzione analitica di orbita_esatta: in campo uniforme non introduce errori di
+    integrazione per nessun dt, e serve da riferimento per gli altri integratori.
+    -------------------------------------------
+    Parametri:
+    - come per passo_eulero (campo deve essere un CampoUniforme)
+    """
+    x_nuova, v_nuova = orbita_esatta(campo.E0, B, x, v, particella, dt[None, :])
+    return x_nuova[0], v_nuova[0]
+
+integratori = {
+    'eulero': passo_eulero,
+    'boris': passo_boris,
+    'rk4': passo_rk4,
+    'esatto': passo_esatto
+}
+
+def scelta_integratore(integratore, campo):
+    """
+    Restituisce il nome dell'integratore da usare con il modello di campo: con integratore None la
+    soluzione analitica ('esatto') in campo uniforme ed Eulero altrimenti.
+    -------------------------------------------
+    Parametri:
+    - integratore : nome dell'integratore, oppure None per la scelta automatica
+    - campo : oggetto Campo
+    """
+    if integratore is None:
+        return 'esatto' if isinstance(campo, CampoUniforme) else 'eulero'
+    if integratore not in integratori:
+        raise ValueError(f"Integratore non valido: {integratore}. Inserire uno fra {', '.join(integratori)}.")
+    if integratore == 'esatto' and not isinstance(campo, CampoUniforme):
+        raise ValueError("L'integratore 'esatto' è disponibile solo in campo uniforme (gradiente '0').")
+    return integratore
+
+def passi_avanzamento(E0, B0, x0, v0, particella, passi, grad, integratore=None, frazione=0.0001,
+                      dt_globale=False, inizio=0, precisione=np.float64):
+    """
+    Generatore che fa avanzare insieme tutte le particelle tenendo in memoria solo lo stato corrente.
+    Ad ogni passo j restituisce posizioni e velocità al passo j e il dt che porta dal passo j al
+    successivo (nullo all'ultimo passo), con la stessa integrazione descritta in avanzamento.
+    Con inizio > 0 x0 e v0 sono lo stato al passo inizio, da cui l'integrazione riprende.
+    Con precisione np.float32 lo stato, i campi nelle posizioni e i dt sono in singola precisione,
+    così che i passi di Eulero e di Boris siano calcolati interamente in float32.
+    -------------------------------------------
+    Parametri:
+    - E0 : campo elettrico (array 3d) [V/m]
+    - B0 : campo magnetico uniforme (array 3d) [T]
+    - x0 : matrice Nx3 delle posizioni iniziali [m]
+    - v0 : matrice Nx3 delle velocità iniziali [m/s]
+    - particella: elemento della classe omonima
+    - passi: numero di iterazioni
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - integratore : 'eulero', 'boris', 'rk4' o 'esatto' (solo in campo uniforme); con None (default)
+      la scelta è automatica (si veda scelta_integratore)
+    - frazione : dt come frazione del periodo di Larmor locale (default 1/10000)
+    - dt_globale : se True tutte le particelle avanzano con lo stesso dt (si veda intervallo_temporale)
+    - inizio : indice del passo a cui corrispondono x0 e v0 (default 0)
+    - precisione : tipo in virgola mobile dello stato (np.float64 di default, oppure np.float32)
+    -------------------------------------------
+    Restituisce (ad ogni passo):
+    - j : indice del passo
+    - x, v : matrici Nx3 di posizioni e velocità al passo j
+    - dt : array degli N intervalli temporali del passo j, oppure il dt comune se dt_globale
+    """
+    campo = modello_campo(E0, B0, grad)
+    integratore = scelta_integratore(integratore, campo)
+    passo = integratori[integratore]
+    x = np.array(x0, dtype=precisione)
+    v = np.array(v0, dtype=precisione)
+    singola = np.dtype(precisione) != np.float64
+    if singola: #campo elettrico, massa e carica nella stessa precisione dello stato
+        campo = campo.con_campo_elettrico(campo.E0, precisione)
+        particella = copy.copy(particella)
+        particella.m, particella.q = np.asarray(particella.m, precisione), np.asarray(particella.q, precisione)
+    uniforme = isinstance(campo, CampoUniforme)
+    valuta_B, valuta_dt = campo.B, intervallo_temporale
+    if profilo.attivo: #funzioni sostituite solo durante la misura dei tempi
+        valuta_B = profilo.misurata('campo B', campo.B)
+        valuta_dt = profilo.misurata('dt (periodo di Larmor)', intervallo_temporale)
+        passo = profilo.misurata('passo ' + integratore, passo)
+    avviso = profilo.indicatore(passi - inizio)
+    if uniforme:
+        dt = valuta_dt(particella, campo.B(x), frazione, dt_globale).astype(precisione) #B non cambia: dt calcolato una volta
+    for j in range(inizio, passi - 1):
+        B = valuta_B(x).astype(precisione, copy=False) #campo per tutte le particelle (Nx3)
+        if not uniforme:
+            dt = valuta_dt(particella, B, frazione, dt_globale).astype(precisione, copy=False)
+        if avviso is not None:
+            avviso(j - inizio)
+        yield j, x, v, dt[0] if dt_globale else dt
+        x, v = passo(x, v, dt, campo, B, particella)
+        if singola: #RK4 rivaluta i campi in doppia precisione
+            x, v = x.astype(precisione, copy=False), v.astype(precisione, copy=False)
+    if avviso is not None:
+        avviso(passi - 1 - inizio)
+    yield passi - 1, x, v, 0.0 if dt_globale else np.zeros(x.shape[0])
+
+def intervallo_temporale(particella, B, frazione, dt_globale=False):
+    """
+    Politica del passo temporale: dt pari a una frazione del periodo di Larmor locale, calcolato dal
+    modulo di B su tutte le particelle insieme. Con dt_globale le particelle sono sincronizzate sul
+    dt più piccolo (quello del campo più intenso), così che i tempi siano gli stessi per tutte.
+    -------------------------------------------
+    Parametri:
+    - particella : elemento della classe omonima
+    - B : matrice Nx3 del campo magnetico nelle posizioni delle particelle [T]
+    - frazione : dt come frazione del periodo di Larmor
+    - dt_globale : se True restituisce lo stesso dt per tutte le particelle
+    -------------------------------------------
+    Restituisce:
+    - array degli N intervalli temporali
+    """
+    dt = frazione * periodo_larmor(particella, B) #un dt per particella
+    if dt_globale:
+        return np.full(dt.shape, np.min(dt))
+    return dt
+
+def passo_decimazione(decimazione, punti_periodo, frazione=0.0001):
+    """
+    Restituisce ogni quanti passi registrare un campione della traiettoria.
+    -------------------------------------------
+    Parametri:
+    - decimazione : registra un passo ogni decimazione
+    - punti_periodo : se diverso da None, numero di punti per periodo di Larmor (ha la precedenza)
+    - frazione : dt come frazione del periodo di Larmor
+    """
+    if punti_periodo is not None:
+        return max(1, int(round(1 / (frazione * punti_periodo)))) #1/frazione passi per periodo
+    if decimazione < 1:
+        raise ValueError("La decimazione deve essere un intero maggiore o uguale a 1.")
+    return int(decimazione)
+
+def nucleo_avanzamento(x0, v0, E, B0, pendenza, qm, frazione, passi, k, boris):
+    """
+    Ciclo dei passi scritto componente per componente, da compilare con Numba: copre il campo
+    uniforme e le leggi lineari Bz = B0 + pendenza*x, con il passo di Eulero o di Boris.
+    Registra un campione ogni k passi più l'ultimo, sommando nei tempi i dt intermedi come avanzamento.
+    -------------------------------------------
+    Parametri:
+    - x0, v0 : matrici Nx3 delle condizioni iniziali
+    - E : campo elettrico (array 3d) [V/m]
+    - B0 : parte uniforme del campo magnetico (array 3d) [T]
+    - pendenza : dBz/dx [T/m] (0 per campo uniforme)
+    - qm : rapporto carica/massa [C/kg]
+    - frazione : dt come frazione del periodo di Larmor locale
+    - passi : numero di iterazioni
+    - k : passo di decimazione
+    - boris : True per il Boris pusher, False per Eulero
+    """
+    N = x0.shape[0]
+    n_campioni = (passi - 1) // k + 1
+    if (passi - 1) % k != 0:
+        n_campioni += 1
+    x = np.zeros((n_campioni, N, 3))
+    tempi = np.zeros((n_campioni, N))
+    periodo_unitario = 2 * np.pi / abs(qm) #periodo di Larmor per |B| = 1 T
+    for i in range(N):
+        x1, x2, x3 = x0[i, 0], x0[i, 1], x0[i, 2]
+        v1, v2, v3 = v0[i, 0], v0[i, 1], v0[i, 2]
+        x[0, i, 0], x[0, i, 1], x[0, i, 2] = x1, x2, x3
+        s = 0
+        for j in range(passi - 1):
+            b1, b2, b3 = B0[0], B0[1], B0[2] + pendenza * x1
+            dt = frazione * periodo_unitario / np.sqrt(b1 * b1 + b2 * b2 + b3 * b3)
+            if boris:
+                h = qm * dt / 2
+                m1, m2, m3 = v1 + h * E[0], v2 + h * E[1], v3 + h * E[2]
+                t1, t2, t3 = h * b1, h * b2, h * b3
+                f = 2 / (1 + t1 * t1 + t2 * t2 + t3 * t3)
+                p1 = m1 + m2 * t3 - m3 * t2
+                p2 = m2 + m3 * t1 - m1 * t3
+                p3 = m3 + m1 * t2 - m2 * t1
+                m1, m2, m3 = m1 + f * (p2 * t3 - p3 * t2), m2 + f * (p3 * t1 - p1 * t3), m3 + f * (p1 * t2 - p2 * t1)
+                v1, v2, v3 = m1 + h * E[0], m2 + h * E[1], m3 + h * E[2]
+                x1, x2, x3 = x1 + v1 * dt, x2 + v2 * dt, x3 + v3 * dt
+            else:
+                a1 = qm * (E[0] + v2 * b3 - v3 * b2)
+                a2 = qm * (E[1] + v3 * b1 - v1 * b3)
+                a3 = qm * (E[2] + v1 * b2 - v2 * b1)
+                x1, x2, x3 = x1 + v1 * dt, x2 + v2 * dt, x3 + v3 * dt
+                v1, v2, v3 = v1 + a1 * dt, v2 + a2 * dt, v3 + a3 * dt
+            tempi[s, i] += dt
+            if (j + 1) % k == 0 or j + 1 == passi - 1:
+                s += 1
+                x[s, i, 0], x[s, i, 1], x[s, i, 2] = x1, x2, x3
+
+    return x, tempi
+
+nucleo_avanzamento_jit = None #compilato alla prima richiesta da nucleo_compilato
+
+def nucleo_compilato():
+    """
+    Restituisce nucleo_avanzamento compilato con Numba, importando Numba e compilando il nucleo
+    (o leggendolo dalla cache su disco di Numba) solo alla prima chiamata.
+    """
+    global nucleo_avanzamento_jit
+    if nucleo_avanzamento_jit is None:
+        from numba import njit
+        nucleo_avanzamento_jit = njit(cache=True)(nucleo_avanzamento)
+    return nucleo_avanzamento_jit
+
+def compilabile (campo):
+    """
+    Indica se il modello di campo è coperto da nucleo_avanzamento: campo uniforme o legge lineare,
+    con parametri comuni a tutte le particelle.
+    -------------------------------------------
+    Parametri:
+    - campo : oggetto Campo
+    """
+    if type(campo) is CampoUniforme:
+        return np.shape(campo.B0) == (3,) and np.shape(campo.E0) == (3,)
+    if type(campo) is CampoLineare:
+        return np.ndim(campo.B0) == 0 and np.ndim(campo.pendenza) == 0 and np.shape(campo.E0) == (3,)
+    return False
+
+@cronometrato('avanzamento')
+def avanzamento(E0, B0, x0, v0, particella, passi, N, grad, decimazione=1, punti_periodo=None, integratore=None, frazione=0.0001,
+                jit=False, dt_globale=False, archivio=None, compatto=False):
     """
     Definisce l'avanzamento in senso vettoriale come ciclo for di iterazioni singole
     di moto rettilineo uniforme. Ad ogni iterazione aggiorna la forza di Lorentz e 
     di conseguenza i vettori velocità e posizione.
-    Regime both con campo B variabile con la posizione secondo la funzione B_grad e campo E diverso da 0. 
+    Regime both con campo B variabile con la posizione secondo una legge registrata e campo E diverso da 0. 
     Calcola il dt come 1/10000 del periodo dell'orbita ciclotronica per rendere il numero di passi
     inseriti in input indipendente da particella e campo magnetico fissati. 
+    La frazione del periodo e l'integratore (Eulero, Boris o RK4) sono selezionabili: con Boris o RK4
+    la stessa accuratezza sulla deriva si ottiene con dt fino a 100 volte maggiori.
+    Tutte le particelle sono fatte avanzare insieme: ad ogni passo lo stato Nx3 è aggiornato con
+    operazioni su array, con un dt diverso per ciascuna particella in presenza di gradiente.
+    Con decimazione (o punti_periodo) si registra solo un passo ogni k, più l'ultimo: ciascuna riga
+    dei tempi contiene allora la somma dei dt fino al campione successivo, così che vel_drift resti esatta.
+    Con archivio traiettorie e tempi sono scritti passo per passo in file .npy mappati in memoria
+    invece che in array in RAM, per cui la dimensione della simulazione è limitata dallo spazio su
+    disco: gli array restituiti sono np.memmap, accettati da tutte le funzioni di analisi, e possono
+    essere riaperti in seguito con carica_archivio.
+    La modalità compatta dimezza la memoria occupata: stato, traiettorie e tempi sono in float32 e,
+    in campo uniforme, dove il dt è lo stesso per tutte le particelle, i tempi sono memorizzati una
+    sola volta per campione invece che per ogni particella (come con dt_globale). La perdita di
+    accuratezza rispetto alla doppia precisione è misurata da confronto_precisione.
+    In campo uniforme l'integratore di default è la soluzione analitica di orbita_esatta: le posizioni
+    sono calcolate direttamente negli istanti dei campioni registrati, senza percorrere i passi, per
+    cui il costo dipende solo dal numero di campioni e la traiettoria non ha errori di integrazione.
     -------------------------------------------
     Parametri:
     - E0 : campo elettrico (array 3d) [V/m]
@@ -142,68 +605,537 @@ def avanzamento(E0, B0, x0, v0, particella, passi, N, grad):
     - particella: elemento della classe omonima definita
     - passi: numero di iterazioni
     - N : numero di particelle (con valore di default 1)
-    - gradiente: char che identifica il tipo di gradiente (0 assente, 1(2,3) per le funzioni B_grad_1 (2,3))
+    - gradiente: char che identifica il tipo di gradiente (0 assente, 1(2,3) per le leggi lineari predefinite),
+      oppure oggetto Campo
+    - decimazione : registra un passo ogni decimazione (default 1, traiettoria completa)
+    - punti_periodo : in alternativa, numero di campioni per periodo di Larmor
+    - integratore : 'eulero', 'boris', 'rk4' o 'esatto' (solo in campo uniforme); con None (default)
+      'esatto' in campo uniforme ed 'eulero' altrimenti
+    - frazione : dt come frazione del periodo di Larmor locale (default 1/10000)
+    - jit : se True usa il nucleo compilato con Numba (solo per Eulero e Boris); se Numba non è
+      installato si usa comunque il ciclo con NumPy
+    - dt_globale : se True tutte le particelle avanzano con lo stesso dt, e i tempi sono un array
+      con un valore per campione invece di una matrice (campioni, N)
+    - archivio : prefisso dei file archivio_tr.npy e archivio_tempi.npy in cui scrivere traiettorie e
+      tempi (None per tenerli in memoria); con archivio il nucleo compilato non è usato
+    - compatto : se True usa la modalità compatta in singola precisione (senza nucleo compilato)
     -------------------------------------------
     Restituisce:
     - x : array che rappresenta la traiettoria
     - dt : passo temporale della simulazione
     """
+    k = passo_decimazione(decimazione, punti_periodo, frazione)
+    campo = modello_campo(E0, B0, grad)
+    uniforme = isinstance(campo, CampoUniforme)
+    integratore = scelta_integratore(integratore, campo)
+    precisione = np.float32 if compatto else np.float64
+    if compatto and uniforme: #stesso dt per tutte le particelle: tempi comuni
+        dt_globale = True
+    if jit and archivio is None and not compatto and numba_disponibile and integratore in ('eulero', 'boris') and compilabile(campo) and \
+            (uniforme or not dt_globale) and np.ndim(particella.q) == 0 and np.ndim(particella.m) == 0:
+        if isinstance(campo, CampoUniforme):
+            B_uniforme, pendenza = campo.B0, 0.0
+        else:
+            B_uniforme, pendenza = np.array([0, 0, campo.B0]), campo.pendenza
+        x, tempi = nucleo_compilato()(np.reshape(x0, (N, 3)).astype(float), np.reshape(v0, (N, 3)).astype(float),
+                                          campo.E0, B_uniforme, float(pendenza), particella.q / particella.m,
+                                          frazione, passi, k, integratore == 'boris')
+        if dt_globale: #in campo uniforme il dt è già lo stesso per tutte le particelle
+            tempi = tempi[:, 0]
+        if N == 1:
+            return x[:, 0, :], tempi[:, 0] if tempi.ndim == 2 else tempi
+        return x, tempi
+
+    campioni = list(range(0, passi, k))
+    if campioni[-1] != passi - 1:
+        campioni.append(passi - 1) #l'ultimo passo è sempre registrato
+    forma_tempi = (len(campioni),) if dt_globale else (len(campioni), N)
+    if archivio is not None: #file inizializzati a zero, scritti un campione alla volta
+        x = np.lib.format.open_memmap(archivio + '_tr.npy', mode='w+', dtype=precisione, shape=(len(campioni), N, 3))
+        tempi = np.lib.format.open_memmap(archivio + '_tempi.npy', mode='w+', dtype=precisione, shape=forma_tempi)
+    else:
+        x = np.zeros((len(campioni), N, 3), dtype=precisione)
+        tempi = np.zeros(forma_tempi, dtype=precisione)
+    if integratore == 'esatto': #soluzione analitica valutata solo negli istanti dei campioni
+        x0, v0 = np.reshape(x0, (N, 3)), np.reshape(v0, (N, 3))
+        dt = intervallo_temporale(particella, campo.B(x0), frazione, dt_globale)
+        indici = np.array(campioni)
+        intervalli = np.diff(indici)[:, None] * dt #somma dei dt fra un campione e il successivo
+        tempi[:-1] = intervalli[:, 0] if dt_globale else intervalli
+        righe = max(1, 2**20 // N) #campioni calcolati insieme, per limitare la memoria temporanea
+        for inizio in range(0, len(campioni), righe):
+            x[inizio:inizio + righe] = orbita_esatta(campo.E0, campo.B0, x0, v0, particella,
+                                                     indici[inizio:inizio + righe, None] * dt)[0]
+    else:
+        s = 0
+        for j, xj, vj, dt in passi_avanzamento(E0, B0, np.reshape(x0, (N, 3)), np.reshape(v0, (N, 3)), particella, passi, campo,
+                                               integratore, frazione, dt_globale, precisione=precisione):
+            if j == campioni[s]:
+                x[s] = xj
+                s += 1
+            tempi[s - 1] += dt #riempimento matrice dei tempi
+    if archivio is not None:
+        x.flush()
+        tempi.flush()
+
+    #Caso 1: simulazione singola (traiettoria (campioni, 3) e tempi (campioni,))
+    if N == 1:
+        return x[:, 0, :], tempi if dt_globale else tempi[:, 0]
+
+    #Caso 2: simulazione multipla (traiettorie (campioni, N, 3) e tempi (campioni, N), oppure (campioni,) con dt_globale)
+    return x, tempi
 
-    #Caso 1: simulazione singola
-    if N == 1: 
-        x = np.zeros((passi, 3))
-        v = np.zeros((passi, 3))
-        tempi = np.zeros(passi)
-        x[0, :] = x0
-        v[0, :] = v0
-        for j in range(passi - 1):
-            if grad=="0":
-                B = B0
-            else:
-                B = gradiente(grad,x[j, 0]) #dipendenza di B dalla posizione
-            dt = 0.0001 * periodo_larmor(particella, B)
-            f_lorentz = particella.q * (E0 + np.cross(v[j, :], B))  #forza di Lorentz
-            v[j + 1, :] = v[j, :] + f_lorentz / particella.m * dt  #aggiornamento del vettore velocità
-            x[j + 1, :] = v[j, :] * dt + x[j, :]  #passi di moto rettilineo uniforme
-            tempi[j] = dt #riempimento matrice dei tempi
-
-     #Caso 2: simulazione multipla
-    elif N > 1:  
-        x = np.zeros((passi, N, 3))
-        v = np.zeros((passi, N, 3))
-        tempi = np.zeros((passi, N))
-        for i, v_init in enumerate(v0):
-            x[0, i, :] = x0[i]
-            v[0, i, :] = v_init
-            for j in range(passi - 1):
-                if grad=="0": #in assenza di gradiente
-                    B = B0
-                else: #presenza di gradiente
-                    B = gradiente(grad, x[j, i, 0]) #dipendenza di B dalla posizione (particella i-esima)
-                dt = 0.0001 * periodo_larmor(particella, B)
-                f_lorentz = particella.q * (E0 + np.cross(v[j, i, :], B))  #forza di Lorentz (particella i-esima)
-                v[j + 1, i, :] = v[j, i, :] + f_lorentz / particella.m * dt  #aggiornamento del vettore velocità (particella i-esima)
-                x[j + 1, i, :] = v[j, i, :] * dt + x[j, i, :]  #passi di moto rettilineo uniforme (particella i-esima)
-                tempi[j,i] = dt #riempimento matrice dei tempi (particella i-esima)
-
+def carica_archivio(archivio, modo='r'):
+    """
+    Riapre traiettorie e tempi scritti da avanzamento con l'argomento archivio, come array mappati
+    in memoria: i dati sono letti dal disco solo quando vengono usati.
+    -------------------------------------------
+    Parametri:
+    - archivio : prefisso dei file, come per avanzamento
+    - modo : modo di apertura dei file ('r' sola lettura, 'r+' lettura e scrittura)
+    -------------------------------------------
+    Restituisce:
+    - traiettorie e tempi nella stessa forma restituita da avanzamento
+    """
+    x = np.load(archivio + '_tr.npy', mmap_mode=modo)
+    tempi = np.load(archivio + '_tempi.npy', mmap_mode=modo)
+    if x.shape[1] == 1: #simulazione singola
+        return x[:, 0, :], tempi if tempi.ndim == 1 else tempi[:, 0]
     return x, tempi
 
+@cronometrato('deriva_flusso')
+def deriva_flusso(E0, B0, x0, v0, particella, passi, N, grad, integratore=None, frazione=0.0001, dt_globale=False,
+                  checkpoint=None, passi_checkpoint=10000, stato_rng=None):
+    """
+    Esegue la simulazione con memoria costante: conserva solo le posizioni iniziali e finali e la
+    somma dei dt di ciascuna particella, oltre allo stato al passo mediano per le velocità teoriche.
+    Il risultato ha la stessa forma di quello di avanzamento con due soli campioni, per cui può
+    essere passato direttamente a vel_drift e istogramma_vdrift.
+    Con checkpoint lo stato dell'integrazione è salvato nel file indicato ogni passi_checkpoint passi
+    e alla fine: se il file esiste già, ed è stato prodotto con gli stessi parametri e le stesse
+    condizioni iniziali, la simulazione riprende dal passo salvato invece che dall'inizio, e con un
+    numero di passi maggiore di quello salvato viene prolungata senza ripetere i passi già fatti.
+    Se il passo mediano della simulazione prolungata precede il passo salvato, lo stato mediano
+    salvato (della simulazione più corta) non è più valido: è ricalcolato integrando dalle condizioni
+    iniziali fino al nuovo passo mediano, così che il risultato coincida con quello di una simulazione
+    nuova della stessa lunghezza. Il prolungamento costa allora i passi mancanti più quelli fino al
+    passo mediano, invece di tutti i passi.
+    Con l'integratore 'esatto' (il default in campo uniforme) gli stati finale e mediano sono
+    calcolati direttamente con orbita_esatta, e non c'è nulla da salvare con checkpoint.
+    -------------------------------------------
+    Parametri:
+    - come per avanzamento (senza decimazione)
+    - checkpoint : file .npz in cui salvare e da cui riprendere lo stato (None per non salvare)
+    - passi_checkpoint : ogni quanti passi aggiornare il salvataggio
+    - stato_rng : stato del generatore casuale che ha prodotto le condizioni iniziali, salvato
+      insieme allo stato dell'integrazione (facoltativo)
+    -------------------------------------------
+    Restituisce:
+    - tr : posizioni iniziali e finali (2, N, 3)
+    - tempi : tempo totale di ciascuna particella nella prima riga, zeri nella seconda (2, N),
+      oppure (2,) con dt_globale
+    - x_mediano, v_mediano : matrici Nx3 di posizioni e velocità al passo mediano
+    """
+    x0 = np.array(np.reshape(x0, (N, 3)), dtype=float)
+    v0 = np.array(np.reshape(v0, (N, 3)), dtype=float)
+    campo = modello_campo(E0, B0, grad)
+    integratore = scelta_integratore(integratore, campo)
+    x, v, inizio = x0, v0, 0
+    tempo = 0.0 if dt_globale else np.zeros(N)
+    mediano, passo_mediano = passi // 2, -1
+    x_mediano = v_mediano = np.full((N, 3), np.nan)
+    if integratore == 'esatto':
+        dt = intervallo_temporale(particella, campo.B(x0), frazione, dt_globale)
+        xs, vs = orbita_esatta(campo.E0, campo.B0, x0, v0, particella, np.outer([mediano, passi - 1], dt))
+        x_mediano, v_mediano, xj = xs[0], vs[0], xs[1]
+        tempo = (passi - 1) * (dt[0] if dt_globale else dt)
+        checkpoint = None
+    elif checkpoint is not None:
+        parametri = impronta(E0, B0, grad, x0, v0, particella, integratore, frazione, dt_globale)
+        stato = carica_checkpoint(checkpoint, parametri)
+        if stato is not None:
+            inizio = int(stato['passo'])
+            if inizio > passi - 1:
+                raise ValueError(f"Il salvataggio {checkpoint} è al passo {inizio}, oltre i {passi} passi richiesti.")
+            x, v = stato['x'], stato['v']
+            tempo = float(stato['tempo']) if dt_globale else stato['tempo']
+            x_mediano, v_mediano, passo_mediano = stato['x_mediano'], stato['v_mediano'], int(stato['passo_mediano'])
+            if passo_mediano != mediano and mediano < inizio: #stato mediano di una simulazione di lunghezza diversa
+                for j, xj, vj, _ in passi_avanzamento(E0, B0, x0, v0, particella, mediano + 1, campo, integratore, frazione,
+                                                      dt_globale):
+                    pass
+                x_mediano, v_mediano, passo_mediano = xj, vj, mediano
+
+    def salva(j, xj, vj):
+        salva_checkpoint(checkpoint, parametri=parametri, passo=j, x=xj, v=vj, tempo=tempo, x_mediano=x_mediano,
+                         v_mediano=v_mediano, passo_mediano=passo_mediano,
+                         stato_rng=json.dumps(stato_rng) if stato_rng is not None else '')
+
+    if integratore != 'esatto':
+        for j, xj, vj, dt in passi_avanzamento(E0, B0, x, v, particella, passi, campo, integratore, frazione, dt_globale, inizio):
+            if j == mediano:
+                x_mediano, v_mediano, passo_mediano = xj, vj, j
+            if checkpoint is not None and j > inizio and j % passi_checkpoint == 0:
+                salva(j, xj, vj) #stato al passo j, con i tempi dei passi precedenti
+            tempo += dt #somma corrente dei dt
+        if checkpoint is not None and j > inizio:
+            salva(j, xj, vj)
+    tr = np.stack((x0, xj))
+    tempi = np.array([tempo, np.zeros_like(tempo)])
+
+    if N == 1:
+        return tr[:, 0, :], tempi if dt_globale else tempi[:, 0], x_mediano, v_mediano
+    return tr, tempi, x_mediano, v_mediano
+
+@cronometrato('deriva_centro_guida')
+def deriva_centro_guida(E0, B0, x0, v0, particella, passi, N, grad, integratore=None, frazione=0.0001, tolleranza=None,
+                        periodi_minimi=4):
+    """
+    Stima la velocità di drift durante l'integrazione dal moto del centro guida: la posizione di
+    ciascuna particella è mediata (pesata con i dt) su ogni girazione completata, e la velocità di
+    drift è la pendenza della retta che interpola i centri guida in funzione del tempo, aggiornata ad
+    ogni girazione con somme correnti (algoritmo di Welford), senza conservare la traiettoria.
+    Le girazioni sono misurate e non dedotte dal numero di passi: ad ogni passo la fase di ciascuna
+    particella avanza dell'angolo di cui ruota la velocità ortogonale a B nel sistema del drift E x B,
+    w = v - v_E, e una girazione si chiude quando la fase accumulata raggiunge 2 pi (il passo a cavallo
+    è diviso fra le due girazioni in proporzione all'angolo). In campi non uniformi le girazioni durano
+    quindi quanto le orbite vere, anche quando |B| varia lungo l'orbita.
+    L'errore standard della pendenza dà l'incertezza di ciascuna particella, che con tolleranza viene
+    fermata non appena l'incertezza relativa scende sotto la tolleranza, così che passi è solo il
+    numero massimo di passi. Le particelle che completano meno di 3 girazioni (ad esempio perché
+    attraversano regioni in cui B si annulla e non girano attorno a una linea di campo) non hanno una
+    retta dei centri guida: per loro la deriva è lo spostamento fra gli estremi diviso per il tempo,
+    come in deriva_flusso, e l'errore è nan.
+    Il risultato ha la forma di quello di deriva_flusso: le posizioni sono quelle della retta dei
+    centri guida alla prima e all'ultima girazione, per cui vel_drift restituisce la pendenza stimata.
+    -------------------------------------------
+    Parametri:
+    - come per deriva_flusso
+    - tolleranza : errore relativo sulla velocità di drift a cui fermare una particella (None per
+      integrare sempre tutti i passi)
+    - periodi_minimi : numero minimo di girazioni prima di valutare la convergenza (almeno 3)
+    -------------------------------------------
+    Restituisce:
+    - tr : posizioni del centro guida interpolato alla prima e all'ultima girazione (2, N, 3)
+    - tempi : tempo fra la prima e l'ultima girazione nella prima riga, zeri nella seconda (2, N)
+    - x_finale, v_finale : matrici Nx3 di posizioni e velocità all'ultimo passo di ciascuna particella
+    - errore : matrice Nx3 degli errori standard della velocità di drift [m/s] (nan senza retta)
+    - passi_usati : array dei passi effettivamente integrati per ciascuna particella
+    """
+    campo = modello_campo(E0, B0, grad)
+    passo = integratori[scelta_integratore(integratore, campo)]
+    passi_periodo = max(1, int(round(1 / frazione)))
+    periodi_minimi = max(3, periodi_minimi)
+    if passi < periodi_minimi * passi_periodo:
+        raise ValueError(f"Servono almeno {periodi_minimi * passi_periodo} passi ({periodi_minimi} periodi di Larmor).")
+
+    def girazione(x, v, B):
+        #velocità ortogonale a B nel sistema del drift E x B e versore di B
+        b = B / np.maximum(np.linalg.norm(B, axis=1), np.finfo(float).tiny)[:, None]
+        w = v - teorica_exb(campo.E(x), B)
+        return w - np.sum(w * b, axis=1)[:, None] * b, b
+
+    #risultati per tutte le particelle
+    tr = np.zeros((2, N, 3))
+    tempi = np.zeros((2, N))
+    x_finale = np.zeros((N, 3))
+    v_finale = np.zeros((N, 3))
+    errore = np.full((N, 3), np.nan)
+    passi_usati = np.full(N, passi)
+
+    #stato e somme delle sole particelle ancora attive
+    indici = np.arange(N)
+    x = np.array(np.reshape(x0, (N, 3)), dtype=float)
+    v = np.array(np.reshape(v0, (N, 3)), dtype=float)
+    x_iniziale = x.copy()
+    B = campo.B(x)
+    w, _ = girazione(x, v, B)
+    tempo, fase = np.zeros(N), np.zeros(N)
+    somma_dt, somma_tdt, somma_xdt = np.zeros(N), np.zeros(N), np.zeros((N, 3))
+    n, t_primo, t_ultimo = np.zeros(N, dtype=int), np.zeros(N), np.zeros(N)
+    media_t, media_X = np.zeros(N), np.zeros((N, 3))
+    Stt, StX, SXX = np.zeros(N), np.zeros((N, 3)), np.zeros((N, 3))
+    errore_pendenza = np.full((N, 3), np.nan)
+
+    def concludi(scelte, j):
+        i = indici[scelte]
+        retta = n[scelte] >= 3
+        pendenza = StX[scelte] / np.where(retta, Stt[scelte], 1)[:, None]
+        tr[0, i] = np.where(retta[:, None], media_X[scelte] + pendenza * (t_primo[scelte] - media_t[scelte])[:, None],
+                            x_iniziale[scelte])
+        tr[1, i] = np.where(retta[:, None], media_X[scelte] + pendenza * (t_ultimo[scelte] - media_t[scelte])[:, None],
+                            x[scelte])
+        tempi[0, i] = np.where(retta, t_ultimo[scelte] - t_primo[scelte], tempo[scelte])
+        x_finale[i], v_finale[i] = x[scelte], v[scelte]
+        errore[i] = np.where(retta[:, None], errore_pendenza[scelte], np.nan)
+        passi_usati[i] = j + 1
+
+    for j in range(passi):
+        dt = intervallo_temporale(particella, B, frazione)
+        x_nuova, v_nuova = passo(x, v, dt, campo, B, particella)
+        B_nuovo = campo.B(x_nuova)
+        w_nuova, b = girazione(x_nuova, v_nuova, B_nuovo)
+        angolo = np.arctan2(np.sum(b * np.cross(w, w_nuova), axis=1), np.sum(w * w_nuova, axis=1))
+        chiusi = np.abs(fase + angolo) >= 2 * np.pi
+        #quota del passo che appartiene alla girazione in corso
+        quota = np.where(chiusi, np.clip((2 * np.pi - np.abs(fase)) / np.maximum(np.abs(angolo), np.finfo(float).tiny), 0, 1), 1)
+        dt_prima = quota * dt
+        somma_dt += dt_prima
+        somma_tdt += (tempo + dt_prima / 2) * dt_prima
+        somma_xdt += x * dt_prima[:, None]
+        fase += angolo
+
+        if np.any(chiusi): #girazioni completate: nuovi punti del centro guida
+            c = np.flatnonzero(chiusi)
+            t_ultimo[c] = somma_tdt[c] / somma_dt[c]
+            X = somma_xdt[c] / somma_dt[c][:, None]
+            n[c] += 1
+            primi = c[n[c] == 1]
+            t_primo[primi] = t_ultimo[primi]
+            scarto_t = t_ultimo[c] - media_t[c]
+            scarto_X = X - media_X[c]
+            media_t[c] += scarto_t / n[c]
+            media_X[c] += scarto_X / n[c][:, None]
+            Stt[c] += scarto_t * (t_ultimo[c] - media_t[c])
+            StX[c] += scarto_t[:, None] * (X - media_X[c])
+            SXX[c] += scarto_X * (X - media_X[c])
+            #il resto del passo apre la girazione successiva
+            dt_dopo = dt[c] - dt_prima[c]
+            somma_dt[c] = dt_dopo
+            somma_tdt[c] = (tempo[c] + dt_prima[c] + dt_dopo / 2) * dt_dopo
+            somma_xdt[c] = x[c] * dt_dopo[:, None]
+            fase[c] -= 2 * np.pi * np.sign(fase[c])
+
+            c = c[n[c] >= 3]
+            pendenza = StX[c] / Stt[c][:, None]
+            residui = np.maximum(SXX[c] - pendenza * StX[c], 0) / (n[c] - 2)[:, None]
+            errore_pendenza[c] = np.sqrt(residui / Stt[c][:, None])
+
+        tempo += dt
+        x, v, B, w = x_nuova, v_nuova, B_nuovo, w_nuova
+
+        if tolleranza is not None and np.any(chiusi):
+            valutabili = chiusi & (n >= periodi_minimi)
+            convergenti = np.zeros(len(indici), dtype=bool)
+            convergenti[valutabili] = (np.linalg.norm(errore_pendenza[valutabili], axis=1)
+                                       <= tolleranza * np.linalg.norm(StX[valutabili] / Stt[valutabili][:, None], axis=1))
+            if np.any(convergenti):
+                concludi(convergenti, j)
+                restanti = ~convergenti
+                indici, x, v, B, w, x_iniziale = indici[restanti], x[restanti], v[restanti], B[restanti], w[restanti], x_iniziale[restanti]
+                tempo, fase, n = tempo[restanti], fase[restanti], n[restanti]
+                somma_dt, somma_tdt, somma_xdt = somma_dt[restanti], somma_tdt[restanti], somma_xdt[restanti]
+                t_primo, t_ultimo, media_t, media_X = t_primo[restanti], t_ultimo[restanti], media_t[restanti], media_X[restanti]
+                Stt, StX, SXX, errore_pendenza = Stt[restanti], StX[restanti], SXX[restanti], errore_pendenza[restanti]
+                if len(indici) == 0:
+                    break
+
+    if len(indici) > 0: #particelle non fermate: retta dei centri guida fino all'ultima girazione completata
+        concludi(np.ones(len(indici), dtype=bool), passi - 1)
+
+    if N == 1:
+        return tr[:, 0, :], tempi[:, 0], x_finale[0], v_finale[0], errore[0], passi_usati[0]
+    return tr, tempi, x_finale, v_finale, errore, passi_usati
+
+#Modello del centro guida: equazioni della deriva senza il moto di girazione
+
+def centro_guida_iniziale(x, v, campo, particella):
+    """
+    Passa dallo stato di ciascuna particella alle variabili del centro guida: posizione del centro
+    R = x + m (w x B)/(q B^2), con w = v - v_E la velocità nel sistema del drift E x B, velocità
+    parallela a B e momento magnetico mu = m w_ort^2 / (2 |B|), invariante adiabatico.
+    -------------------------------------------
+    Parametri:
+    - x, v : matrici Nx3 di posizioni e velocità
+    - campo : oggetto Campo
+    - particella : elemento della classe omonima
+    -------------------------------------------
+    Restituisce:
+    - R : matrice Nx3 dei centri guida
+    - v_parallela : array delle velocità parallele a B
+    - mu : array dei momenti magnetici [J/T]
+    """
+    B = campo.B(x)
+    intB = np.linalg.norm(B, axis=1)
+    b = B / intB[:, None]
+    w = v - teorica_exb(campo.E(x), B)
+    v_parallela = np.sum(w * b, axis=1)
+    w_ortogonale = w - v_parallela[:, None] * b
+    mu = particella.m * np.sum(w_ortogonale**2, axis=1) / (2 * intB)
+    R = x + colonna(particella.m / particella.q) * np.cross(w, B) / intB[:, None]**2
+
+    return R, v_parallela, mu
+
+def equazioni_centro_guida(R, v_parallela, mu, campo, particella):
+    """
+    Derivate temporali delle variabili del centro guida: dR/dt = v_par b + v_E + v_gradB, con i drift
+    E x B e di gradiente di teorica_exb e deriva_gradiente (v_ort^2 = 2 mu |B| / m), e
+    dv_par/dt = (q E·b - mu b·grad|B|)/m (forza dello specchio magnetico). Il drift di curvatura è trascurato.
+    -------------------------------------------
+    Restituisce:
+    - dR/dt (matrice Nx3) e dv_par/dt (array)
+    """
+    B = campo.B(R)
+    E = campo.E(R)
+    gradB = campo.gradiente_modulo(R)
+    intB = np.linalg.norm(B, axis=1)
+    b = B / intB[:, None]
+    v_ortogonale_quadro = 2 * mu * intB / particella.m
+    dR = v_parallela[:, None] * b + teorica_exb(E, B) + deriva_gradiente(B, gradB, v_ortogonale_quadro, particella)
+    dv = (particella.q * np.sum(E * b, axis=1) - mu * np.sum(gradB * b, axis=1)) / particella.m
+
+    return dR, dv
+
+@cronometrato('avanzamento_centro_guida')
+def avanzamento_centro_guida(E0, B0, x0, v0, particella, durata, N, grad, frazione_scala=0.05, passi_minimi=10,
+                             passi_massimi=10000):
+    """
+    Integra con Runge-Kutta del quarto ordine le equazioni del centro guida per un tempo durata, senza
+    risolvere le orbite di Larmor: il dt di ciascuna particella è frazione_scala del tempo in cui il
+    centro guida percorre la lunghezza di scala del campo |B|/|grad|B||, compreso fra durata/passi_massimi
+    e durata/passi_minimi (in campo uniforme le equazioni hanno soluzione esatta e bastano passi_minimi passi).
+    Il modello vale solo se il raggio di Larmor è piccolo rispetto alla lunghezza di scala (si veda
+    parametro_adiabatico).
+    Il risultato ha la forma di quello di deriva_flusso, per cui vel_drift e istogramma_vdrift si
+    applicano direttamente.
+    -------------------------------------------
+    Parametri:
+    - E0, B0, x0, v0, particella, N, grad : come per avanzamento
+    - durata : tempo simulato [s], uguale per tutte le particelle o array di N valori
+    - frazione_scala : frazione della lunghezza di scala percorsa in un passo
+    - passi_minimi : numero minimo di passi per particella
+    - passi_massimi : numero massimo di passi per particella
+    -------------------------------------------
+    Restituisce:
+    - tr : centri guida iniziali e finali (2, N, 3)
+    - tempi : durata nella prima riga, zeri nella seconda (2, N)
+    - x_finale, v_finale : centri guida finali e una velocità con le stesse componenti parallela e
+      ortogonale a B della particella, per le velocità teoriche
+    - passi_usati : array dei passi di ciascuna particella
+    """
+    campo = modello_campo(E0, B0, grad)
+    x = np.reshape(np.asarray(x0, dtype=float), (N, 3))
+    R, v_parallela, mu = centro_guida_iniziale(x, np.reshape(np.asarray(v0, dtype=float), (N, 3)), campo, particella)
+    R_iniziale = R.copy()
+    restante = np.broadcast_to(np.asarray(durata, dtype=float), (N,)).copy()
+    dt_massimo = restante / passi_minimi
+    dt_minimo = restante / passi_massimi
+    passi_usati = np.zeros(N, dtype=int)
+
+    for _ in range(passi_massimi + 1):
+        attive = restante > 0
+        if not np.any(attive):
+            break
+        k1R, k1v = equazioni_centro_guida(R, v_parallela, mu, campo, particella)
+        intB = np.linalg.norm(campo.B(R), axis=1)
+        scala = intB / np.maximum(np.linalg.norm(campo.gradiente_modulo(R), axis=1), np.finfo(float).tiny) #lunghezza di scala
+        velocita = np.maximum(np.linalg.norm(k1R, axis=1), np.finfo(float).tiny)
+        dt = np.minimum(np.clip(frazione_scala * scala / velocita, dt_minimo, dt_massimo), restante)
+        dt[~attive] = 0
+        h = dt[:, None]
+        k2R, k2v = equazioni_centro_guida(R + k1R * h / 2, v_parallela + k1v * dt / 2, mu, campo, particella)
+        k3R, k3v = equazioni_centro_guida(R + k2R * h / 2, v_parallela + k2v * dt / 2, mu, campo, particella)
+        k4R, k4v = equazioni_centro_guida(R + k3R * h, v_parallela + k3v * dt, mu, campo, particella)
+        R = R + h / 6 * (k1R + 2 * k2R + 2 * k3R + k4R)
+        v_parallela = v_parallela + dt / 6 * (k1v + 2 * k2v + 2 * k3v + k4v)
+        restante = np.where(restante - dt > 1e-12 * dt_massimo * passi_minimi, restante - dt, 0)
+        passi_usati += attive
+
+    #velocità equivalente: componente parallela e ortogonale (in una direzione qualunque) a B
+    B = campo.B(R)
+    intB = np.linalg.norm(B, axis=1)
+    b = B / intB[:, None]
+    ortogonale = np.cross(b, np.where(np.abs(b[:, [0]]) < 0.9, [[1, 0, 0]], [[0, 1, 0]]))
+    ortogonale /= np.linalg.norm(ortogonale, axis=1)[:, None]
+    v_finale = v_parallela[:, None] * b + np.sqrt(2 * mu * intB / particella.m)[:, None] * ortogonale
+
+    tr = np.stack((R_iniziale, R))
+    tempi = np.stack((np.broadcast_to(np.asarray(durata, dtype=float), (N,)), np.zeros(N)))
+    if N == 1:
+        return tr[:, 0, :], tempi[:, 0], R, v_finale, passi_usati
+    return tr, tempi, R, v_finale, passi_usati
+
+def parametro_adiabatico(x, v, campo, particella):
+    """
+    Rapporto fra il raggio di Larmor e la lunghezza di scala |B|/|grad|B|| del campo per ciascuna
+    particella: il modello del centro guida è accurato solo se è molto minore di 1.
+    -------------------------------------------
+    Parametri:
+    - x, v : matrici Nx3 di posizioni e velocità
+    - campo : oggetto Campo
+    - particella : elemento della classe omonima
+    """
+    _, _, mu = centro_guida_iniziale(x, v, campo, particella)
+    intB = np.linalg.norm(campo.B(x), axis=1)
+    raggio = np.sqrt(2 * mu * intB / particella.m) * particella.m / (np.abs(particella.q) * intB)
+
+    return raggio * np.linalg.norm(campo.gradiente_modulo(x), axis=1) / intB
+
+def confronto_centro_guida(E0, B0, x0, v0, particella, grad, periodi=6, integratore='boris', frazione=0.001,
+                           frazione_scala=0.05):
+    """
+    Verifica il modello del centro guida rispetto all'integrazione completa delle orbite: le stesse
+    particelle sono simulate per periodi periodi di Larmor con passi_avanzamento (stimando la deriva
+    con deriva_centro_guida) e per lo stesso tempo con avanzamento_centro_guida.
+    -------------------------------------------
+    Parametri:
+    - E0, B0, x0, v0, particella, grad : come per avanzamento
+    - periodi : periodi di Larmor simulati con le orbite complete (almeno 4)
+    - integratore, frazione : integrazione delle orbite complete
+    - frazione_scala : come per avanzamento_centro_guida
+    -------------------------------------------
+    Restituisce:
+    - dizionario con le velocità di drift delle orbite ('orbite') e del centro guida ('centro_guida'),
+      l'errore relativo di ciascuna particella ('errore_relativo'), il parametro adiabatico iniziale
+      ('parametro_adiabatico') e i tempi di calcolo ('tempo_orbite', 'tempo_centro_guida') [s]
+    """
+    N = np.shape(x0)[0]
+    inizio = time.perf_counter()
+    tr, tempi, _, _, _, _ = deriva_centro_guida(E0, B0, x0, v0, particella, int(round(periodi / frazione)), N, grad,
+                                                integratore, frazione)
+    tempo_orbite = time.perf_counter() - inizio
+    orbite = np.atleast_2d(vel_drift(tr, tempi))
+
+    #stesso tempo simulato: dal primo all'ultimo periodo mediato, a partire dal centro guida del primo periodo
+    inizio = time.perf_counter()
+    trc, tempic, _, _, _ = avanzamento_centro_guida(E0, B0, x0, v0, particella, np.atleast_2d(tempi)[0], N, grad, frazione_scala)
+    tempo_centro_guida = time.perf_counter() - inizio
+    centro_guida = np.atleast_2d(vel_drift(trc, tempic))
+
+    return {
+        'orbite': orbite,
+        'centro_guida': centro_guida,
+        'errore_relativo': np.linalg.norm(centro_guida - orbite, axis=1) / np.linalg.norm(orbite, axis=1),
+        'parametro_adiabatico': parametro_adiabatico(np.reshape(x0, (N, 3)), np.reshape(v0, (N, 3)), modello_campo(E0, B0, grad),
+                                                     particella),
+        'tempo_orbite': tempo_orbite,
+        'tempo_centro_guida': tempo_centro_guida
+    }
+
 #Rappresentazioni grafiche 
 
-def grafico2d (tr, E, B0, particella, grad, dt):
+@cronometrato('grafico2d')
+def grafico2d (tr, E, B0, particella, grad, dt, salva=None, veloce=True):
     """
     Disegna l'orbita in uno spazio cartesiano 2d mostrando esplicitamente anche
     direzione e verso dei vettori campo elettrico e magnetico. 
     L'intensità del campo magnetico lungo la direzione di variazione per gradiente è resa da una scala di colori. 
+    Con più traiettorie, nella modalità veloce queste sono ridotte alla risoluzione della figura
+    (si veda decimazione_minmax) e disegnate tutte insieme con una sola LineCollection.
     -------------------------------------------
     Parametri:
     - tr  :  traiettoria
     - E : campo elettrico che giace su xy
     - B0 : campo magnetico che giace su z
     - particella: elemento della classe omonima
-    - grad : char che identifica il gradiente
+    - grad : char che identifica il gradiente, oppure oggetto Campo
     - dt : restituito da avanzamento per l'eventuale rappresentazione di v
+    - salva : se diverso da None, percorso del file in cui salvare la figura invece di mostrarla
+    - veloce : se False disegna ciascuna traiettoria completa con una chiamata a plot (default True)
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
+    from matplotlib.collections import LineCollection
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -219,10 +1151,16 @@ def grafico2d (tr, E, B0, particella, grad, dt):
     #Caso 2: simulazione multipla (N traiettorie, l'array tr ha dimensione 3)
     else:
         N = tr.shape[1] 
-        for j in range(N):
-            x0, y0 = tr[0, j, 0], tr[0, j, 1]
-            ax.plot(tr[:, j, 0], tr[:, j, 1], color=plt.cm.viridis(j/N))  #per avere colori diversi per ogni particella
-            ax.scatter(x0, y0, color='blue', marker='.') #label tolte per non appesantire il grafico
+        colori = plt.cm.viridis(np.arange(N) / N)  #per avere colori diversi per ogni particella
+        if veloce:
+            punti = int(fig.get_size_inches()[0] * fig.dpi) #risoluzione orizzontale della figura
+            linee = LineCollection(np.swapaxes(decimazione_minmax(tr[:, :, :2], punti), 0, 1), colors=colori)
+            ax.add_collection(linee)
+            ax.autoscale_view()
+        else:
+            for j in range(N):
+                ax.plot(tr[:, j, 0], tr[:, j, 1], color=colori[j])
+        ax.scatter(tr[0, :, 0], tr[0, :, 1], color='blue', marker='.') #label tolte per non appesantire il grafico
         ax.set_title(f"Traiettorie per {N} {particella.plurale} nel piano xy")
 
     xmin, xmax = ax.get_xlim() 
@@ -235,8 +1173,9 @@ def grafico2d (tr, E, B0, particella, grad, dt):
     By_pos = b[-1, 1]
     ax.text(Bx_pos -0.06 * (xmax - xmin), By_pos - 0.05 * (ymax - ymin), 'B', color='black', fontsize=12, fontweight='bold')
 
-    if (grad == 0): #assenza di gradiente magnetico
-            if B0[2]>0 :
+    campo = modello_campo(E, B0, grad)
+    if isinstance(campo, CampoUniforme): #assenza di gradiente magnetico
+            if campo.B0[2]>0 :
                 ax.scatter(a, b, marker='o', edgecolors='gray', s=150, c='white')
                 ax.scatter(a, b, marker='.', c='gray')
             else:
@@ -244,24 +1183,21 @@ def grafico2d (tr, E, B0, particella, grad, dt):
                 ax.scatter(a, b, marker='x', c='gray')
 
     else : #caso con gradiente magnetico
-        B_grad = gradiente(grad, a)
-        B_abs = np.abs(B_grad[2])
+        punti = np.column_stack((a.ravel(), b.ravel(), np.zeros(a.size)))
+        B_griglia = campo.B(punti)[:, 2].reshape(a.shape) #campo valutato una sola volta su tutta la griglia
+        B_abs = np.abs(B_griglia)
         colori = [(0.9, 0.9, 0.9), (0, 0, 0)]  #da grigio chiaro a nero
         mappa = mcolors.LinearSegmentedColormap.from_list("custom_gray", colori) 
         #grigiochiaro= np.min(B_abs) + 0.1* (np.max(B_abs) - np.min(B_abs)) #partenza dal grigio invece che dal bianco
-        for i in range(a.shape[0]):
-            for j in range(a.shape[1]):
-                #Br_value = B_grad(a[i, j])[2]
-                Br_value = gradiente(grad, a[i, j])[2]
-                intensita = (np.abs(Br_value) - np.min(B_abs)) / (np.max(B_abs) - np.min(B_abs))
-                intensita = np.clip(intensita, 0, 1)  #normalizzazione intensità colore
-                colore = mappa(intensita) #colormap in scala di grigi
-                if Br_value >= 0:
-                    ax.scatter(a[i, j], b[i, j], c=[colore], marker='o', s=100)
-                    ax.scatter(a[i, j], b[i, j], c='white', marker='o', s=10)  #puntino cerchiato
-                else: 
-                    ax.scatter(a[i, j], b[i, j], c=[colore], marker='o', s=100)
-                    ax.scatter(a[i, j], b[i, j], c='white', marker='x', s=60, linewidths=1.5)  #croce cerchiata
+        ampiezza = np.max(B_abs) - np.min(B_abs)
+        if ampiezza > 0:
+            intensita = np.clip((B_abs - np.min(B_abs)) / ampiezza, 0, 1)  #normalizzazione intensità colore
+        else: #campo di modulo costante sulla griglia
+            intensita = np.ones(B_abs.shape)
+        positivo = B_griglia >= 0
+        ax.scatter(a, b, c=mappa(intensita.ravel()), marker='o', s=100) #colormap in scala di grigi
+        ax.scatter(a[positivo], b[positivo], c='white', marker='o', s=10)  #puntino cerchiato
+        ax.scatter(a[~positivo], b[~positivo], c='white', marker='x', s=60, linewidths=1.5)  #croce cerchiata
 
         #colorbar della scala di colori di B
         normalizzazione = mcolors.Normalize(vmin=np.min(B_abs), vmax=np.max(B_abs)) #per fare la colorbar normalizzata
@@ -296,79 +1232,441 @@ def grafico2d (tr, E, B0, particella, grad, dt):
 
     ax.set_xlabel("x [m]")
     ax.set_ylabel("y [m]")
-    plt.show()
-
-#Gradienti magnetici
+    mostra_o_salva(fig, salva)
 
-def gradiente (tipo, x):
+def decimazione_minmax (tr, punti):
     """
-    Funzione necessaria per distinguere i 3 tipi di gradiente magnetico tramite un dizionario. 
+    Riduce le traiettorie a circa 5*punti/2 campioni ciascuna conservandone l'aspetto: i campioni
+    sono divisi in circa punti/2 gruppi consecutivi e di ciascun gruppo si tengono il primo campione
+    e quelli con coordinate minime e massime (in ordine temporale), più l'ultimo campione.
     -------------------------------------------
     Parametri:
-    x : coordinata su cui varia l'intensità del vettore campo magnetico
+    - tr : array delle traiettorie (campioni, N, d)
+    - punti : risoluzione della figura in pixel
+    -------------------------------------------
+    Restituisce:
+    - traiettorie ridotte (campioni ridotti, N, d)
     """
-    opzioni = {
-        "1": B_grad_1,
-        "2": B_grad_2,
-        "3": B_grad_3
-    }
-    if tipo in opzioni:
-        return opzioni[tipo](x) 
+    campioni, N = tr.shape[0], tr.shape[1]
+    gruppi = max(1, punti // 2)
+    if campioni <= 5 * gruppi:
+        return tr
+    lunghezza = -(-campioni // gruppi) #divisione arrotondata per eccesso
+    completi = (campioni // lunghezza) * lunghezza
+    #gruppi completi (viste senza copia dei dati) ed eventuale gruppo finale più corto
+    blocchi = [(0, completi, lunghezza)]
+    if completi < campioni:
+        blocchi.append((completi, campioni, campioni - completi))
+    scelti = []
+    for inizio, fine, l in blocchi:
+        righe = l * max(1, 2**22 // (l * N)) #gruppi letti insieme: pochi MB alla volta anche da array su disco
+        for a in range(inizio, fine, righe):
+            b = min(fine, a + righe)
+            blocco = np.asarray(tr[a:b])
+            primi = np.broadcast_to(np.arange(a, b, l)[:, None], ((b - a) // l, N))
+            indici = [primi]
+            for c in range(tr.shape[2]):
+                coordinata = blocco[:, :, c].reshape(-1, l, N)
+                indici += [primi + np.argmin(coordinata, axis=1), primi + np.argmax(coordinata, axis=1)]
+            scelti.append(np.sort(np.stack(indici, axis=1), axis=1).reshape(-1, N)) #ordine temporale dentro ogni gruppo
+    scelti.append(np.full((1, N), campioni - 1))
+
+    return np.take_along_axis(tr, np.vstack(scelti)[:, :, None], axis=0)
+
+@cronometrato('matplotlib: mostra o salva')
+def mostra_o_salva (fig, salva):
+    """
+    Mostra la figura a schermo oppure, se è indicato un percorso, la salva su file e la chiude
+    (modalità senza finestre per le esecuzioni batch).
+    -------------------------------------------
+    Parametri:
+    - fig : figura di matplotlib
+    - salva : percorso del file oppure None
+    """
+    import matplotlib.pyplot as plt
+    if salva is None:
+        plt.show()
     else:
-        raise ValueError(f"Tipo di gradiente non valido: {tipo}. Inserire uno fra tra '1', '2', '3'.")
+        fig.savefig(salva)
+        plt.close(fig)
+
+#Modelli di campo e gradienti magnetici
+
+class Campo():
+    """
+    Classe base dei modelli di campo elettromagnetico statico. Le sottoclassi definiscono il campo
+    magnetico B(posizioni) e, quando noto in forma analitica, il gradiente del suo modulo, valutati
+    insieme su tutte le particelle (matrici Nx3); il campo elettrico è uniforme.
+    Per definire una nuova legge basta ridefinire B (ed eventualmente gradiente_modulo) e
+    registrarla con registra_campo.
+    -------------------------------------------
+    Parametri:
+    E0 : campo elettrico uniforme [V/m]
+    """
 
-def B_grad_1 (x) : 
+    def __init__(self, E0=(0, 0, 0)):
+        self.E0 = np.asarray(E0, dtype=float)
+
+    def B(self, posizioni):
+        raise NotImplementedError("Le sottoclassi di Campo devono definire il campo magnetico B.")
+
+    def E(self, posizioni):
+        return np.broadcast_to(self.E0, np.shape(posizioni))
+
+    def gradiente_modulo(self, posizioni, h=1e-6):
+        """
+        Gradiente di |B| nelle posizioni (matrice Nx3), per differenze finite centrate di passo h [m].
+        """
+        posizioni = np.asarray(posizioni, dtype=float)
+        grad = np.zeros(posizioni.shape)
+        for c in range(3):
+            spostamento = np.zeros(3)
+            spostamento[c] = h
+            grad[:, c] = (np.linalg.norm(self.B(posizioni + spostamento), axis=1) -
+                          np.linalg.norm(self.B(posizioni - spostamento), axis=1)) / (2 * h)
+        return grad
+
+    def con_campo_elettrico(self, E0, precisione=float):
+        """
+        Restituisce una copia del modello con il campo elettrico uniforme E0, nel tipo in virgola
+        mobile precisione (np.float32 nella modalità in singola precisione di passi_avanzamento).
+        """
+        copia = copy.copy(self)
+        copia.E0 = np.asarray(E0, dtype=precisione)
+        return copia
+
+class CampoUniforme(Campo):
     """
-    Legge di variazione spaziale del campo magnetico. 
+    Campo magnetico uniforme e costante.
     -------------------------------------------
     Parametri:
-    x : coordinata su cui varia l'intensità del vettore campo magnetico
+    B0 : vettore campo magnetico [T]
+    E0 : campo elettrico uniforme [V/m]
     """
-    B0 = 0.00001 #T
-    q = 0.00005
-    Br = B0+q*(x**1)
 
-    return [0,0,Br]
+    def __init__(self, B0, E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.B0 = np.asarray(B0, dtype=float)
 
-def B_grad_2 (x) :
+    def B(self, posizioni):
+        return np.broadcast_to(self.B0, np.shape(posizioni))
+
+    def gradiente_modulo(self, posizioni):
+        return np.zeros(np.shape(posizioni))
+
+class CampoLineare(Campo):
     """
-    Legge di variazione spaziale del campo magnetico. 
+    Campo magnetico lungo z con intensità lineare nella coordinata x: Bz = B0 + pendenza*x.
     -------------------------------------------
     Parametri:
-    x : coordinata su cui varia l'intensità del vettore campo magnetico
+    B0 : intensità in x = 0 [T]
+    pendenza : dBz/dx [T/m]
+    E0 : campo elettrico uniforme [V/m]
     """
-    B0 = 0.01 #T
-    q = 0.02
-    Br = B0+q*(x**1)
 
-    return [0,0,Br]
+    def __init__(self, B0, pendenza, E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.B0 = B0
+        self.pendenza = pendenza
+
+    def B(self, posizioni):
+        B = np.zeros(np.shape(posizioni))
+        B[:, 2] = self.B0 + self.pendenza * posizioni[:, 0]
+        return B
+
+    def gradiente_modulo(self, posizioni):
+        grad = np.zeros(np.shape(posizioni))
+        grad[:, 0] = np.sign(self.B0 + self.pendenza * posizioni[:, 0]) * self.pendenza
+        return grad
 
-def B_grad_3 (x) : 
+class CampoEsponenziale(Campo):
     """
-    Legge di variazione spaziale del campo magnetico. 
+    Campo magnetico lungo z con intensità esponenziale nella coordinata x: Bz = B0*exp(x/L).
     -------------------------------------------
     Parametri:
-    x : coordinata su cui varia l'intensità del vettore campo magnetico
+    B0 : intensità in x = 0 [T]
+    L : lunghezza di scala della variazione [m]
+    E0 : campo elettrico uniforme [V/m]
     """
-    B0 = -0.0005 #T
-    q = -0.0008
-    Br = B0+q*(x**1)
 
-    return [0,0,Br]
+    def __init__(self, B0, L, E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.B0 = B0
+        self.L = L
+
+    def B(self, posizioni):
+        B = np.zeros(np.shape(posizioni))
+        B[:, 2] = self.B0 * np.exp(posizioni[:, 0] / self.L)
+        return B
+
+    def gradiente_modulo(self, posizioni):
+        grad = np.zeros(np.shape(posizioni))
+        grad[:, 0] = np.abs(self.B0) * np.exp(posizioni[:, 0] / self.L) / self.L
+        return grad
+
+class CampoDipolo(Campo):
+    """
+    Campo di un dipolo magnetico puntiforme: B = mu0/(4 pi) (3 r (m·r)/r^5 - m/r^3).
+    Il gradiente del modulo è calcolato per differenze finite.
+    -------------------------------------------
+    Parametri:
+    momento : momento di dipolo magnetico [A m^2]
+    centro : posizione del dipolo [m]
+    E0 : campo elettrico uniforme [V/m]
+    """
+
+    def __init__(self, momento, centro=(0, 0, 0), E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.momento = np.asarray(momento, dtype=float)
+        self.centro = np.asarray(centro, dtype=float)
+
+    def B(self, posizioni):
+        r = posizioni - self.centro
+        modr = np.linalg.norm(r, axis=1)[:, None]
+        mr = np.sum(r * self.momento, axis=1)[:, None]
+        return 1e-7 * (3 * r * mr / modr**5 - self.momento / modr**3)
+
+class CampoSpecchio(Campo):
+    """
+    Specchio magnetico con asse z: Bz = B0 (1 + z^2/L^2), con le componenti radiali
+    Bx = -B0 x z/L^2 e By = -B0 y z/L^2 che rendono il campo a divergenza nulla.
+    Il gradiente del modulo è calcolato per differenze finite.
+    -------------------------------------------
+    Parametri:
+    B0 : intensità al centro dello specchio [T]
+    L : lunghezza di scala lungo l'asse [m]
+    E0 : campo elettrico uniforme [V/m]
+    """
+
+    def __init__(self, B0, L, E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.B0 = B0
+        self.L = L
+
+    def B(self, posizioni):
+        x, y, z = posizioni[:, 0], posizioni[:, 1], posizioni[:, 2]
+        fattore = self.B0 / self.L**2
+        return np.column_stack((-fattore * x * z, -fattore * y * z, self.B0 + fattore * z**2))
+
+class CampoGriglia(Campo):
+    """
+    Campo campionato su una griglia regolare 3D (forma nx x ny x nz x 3) o 2D nel piano xy
+    (forma nx x ny x 3, campo invariante lungo z), valutato per interpolazione trilineare
+    (bilineare in 2D) su tutte le particelle insieme. Fuori dalla griglia si usa il valore
+    sul bordo. La mappa del campo elettrico, se presente, si somma al campo uniforme E0.
+    Le mappe possono essere array in memoria o memory-map (si veda carica_campo).
+    -------------------------------------------
+    Parametri:
+    B_griglia : valori del campo magnetico sui nodi [T]
+    origine : coordinate del primo nodo [m]
+    passo : distanza fra i nodi, uguale o diversa per ciascun asse [m]
+    E_griglia : valori del campo elettrico sui nodi, stessa griglia di B [V/m] (facoltativo)
+    E0 : campo elettrico uniforme [V/m]
+    """
+
+    def __init__(self, B_griglia, origine=(0, 0, 0), passo=1.0, E_griglia=None, E0=(0, 0, 0)):
+        super().__init__(E0)
+        self.dimensioni = np.ndim(B_griglia) - 1
+        if self.dimensioni not in (2, 3) or np.shape(B_griglia)[-1] != 3:
+            raise ValueError("La mappa di B deve avere forma (nx, ny, 3) oppure (nx, ny, nz, 3).")
+        if min(np.shape(B_griglia)[:-1]) < 2:
+            raise ValueError("La griglia deve avere almeno due nodi per asse.")
+        if E_griglia is not None and np.shape(E_griglia) != np.shape(B_griglia):
+            raise ValueError("Le mappe di E e di B devono avere la stessa forma.")
+        self.B_griglia = B_griglia
+        self.E_griglia = E_griglia
+        self.origine = np.asarray(origine, dtype=float)[:self.dimensioni]
+        self.passo = np.broadcast_to(np.asarray(passo, dtype=float), (self.dimensioni,)).copy()
+        self.nodi = np.array(np.shape(B_griglia)[:-1])
+        #salti nell'indice lineare dei nodi per ciascun asse e per ciascuno dei 2^d vertici di una cella
+        self.salti = np.append(np.cumprod(self.nodi[:0:-1])[::-1], 1)
+        self.vertici = [[(vertice >> c) & 1 for c in range(self.dimensioni)] for vertice in range(2 ** self.dimensioni)]
+        self.percorsi = None
+
+    def interpola(self, griglia, posizioni):
+        """
+        Interpolazione multilineare dei valori della griglia nelle posizioni (matrice Nx3).
+        """
+        u = (np.asarray(posizioni)[:, :self.dimensioni] - self.origine) / self.passo
+        i0 = np.clip(np.floor(u).astype(np.intp), 0, self.nodi - 2)
+        t = np.clip(u - i0, 0.0, 1.0)
+        base = i0 @ self.salti
+        valori = np.reshape(griglia, (-1, 3)) #vista piatta dei nodi, non copia la memory-map
+
+        risultato = np.zeros((len(u), 3))
+        for vertice in self.vertici:
+            peso = np.prod(np.where(vertice, t, 1 - t), axis=1)
+            risultato += peso[:, None] * valori[base + np.dot(vertice, self.salti)]
+        return risultato
+
+    def B(self, posizioni):
+        return self.interpola(self.B_griglia, posizioni)
+
+    def E(self, posizioni):
+        if self.E_griglia is None:
+            return super().E(posizioni)
+        return (self.E0 + self.interpola(self.E_griglia, posizioni)).astype(self.E0.dtype, copy=False)
+
+    def __copy__(self):
+        copia = object.__new__(type(self))
+        copia.__dict__.update(self.__dict__)
+        return copia
+
+    def __getstate__(self):
+        #le mappe lette da file vengono riaperte dal processo che riceve l'oggetto invece di essere copiate
+        stato = dict(self.__dict__)
+        if self.percorsi is not None:
+            stato['B_griglia'] = stato['E_griglia'] = None
+        return stato
+
+    def __setstate__(self, stato):
+        self.__dict__.update(stato)
+        if self.percorsi is not None:
+            self.B_griglia, self.E_griglia = leggi_mappe(*self.percorsi)
+
+def leggi_mappe (percorso, percorso_E=None):
+    """
+    Legge le mappe di campo da file. Un file .npy contiene la sola mappa di B e viene aperto come
+    memory-map in sola lettura; un file .npz contiene la mappa 'B' e facoltativamente 'E', e viene
+    caricato in memoria. percorso_E indica un file .npy separato per la mappa di E.
+    -------------------------------------------
+    Restituisce:
+    - mappe di B e di E (None se assente)
+    """
+    if percorso.endswith('.npz'):
+        with np.load(percorso) as dati:
+            B_griglia = dati['B']
+            E_griglia = dati['E'] if 'E' in dati else None
+    else:
+        B_griglia = np.load(percorso, mmap_mode='r')
+        E_griglia = None
+    if percorso_E is not None:
+        E_griglia = np.load(percorso_E, mmap_mode='r')
+    return B_griglia, E_griglia
+
+def carica_campo (percorso, origine=None, passo=None, percorso_E=None, E0=(0, 0, 0)):
+    """
+    Crea un CampoGriglia da mappe salvate su file (si veda leggi_mappe). Origine e passo della
+    griglia, se non indicati, sono letti dalle chiavi 'origine' e 'passo' del file .npz, oppure
+    valgono (0, 0, 0) e 1 m.
+    -------------------------------------------
+    Parametri:
+    percorso : file .npy o .npz con la mappa di B
+    origine : coordinate del primo nodo [m]
+    passo : distanza fra i nodi [m]
+    percorso_E : file .npy con la mappa di E (facoltativo)
+    E0 : campo elettrico uniforme [V/m]
+    """
+    if percorso.endswith('.npz'):
+        with np.load(percorso) as dati:
+            if origine is None and 'origine' in dati:
+                origine = dati['origine']
+            if passo is None and 'passo' in dati:
+                passo = dati['passo']
+    B_griglia, E_griglia = leggi_mappe(percorso, percorso_E)
+    campo = CampoGriglia(B_griglia, origine=(0, 0, 0) if origine is None else origine,
+                         passo=1.0 if passo is None else passo, E_griglia=E_griglia, E0=E0)
+    campo.percorsi = (percorso, percorso_E)
+    return campo
+
+def campiona_campo (campo, origine, passo, nodi):
+    """
+    Campiona un modello di campo sui nodi di una griglia regolare, ad esempio per salvarlo con
+    np.save/np.savez e riutilizzarlo come CampoGriglia.
+    -------------------------------------------
+    Parametri:
+    campo : elemento di una sottoclasse di Campo
+    origine : coordinate del primo nodo [m]
+    passo : distanza fra i nodi [m]
+    nodi : numero di nodi per asse (2 o 3 valori)
+    -------------------------------------------
+    Restituisce:
+    - mappe di B e di E sui nodi, di forma (*nodi, 3)
+    """
+    d = len(nodi)
+    passo = np.broadcast_to(np.asarray(passo, dtype=float), (d,))
+    assi = [origine[c] + passo[c] * np.arange(nodi[c]) for c in range(d)]
+    punti = np.zeros((int(np.prod(nodi)), 3))
+    punti[:, :d] = np.stack(np.meshgrid(*assi, indexing='ij'), axis=-1).reshape(-1, d)
+    return campo.B(punti).reshape(*nodi, 3), np.array(campo.E(punti)).reshape(*nodi, 3)
+
+coefficienti_gradiente = {
+    "1": (0.00001, 0.00005), #(B0 [T], dBz/dx [T/m]) delle leggi lineari predefinite
+    "2": (0.01, 0.02),
+    "3": (-0.0005, -0.0008)
+}
+
+#Registro delle leggi di campo magnetico selezionabili con il char grad
+campi = {tipo: CampoLineare(*coefficienti) for tipo, coefficienti in coefficienti_gradiente.items()}
+
+def registra_campo (tipo, campo):
+    """
+    Registra una nuova legge di campo, che diventa selezionabile in avanzamento e nelle altre
+    funzioni passando tipo come argomento grad.
+    -------------------------------------------
+    Parametri:
+    tipo : char (o stringa) che identifica la legge
+    campo : elemento di una sottoclasse di Campo
+    """
+    if not isinstance(campo, Campo):
+        raise TypeError("Il secondo argomento deve essere un oggetto della classe Campo.")
+    if tipo == "0":
+        raise ValueError("Il tipo '0' è riservato al campo uniforme.")
+    campi[tipo] = campo
+
+def modello_campo (E0, B0, grad):
+    """
+    Restituisce il modello di campo usato dalle simulazioni: campo uniforme B0 se grad è '0',
+    altrimenti la legge registrata con il char grad; in entrambi i casi con campo elettrico E0.
+    Se grad è già un oggetto Campo viene restituito così com'è.
+    -------------------------------------------
+    Parametri:
+    E0 : campo elettrico uniforme [V/m]
+    B0 : campo magnetico uniforme [T] (usato solo se grad è '0')
+    grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    """
+    if isinstance(grad, Campo):
+        return grad
+    if grad == "0" or grad == 0:
+        return CampoUniforme(B0, E0)
+    if grad in campi:
+        return campi[grad].con_campo_elettrico(E0)
+    raise ValueError(f"Tipo di gradiente non valido: {grad}. Inserire uno fra '0', {', '.join(repr(t) for t in campi)}.")
+
+def gradiente (tipo, x):
+    """
+    Valuta la legge di campo registrata con il char tipo lungo l'asse x (y = z = 0).
+    -------------------------------------------
+    Parametri:
+    tipo : char che identifica la legge
+    x : coordinata (o array di coordinate) su cui varia l'intensità del vettore campo magnetico
+    -------------------------------------------
+    Restituisce:
+    - lista delle tre componenti [Bx, By, Bz], ciascuna con la forma di x
+    """
+    if tipo not in campi:
+        raise ValueError(f"Tipo di gradiente non valido: {tipo}. Inserire uno fra {', '.join(repr(t) for t in campi)}.")
+    x = np.asarray(x, dtype=float)
+    posizioni = np.zeros((x.size, 3))
+    posizioni[:, 0] = x.ravel()
+    B = campi[tipo].B(posizioni)
+
+    return [B[:, c].reshape(x.shape) for c in range(3)]
 
 def plot_gradienti():
     """
     Mostra il valore del campo magnetico B(x) per i tre diversi tipi di gradiente implementati.
     """
     x = np.linspace(-3, 3, 100)  #intervallo ragionevole per x
-    B1 = [gradiente("1", xi)[2] for xi in x]
-    B2 = np.array([gradiente("2", xi)[2] for xi in x])
-    B3 = np.array([gradiente("3", xi)[2] for xi in x])
+    B1 = gradiente("1", x)[2]
+    B2 = gradiente("2", x)[2]
+    B3 = gradiente("3", x)[2]
     
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(8, 5))
-    plt.plot(x, B1, label="B_grad_1(x)", color='blue')
-    plt.plot(x, B2, label="B_grad_2(x)", color='green')
-    plt.plot(x, B3, label="B_grad_3(x)", color='red')
+    plt.plot(x, B1, label="Gradiente 1: B(x)", color='blue')
+    plt.plot(x, B2, label="Gradiente 2: B(x)", color='green')
+    plt.plot(x, B3, label="Gradiente 3: B(x)", color='red')
     
     plt.xlabel("Posizione x [m]")
     plt.ylabel("B(x) [T]")
@@ -381,7 +1679,7 @@ def plot_gradienti():
 
 #Generazione di parametri iniziali casuali
 
-def velocita_montecarlo(N):
+def velocita_montecarlo(N, rng=None):
     """
     Genera N velocità iniziali casuali per particelle. Ciascuna componente è compresa in un range
     fra -10^5 m/s e +10^5 m/s con probabilità uniforme. La limitazione permette di mantenersi nel
@@ -393,7 +1691,9 @@ def velocita_montecarlo(N):
     -------------------------------------------
     Parametri:
     - N : numero dei vettori velocità inziale da generare
+    - rng : generatore np.random.Generator da usare (default lo stato globale di np.random)
     """
+    generatore = np.random if rng is None else rng
     #numero_positive = N // 2 + (N % 2)  #perché N potrebbe essere dispari
     #numero_negative = N // 2 
     #vxpos = np.random.uniform(1e3, 1e5, numero_positive)
@@ -405,14 +1705,14 @@ def velocita_montecarlo(N):
     #vzpos = np.random.uniform(1e3, 1e5, numero_positive)
     #vzneg = np.random.uniform(-1e5, -1e3, numero_negative)
     #vz = np.concatenate((vzpos, vzneg))
-    vx = np.random.uniform(-1e5, 1e5, N)
-    vy = np.random.uniform(-1e5, 1e5, N)
+    vx = generatore.uniform(-1e5, 1e5, N)
+    vy = generatore.uniform(-1e5, 1e5, N)
     vz = np.zeros(N)
     array_v = np.column_stack((vx, vy, vz))
 
     return array_v
 
-def posizioni_montecarlo(N):
+def posizioni_montecarlo(N, rng=None):
     """
     Genera N posizioni iniziali casuali per particelle. Ciascuna componente è compresa in un range
     fra -1.5 m e +1.5 m con probabilità uniforme. La limitazione permette di mantenersi entro una
@@ -420,21 +1720,286 @@ def posizioni_montecarlo(N):
     -------------------------------------------
     Parametri:
     - N : numero dei vettori velocità inziale da generare
+    - rng : generatore np.random.Generator da usare (default lo stato globale di np.random)
     """
-    px = np.random.uniform(-1.5, 1.5, N)
-    py = np.random.uniform(-1.5, 1.5, N)
-    pz = np.random.uniform(-1.5, 1.5, N)
+    generatore = np.random if rng is None else rng
+    px = generatore.uniform(-1.5, 1.5, N)
+    py = generatore.uniform(-1.5, 1.5, N)
+    pz = generatore.uniform(-1.5, 1.5, N)
     array_p = np.column_stack((px, py, pz))
 
     return array_p
 
-def scelta_posizione(N):
+#Campionamento a varianza ridotta delle condizioni iniziali
+
+#numeri di direzione di Joe e Kuo (s, a, m) per le dimensioni di Sobol successive alla prima
+DIREZIONI_SOBOL = [(1, 0, [1]), (2, 1, [1, 3]), (3, 1, [1, 3, 1]), (3, 2, [1, 1, 1]), (4, 1, [1, 1, 3, 3]),
+                   (4, 4, [1, 3, 5, 13])]
+BITS_SOBOL = 32
+
+def punti_casuali(N, dimensioni, rng):
+    """
+    Genera N punti pseudocasuali indipendenti nel cubo unitario.
+    -------------------------------------------
+    Parametri:
+    - N : numero di punti
+    - dimensioni : numero di coordinate di ciascun punto
+    - rng : generatore np.random.Generator
+    -------------------------------------------
+    Restituisce:
+    - matrice N x dimensioni di valori in [0,1)
+    """
+    return rng.random((N, dimensioni))
+
+def punti_stratificati(N, dimensioni, rng):
+    """
+    Genera N punti stratificati nel cubo unitario (ipercubo latino): ogni coordinata ha esattamente un
+    punto in ciascuno degli N intervalli di ampiezza 1/N, in posizione casuale al suo interno, e gli
+    strati delle diverse coordinate sono accoppiati con permutazioni casuali.
+    -------------------------------------------
+    Parametri:
+    - N : numero di punti
+    - dimensioni : numero di coordinate di ciascun punto
+    - rng : generatore np.random.Generator
+    -------------------------------------------
+    Restituisce:
+    - matrice N x dimensioni di valori in [0,1)
+    """
+    strati = np.column_stack([rng.permutation(N) for _ in range(dimensioni)])
+
+    return (strati + rng.random((N, dimensioni))) / N
+
+def punti_halton(N, dimensioni, rng):
+    """
+    Genera i primi N punti della sequenza a bassa discrepanza di Halton (inverso radicale dell'indice
+    nelle basi prime 2, 3, 5, ...), traslati modulo 1 di un vettore casuale (rotazione di
+    Cranley-Patterson) perché semi diversi diano repliche indipendenti della stima.
+    -------------------------------------------
+    Parametri:
+    - N : numero di punti
+    - dimensioni : numero di coordinate di ciascun punto (al massimo 10)
+    - rng : generatore np.random.Generator
+    -------------------------------------------
+    Restituisce:
+    - matrice N x dimensioni di valori in [0,1)
+    """
+    basi = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+    if dimensioni > len(basi):
+        raise ValueError(f"La sequenza di Halton è disponibile fino a {len(basi)} dimensioni.")
+    punti = np.zeros((N, dimensioni))
+    for d, base in enumerate(basi[:dimensioni]):
+        indici = np.arange(1, N + 1)
+        peso = 1 / base
+        while np.any(indici > 0):
+            punti[:, d] += peso * (indici % base)
+            indici //= base
+            peso /= base
+
+    return (punti + rng.random(dimensioni)) % 1
+
+def punti_sobol(N, dimensioni, rng):
+    """
+    Genera i primi N punti della sequenza a bassa discrepanza di Sobol (numeri di direzione di Joe e
+    Kuo), con uno spostamento digitale casuale (XOR con un intero casuale per coordinata) che conserva
+    la struttura di rete della sequenza e rende indipendenti le repliche con semi diversi. La
+    sequenza ha le proprietà migliori quando N è una potenza di 2.
+    -------------------------------------------
+    Parametri:
+    - N : numero di punti
+    - dimensioni : numero di coordinate di ciascun punto (al massimo 7)
+    - rng : generatore np.random.Generator
+    -------------------------------------------
+    Restituisce:
+    - matrice N x dimensioni di valori in [0,1)
+    """
+    if dimensioni > len(DIREZIONI_SOBOL) + 1:
+        raise ValueError(f"La sequenza di Sobol è disponibile fino a {len(DIREZIONI_SOBOL) + 1} dimensioni.")
+    L = BITS_SOBOL
+    direzioni = np.zeros((dimensioni, L + 1), dtype=np.uint64)
+    direzioni[0, 1:] = [1 << (L - k) for k in range(1, L + 1)]
+    for d in range(1, dimensioni):
+        s, a, m = DIREZIONI_SOBOL[d - 1]
+        V = [0] * (L + 1)
+        for k in range(1, L + 1):
+            if k <= s:
+                V[k] = m[k - 1] << (L - k)
+            else:
+                V[k] = V[k - s] ^ (V[k - s] >> s)
+                for i in range(1, s):
+                    if (a >> (s - 1 - i)) & 1:
+                        V[k] ^= V[k - i]
+        direzioni[d] = V
+
+    indici = np.arange(N, dtype=np.uint64)
+    interi = np.zeros((N, dimensioni), dtype=np.uint64)
+    for b in range(L):
+        bit = (indici >> np.uint64(b)) & np.uint64(1)
+        if not bit.any():
+            break
+        interi ^= bit[:, None] * direzioni[:, b + 1]
+    interi ^= rng.integers(0, 1 << L, dimensioni, dtype=np.uint64)
+
+    return interi / float(1 << L)
+
+campionamenti = {
+    'casuale': punti_casuali,
+    'stratificato': punti_stratificati,
+    'halton': punti_halton,
+    'sobol': punti_sobol,
+}
+
+def velocita_uniformi(u):
+    """
+    Trasforma punti del quadrato unitario in velocità con componenti x e y uniformi fra -10^5 m/s e
+    +10^5 m/s e componente z nulla, come velocita_montecarlo.
+    -------------------------------------------
+    Parametri:
+    - u : matrice Nx2 di valori in [0,1)
+    -------------------------------------------
+    Restituisce:
+    - matrice Nx3 delle velocità
+    """
+    v = np.zeros((len(u), 3))
+    v[:, :2] = -1e5 + 2e5 * u
+
+    return v
+
+def velocita_maxwelliane(u, sigma=1e5 / np.sqrt(3)):
+    """
+    Trasforma punti del quadrato unitario in velocità con componenti x e y gaussiane di media nulla
+    (distribuzione di Maxwell nel piano ortogonale a B) con la trasformazione di Box-Muller; la
+    componente z è nulla. La deviazione standard predefinita è quella delle componenti di
+    velocita_uniformi, così le due distribuzioni hanno la stessa energia cinetica media.
+    -------------------------------------------
+    Parametri:
+    - u : matrice Nx2 di valori in [0,1)
+    - sigma : deviazione standard di ciascuna componente [m/s], pari a sqrt(kT/m)
+    -------------------------------------------
+    Restituisce:
+    - matrice Nx3 delle velocità
+    """
+    raggio = sigma * np.sqrt(-2 * np.log(1 - u[:, 0]))
+    angolo = 2 * np.pi * u[:, 1]
+    v = np.zeros((len(u), 3))
+    v[:, 0] = raggio * np.cos(angolo)
+    v[:, 1] = raggio * np.sin(angolo)
+
+    return v
+
+distribuzioni = {
+    'uniforme': velocita_uniformi,
+    'maxwelliana': velocita_maxwelliane,
+}
+
+def registra_distribuzione(nome, funzione):
+    """
+    Aggiunge una distribuzione di velocità definita dall'utente a quelle utilizzabili in
+    condizioni_iniziali.
+    -------------------------------------------
+    Parametri:
+    - nome : nome con cui richiamare la distribuzione
+    - funzione : funzione che trasforma una matrice Nx2 di punti in [0,1) in una matrice Nx3 di
+      velocità; per conservare i vantaggi dei metodi stratificati e a bassa discrepanza deve essere
+      una trasformazione monotona o comunque regolare (ad esempio l'inversa della funzione di ripartizione)
+    """
+    distribuzioni[nome] = funzione
+
+def condizioni_iniziali(N, metodo='casuale', distribuzione='uniforme', antitetico=False, rng=None):
+    """
+    Genera posizioni e velocità iniziali di N particelle campionando congiuntamente un punto del cubo
+    unitario a 5 dimensioni per particella (2 per la velocità, 3 per la posizione) con il metodo
+    scelto e trasformandolo nelle distribuzioni richieste. Le posizioni sono uniformi fra -1.5 m e
+    +1.5 m come in posizioni_montecarlo. Con antitetico le particelle sono generate a coppie adiacenti
+    con la stessa posizione e velocità opposte (v, -v): per distribuzioni simmetriche le due metà del
+    campione hanno la stessa legge, ma gli scarti della deriva dalla media si compensano nella coppia.
+    -------------------------------------------
+    Parametri:
+    - N : numero di particelle
+    - metodo : chiave di campionamenti ('casuale', 'stratificato', 'halton', 'sobol')
+    - distribuzione : chiave di distribuzioni ('uniforme', 'maxwelliana' o registrate dall'utente)
+    - antitetico : se True genera le velocità a coppie antitetiche
+    - rng : generatore np.random.Generator, oppure seme intero o None da cui crearlo
+    -------------------------------------------
+    Restituisce:
+    - x0, v0 : matrici Nx3 delle posizioni e delle velocità iniziali
+    """
+    if metodo not in campionamenti:
+        raise ValueError(f"Metodo di campionamento sconosciuto: {metodo}. Disponibili: {', '.join(campionamenti)}.")
+    if distribuzione not in distribuzioni:
+        raise ValueError(f"Distribuzione sconosciuta: {distribuzione}. Disponibili: {', '.join(distribuzioni)}.")
+    rng = np.random.default_rng(rng)
+    n = (N + 1) // 2 if antitetico else N
+    u = campionamenti[metodo](n, 5, rng)
+    v0 = distribuzioni[distribuzione](u[:, :2])
+    x0 = -1.5 + 3 * u[:, 2:]
+    if antitetico:
+        v0 = np.stack((v0, -v0), axis=1).reshape(2 * n, 3)[:N]
+        x0 = np.repeat(x0, 2, axis=0)[:N]
+
+    return x0, v0
+
+def efficienza_campionamento(E0, B0, grad, particella, passi, N, repliche=50, campionamenti_confronto=None, seme=None,
+                             integratore=None, frazione=0.0001):
+    """
+    Stima l'efficacia dei metodi di campionamento per la deriva media: per ogni metodo ripete la
+    simulazione di N particelle con repliche semi indipendenti e misura la dispersione delle medie
+    ottenute. Per i metodi non indipendenti (stratificati, a bassa discrepanza, antitetici) l'errore
+    standard calcolato dal singolo campione non è affidabile e solo la dispersione fra repliche
+    misura la precisione effettiva.
+    -------------------------------------------
+    Parametri:
+    - E0, B0, grad, particella, passi, integratore, frazione : come per deriva_flusso
+    - N : numero di particelle di ciascuna replica
+    - repliche : numero di repliche per metodo
+    - campionamenti_confronto : dizionario {etichetta: (metodo, distribuzione, antitetico)}; di default
+      confronta tutti i metodi con e senza coppie antitetiche con velocità uniformi
+    - seme : seme da cui derivare i semi delle repliche
+    -------------------------------------------
+    Restituisce:
+    - dizionario {etichetta: (media, deviazione standard delle medie, fattore)}, dove fattore è il
+      rapporto fra la varianza delle medie del campionamento casuale semplice e quella del metodo,
+      cioè quante volte meno particelle servono per la stessa confidenza (nan senza un campionamento
+      casuale semplice di riferimento)
+    """
+    if campionamenti_confronto is None:
+        campionamenti_confronto = {}
+        for metodo in campionamenti:
+            campionamenti_confronto[metodo] = (metodo, 'uniforme', False)
+            campionamenti_confronto[metodo + '+antitetico'] = (metodo, 'uniforme', True)
+    semi = np.random.SeedSequence(seme).spawn(repliche)
+    medie = {}
+    for etichetta, (metodo, distribuzione, antitetico) in campionamenti_confronto.items():
+        medie[etichetta] = []
+        for seme_replica in semi:
+            x0, v0 = condizioni_iniziali(N, metodo, distribuzione, antitetico, np.random.default_rng(seme_replica))
+            tr, tempi = deriva_flusso(E0, B0, x0, v0, particella, passi, N, grad, integratore, frazione)[:2]
+            medie[etichetta].append(np.mean(np.linalg.norm(np.atleast_2d(vel_drift(tr, tempi)), axis=1)))
+
+    riferimento = None #campionamento casuale semplice con la stessa distribuzione del primo metodo
+    distribuzione_riferimento = next(iter(campionamenti_confronto.values()))[1]
+    for etichetta, (metodo, distribuzione, antitetico) in campionamenti_confronto.items():
+        if metodo == 'casuale' and distribuzione == distribuzione_riferimento and not antitetico and riferimento is None:
+            riferimento = np.var(medie[etichetta], ddof=1)
+    risultati = {}
+    for etichetta, valori in medie.items():
+        varianza = np.var(valori, ddof=1)
+        fattore = riferimento / varianza if riferimento is not None and varianza > 0 else np.nan
+        risultati[etichetta] = (np.mean(valori), np.sqrt(varianza), fattore)
+
+    return risultati
+
+def scelta_posizione(N, rng=None, x0='montecarlo'):
     """
     Permette di scegliere nelle simulazioni multiple se generare casualmente le posizioni iniziali o
-    usarne una comune, inserita, per tutte le particelle. 
+    usarne una comune, inserita, per tutte le particelle.
     -------------------------------------------
     Parametri:
     - N : numero delle particelle presenti nella simulazione
+    - rng : generatore np.random.Generator per le posizioni casuali (default lo stato globale di np.random)
+    - x0 : posizioni casuali della scelta B: matrice Nx3 già campionata, ad esempio da condizioni_iniziali
+      insieme alle velocità, restituita così com'è; None se le posizioni vanno generate dal seme insieme
+      alle velocità, e allora la scelta B restituisce None; 'montecarlo' (default) per generarle con
+      posizioni_montecarlo(N, rng)
     """
     print('Premere A per fissare una sola posizione iniziale;')
     print('Premere B per generare N posizioni iniziali casuali;')
@@ -446,15 +2011,570 @@ def scelta_posizione(N):
             x0 = np.tile(pos0, (N, 1))
             break
         elif (risp2 == 'B'):
-            x0= posizioni_montecarlo(N)
+            if isinstance(x0, str):
+                x0 = posizioni_montecarlo(N, rng)
             break
         else:
             print("Input non valido, inserire A o B.")
 
     return x0
 
+#Salvataggio periodico e ripresa delle simulazioni
+
+def impronta(*parametri):
+    """
+    Impronta SHA-1 (stringa esadecimale) di un insieme di parametri: numeri, stringhe, array,
+    liste, tuple e dizionari, oggetti Particella e Campo (attraverso i loro attributi) e semi
+    np.random.SeedSequence. Parametri uguali danno la stessa impronta in ogni esecuzione, per cui
+    l'impronta identifica una simulazione nei file salvati su disco.
+    -------------------------------------------
+    Parametri:
+    - parametri : oggetti da cui calcolare l'impronta
+    """
+    h = hashlib.sha1()
+
+    def aggiorna(oggetto):
+        if isinstance(oggetto, (Particella, Campo)):
+            h.update(type(oggetto).__name__.encode())
+            oggetto = vars(oggetto)
+        if isinstance(oggetto, np.random.SeedSequence):
+            oggetto = (oggetto.entropy, oggetto.spawn_key)
+        if isinstance(oggetto, dict):
+            for chiave in sorted(oggetto):
+                h.update(f'{chiave}:'.encode())
+                aggiorna(oggetto[chiave])
+        elif isinstance(oggetto, (list, tuple)):
+            h.update(b'(')
+            for elemento in oggetto:
+                aggiorna(elemento)
+            h.update(b')')
+        elif isinstance(oggetto, np.ndarray):
+            h.update(str(oggetto.shape).encode())
+            h.update(np.ascontiguousarray(oggetto, dtype=float).tobytes())
+        elif isinstance(oggetto, (int, float, np.number)) and float(oggetto) == oggetto:
+            h.update(repr(float(oggetto)).encode()) #1 e 1.0 hanno la stessa impronta
+        else:
+            h.update(repr(oggetto).encode())
+        h.update(b';')
+
+    aggiorna(parametri)
+    return h.hexdigest()
+
+def salva_checkpoint(percorso, *array, **stato):
+    """
+    Scrive in un file .npz lo stato di una simulazione. Il file è scritto con un nome temporaneo e
+    poi rinominato, così che un'interruzione durante la scrittura lasci intatto il salvataggio precedente.
+    -------------------------------------------
+    Parametri:
+    - percorso : file di destinazione
+    - array : array da salvare senza nome (arr_0, arr_1, ... come in np.savez)
+    - stato : array da salvare, passati per nome
+    """
+    temporaneo = percorso + '.tmp'
+    with open(temporaneo, 'wb') as file:
+        np.savez(file, *array, **stato)
+    os.replace(temporaneo, percorso)
+
+def carica_checkpoint(percorso, parametri):
+    """
+    Legge lo stato salvato da salva_checkpoint e controlla che sia stato prodotto dalla stessa
+    simulazione, confrontando l'impronta dei parametri salvata con quella indicata.
+    -------------------------------------------
+    Parametri:
+    - percorso : file del salvataggio
+    - parametri : impronta dei parametri della simulazione da riprendere
+    -------------------------------------------
+    Restituisce:
+    - dizionario degli array salvati, oppure None se il file non esiste
+    """
+    if not os.path.exists(percorso):
+        return None
+    with np.load(percorso) as file:
+        stato = {nome: file[nome] for nome in file.files}
+    if str(stato['parametri']) != parametri:
+        raise ValueError(f"Il salvataggio {percorso} è stato prodotto da una simulazione con parametri diversi.")
+    return stato
+
+#Cache dei risultati su disco
+
+def risultato_memorizzato(cartella, parametri, calcola, dimensione_massima=2**30):
+    """
+    Cache su disco indirizzata dal contenuto: il risultato di calcola() è salvato in un file .npz il
+    cui nome è l'impronta dei parametri (si veda impronta), e una richiesta con gli stessi parametri
+    lo rilegge invece di ripetere il calcolo. Quando la cartella supera la dimensione massima sono
+    eliminati i risultati usati meno di recente (politica LRU, con la data di modifica dei file
+    aggiornata ad ogni lettura).
+    -------------------------------------------
+    Parametri:
+    - cartella : cartella della cache
+    - parametri : tutto ciò da cui dipende il risultato (campi, particella, condizioni iniziali o seme, passi, integratore...)
+    - calcola : funzione senza argomenti che restituisce un array o una tupla di array
+    - dimensione_massima : dimensione massima della cartella [byte]
+    -------------------------------------------
+    Restituisce:
+    - il risultato (tupla di array, oppure array)
+    - True se il risultato è stato letto dalla cache, False se è stato calcolato
+    """
+    os.makedirs(cartella, exist_ok=True)
+    percorso = os.path.join(cartella, impronta(parametri) + '.npz')
+    if os.path.exists(percorso):
+        with np.load(percorso) as file:
+            risultato = tuple(file[f'arr_{i}'] for i in range(len(file.files) - 1))
+            singolo = bool(file['singolo'])
+        os.utime(percorso) #usato ora: ultimo a essere eliminato
+        return risultato[0] if singolo else risultato, True
+
+    risultato = calcola()
+    singolo = not isinstance(risultato, tuple)
+    salva_checkpoint(percorso, *((risultato,) if singolo else risultato), singolo=singolo)
+    libera_cache(cartella, dimensione_massima, conserva=percorso)
+    return risultato, False
+
+def libera_cache(cartella, dimensione_massima, conserva=None):
+    """
+    Elimina dalla cartella della cache i file usati meno di recente finché la dimensione totale non
+    scende sotto quella massima.
+    -------------------------------------------
+    Parametri:
+    - cartella : cartella della cache
+    - dimensione_massima : dimensione massima [byte]
+    - conserva : file da non eliminare in ogni caso (il risultato appena scritto)
+    """
+    voci = [os.path.join(cartella, nome) for nome in os.listdir(cartella) if nome.endswith('.npz')]
+    voci.sort(key=os.path.getmtime)
+    totale = sum(os.path.getsize(voce) for voce in voci)
+    for voce in voci:
+        if totale <= dimensione_massima:
+            break
+        if voce != conserva:
+            totale -= os.path.getsize(voce)
+            os.remove(voce)
+
+#Esecuzione parallela delle simulazioni statistiche
+
+PARTICELLE_SEME = 64 #particelle per seme in statistica_parallela, indipendente dal numero di processi
+
+def blocco_statistica(compito):
+    """
+    Simula con deriva_flusso (o, se è indicata una tolleranza, con deriva_centro_guida) un blocco di
+    particelle per una configurazione di campi; è la funzione eseguita da ciascun processo di
+    statistica_parallela. Le condizioni iniziali mancanti sono generate gruppo per gruppo, ciascun
+    gruppo di particelle con un generatore inizializzato dal proprio seme, con condizioni_iniziali se è
+    indicato un campionamento, e del blocco sono conservate le n particelle a partire da primo.
+    -------------------------------------------
+    Parametri:
+    - compito : tupla (E0, B0, grad, x0, v0, n, semi, primo, particella, passi, integratore, frazione,
+      tolleranza, checkpoint, passi_checkpoint, campionamento), con semi la lista di coppie (seme,
+      particelle) dei gruppi che contengono il blocco, primo l'indice della prima particella del blocco
+      fra quelle dei gruppi, x0 e v0 matrici nx3 oppure None, checkpoint il file
+      di salvataggio di deriva_flusso (None per non salvare) e campionamento una tupla (metodo,
+      distribuzione, antitetico) di condizioni_iniziali oppure None
+    -------------------------------------------
+    Restituisce:
+    - tr, tempi, x_mediano, v_mediano come deriva_flusso (sempre nella forma a N particelle), oppure
+      tr, tempi, x_finale, v_finale, errore, passi_usati come deriva_centro_guida
+    """
+    E0, B0, grad, x0, v0, n, semi, primo, particella, passi, integratore, frazione, tolleranza, checkpoint, passi_checkpoint, \
+        campionamento = compito
+    gruppi = [(np.random.default_rng(seme), m) for seme, m in semi]
+    parte = slice(primo, primo + n) #particelle del blocco fra quelle generate dai gruppi
+    if campionamento is not None and (x0 is None or v0 is None):
+        campioni = [condizioni_iniziali(m, *campionamento, rng=rng) for rng, m in gruppi]
+        x0 = np.concatenate([c[0] for c in campioni])[parte] if x0 is None else x0
+        v0 = np.concatenate([c[1] for c in campioni])[parte] if v0 is None else v0
+    if v0 is None:
+        v0 = np.concatenate([velocita_montecarlo(m, rng) for rng, m in gruppi])[parte]
+    if x0 is None:
+        x0 = np.concatenate([posizioni_montecarlo(m, rng) for rng, m in gruppi])[parte]
+    if tolleranza is not None:
+        risultato = deriva_centro_guida(E0, B0, x0, v0, particella, passi, n, grad, integratore, frazione, tolleranza)
+    else:
+        risultato = deriva_flusso(E0, B0, x0, v0, particella, passi, n, grad, integratore, frazione, checkpoint=checkpoint,
+                                  passi_checkpoint=passi_checkpoint, stato_rng=[rng.bit_generator.state for rng, _ in gruppi])
+
+    #stati ed errori nella forma a n particelle anche per blocchi di una sola particella
+    altri = tuple(np.reshape(r, (n, 3)) if np.size(r) == 3 * n else np.reshape(r, (n,)) for r in risultato[2:])
+    return (np.reshape(risultato[0], (2, n, 3)), np.reshape(risultato[1], (2, n))) + altri
+
+def statistica_parallela(configurazioni, particella, N, passi, x0=None, v0=None, processi=1, seme=None,
+                         integratore=None, frazione=0.0001, tolleranza=None, checkpoint=None, passi_checkpoint=10000,
+                         campionamento=None, esecutore=None):
+    """
+    Distribuisce su più processi le simulazioni a memoria costante di N particelle per una lista di
+    configurazioni di campi: l'insieme delle particelle è diviso in tanti blocchi quanti sono i
+    processi (al più N) e ogni coppia (configurazione, blocco) è un compito indipendente. Le condizioni
+    iniziali sono generate in gruppi consecutivi di PARTICELLE_SEME particelle, ciascuno con un proprio
+    seme derivato da seme con np.random.SeedSequence, e ogni blocco genera i gruppi che lo contengono
+    conservandone solo le proprie particelle: le condizioni iniziali di ogni particella dipendono
+    quindi solo da seme e non dal numero di processi, che non è limitato dal numero di gruppi, e a
+    parità di seme i risultati sono gli stessi con qualunque numero di processi; le stesse condizioni
+    iniziali sono usate per tutte le configurazioni.
+    -------------------------------------------
+    Parametri:
+    - configurazioni : lista di tuple (E0, B0, grad)
+    - particella : elemento della classe omonima
+    - N : numero di particelle
+    - passi : numero di iterazioni
+    - x0, v0 : matrici Nx3 delle condizioni iniziali; se None sono generate casualmente in ciascun blocco
+    - processi : numero di processi (con 1 il calcolo avviene nel processo corrente)
+    - seme : seme per le condizioni iniziali generate
+    - integratore, frazione : come per avanzamento
+    - tolleranza : se diversa da None la deriva è stimata con deriva_centro_guida, con passi come
+      numero massimo di passi
+    - checkpoint : cartella in cui ogni blocco salva periodicamente il proprio stato (si veda
+      deriva_flusso), in un file il cui nome è l'impronta di configurazione, blocco e semi: rilanciando
+      la stessa simulazione con lo stesso numero di processi i blocchi riprendono dal salvataggio. Non è
+      usata con tolleranza.
+    - passi_checkpoint : ogni quanti passi aggiornare i salvataggi
+    - campionamento : tupla (metodo, distribuzione, antitetico) con cui ciascun blocco genera le
+      condizioni iniziali mancanti (si veda condizioni_iniziali); None per il campionamento uniforme
+      di velocita_montecarlo e posizioni_montecarlo
+    - esecutore : ProcessPoolExecutor già avviato su cui eseguire i compiti, per riusarlo in più chiamate
+      successive (None per avviarne uno per la chiamata); è usato solo con processi maggiore di 1
+    -------------------------------------------
+    Restituisce:
+    - lista, una per configurazione, di tuple (tr, tempi, x_mediano, v_mediano) come deriva_flusso,
+      con i blocchi ricomposti nell'ordine originale delle particelle; con tolleranza le tuple sono
+      (tr, tempi, x_finale, v_finale, errore, passi_usati) come deriva_centro_guida
+    """
+    semi_gruppi = np.random.SeedSequence(seme).spawn(-(-N // PARTICELLE_SEME))
+    processi = max(1, min(processi, N))
+    blocchi = np.array_split(np.arange(N), processi)
+    semi, primi = [], []
+    for indici in blocchi: #gruppi che contengono il blocco e posizione del blocco al loro interno
+        primo_gruppo, ultimo_gruppo = indici[0] // PARTICELLE_SEME, indici[-1] // PARTICELLE_SEME
+        semi.append([(semi_gruppi[g], min(PARTICELLE_SEME, N - g * PARTICELLE_SEME))
+                     for g in range(primo_gruppo, ultimo_gruppo + 1)])
+        primi.append(int(indici[0] - primo_gruppo * PARTICELLE_SEME))
+    if checkpoint is not None:
+        os.makedirs(checkpoint, exist_ok=True)
+    compiti = []
+    for E0, B0, grad in configurazioni:
+        for indici, seme_blocco, primo in zip(blocchi, semi, primi):
+            x_blocco = None if x0 is None else np.reshape(x0, (N, 3))[indici]
+            v_blocco = None if v0 is None else np.reshape(v0, (N, 3))[indici]
+            salvataggio = None
+            if checkpoint is not None:
+                #il campionamento entra nell'impronta solo se indicato, per riprendere i salvataggi già esistenti
+                extra = () if campionamento is None else (campionamento,)
+                nome = impronta(E0, B0, grad, x_blocco, v_blocco, len(indici), seme_blocco, primo, particella, integratore,
+                                frazione, *extra)
+                salvataggio = os.path.join(checkpoint, f'blocco_{nome[:16]}.npz')
+            compiti.append((E0, B0, grad, x_blocco, v_blocco, len(indici), seme_blocco, primo, particella, passi, integratore,
+                            frazione, tolleranza, salvataggio, passi_checkpoint, campionamento))
+
+    if processi == 1:
+        parziali = [blocco_statistica(compito) for compito in compiti]
+    elif esecutore is not None:
+        parziali = list(esecutore.map(blocco_statistica, compiti))
+    else:
+        with ProcessPoolExecutor(max_workers=processi) as esecutore:
+            parziali = list(esecutore.map(blocco_statistica, compiti))
+
+    risultati = []
+    for c in range(len(configurazioni)):
+        parti = parziali[c * processi:(c + 1) * processi]
+        #traiettorie e tempi hanno le particelle sul secondo asse, gli altri risultati sul primo
+        risultati.append(tuple(np.concatenate([p[k] for p in parti], axis=1 if k < 2 else 0) for k in range(len(parti[0]))))
+
+    return risultati
+
+def aggiorna_momenti(n, media, M2, valori):
+    """
+    Aggiorna numero, media e somma dei quadrati degli scarti (M2) di un campione con un nuovo blocco
+    di valori, con la formula di Welford per blocchi (Chan et al.), senza conservare i valori precedenti.
+    -------------------------------------------
+    Parametri:
+    - n, media, M2 : statistiche correnti (0, 0.0, 0.0 all'inizio)
+    - valori : array dei nuovi valori
+    -------------------------------------------
+    Restituisce:
+    - n, media, M2 aggiornati; la varianza campionaria è M2 / (n - 1)
+    """
+    n_blocco = len(valori)
+    if n_blocco == 0:
+        return n, media, M2
+    media_blocco = np.mean(valori)
+    delta = media_blocco - media
+    n_totale = n + n_blocco
+    media = media + delta * n_blocco / n_totale
+    M2 = M2 + np.sum((valori - media_blocco)**2) + delta**2 * n * n_blocco / n_totale
+    return n_totale, media, M2
+
+def statistica_adattiva(E0, B0, grad, particella, passi, errore_relativo=None, scarto=None, blocco=50, N_massimo=10000,
+                        tempo_massimo=None, x0=None, processi=1, seme=None, integratore=None, frazione=0.0001,
+                        tolleranza=None, livello=0.95, campionamento=None):
+    """
+    Studio Monte Carlo sequenziale della velocità di drift: le particelle sono simulate a blocchi con
+    statistica_parallela e, dopo ogni blocco, media e varianza dei moduli delle velocità di drift (e
+    delle velocità teoriche di derive_particelle) sono aggiornate con aggiorna_momenti. Il campione si
+    ferma appena è raggiunto il criterio richiesto, così che le configurazioni poco rumorose usano poche
+    particelle e quelle rumorose quante ne servono, entro il limite N_massimo o tempo_massimo:
+    - errore_relativo : errore standard della stima relativo alla stima non superiore al valore indicato;
+    - scarto : intervallo di confidenza dello scarto relativo dalla velocità teorica tutto entro ±scarto
+      (accordo con la teoria) oppure tutto fuori (disaccordo risolto).
+    Entrambi i criteri usano lo stesso stimatore: la media con il suo errore standard in campo uniforme,
+    e in campo non uniforme, come in statistica_vdrift, la mediana con l'errore di intervallo_mediana,
+    che non risente delle code lunghe della distribuzione; lo scarto è allora fra le mediane simulata e
+    teorica.
+    Ogni blocco ha il seme [seme, indice del blocco], per cui i risultati sono riproducibili; con più
+    processi tutti i blocchi sono eseguiti sullo stesso gruppo di processi.
+    -------------------------------------------
+    Parametri:
+    - E0, B0, grad : campi e tipo di gradiente della configurazione
+    - particella : elemento della classe omonima
+    - passi : numero di iterazioni
+    - errore_relativo, scarto : criteri di arresto (almeno uno dei due)
+    - blocco : particelle per blocco (almeno 2)
+    - N_massimo : numero massimo di particelle
+    - tempo_massimo : tempo di calcolo massimo [s] (None per nessun limite)
+    - x0 : matrice delle posizioni iniziali con almeno N_massimo righe, usate in ordine; se None sono
+      generate casualmente
+    - processi, integratore, frazione, tolleranza : come per statistica_parallela
+    - livello : livello di confidenza del criterio scarto
+    - campionamento : tupla (metodo, distribuzione, antitetico) delle condizioni iniziali di ciascun
+      blocco, come per statistica_parallela; con metodi non indipendenti l'errore standard è una stima
+      per eccesso e il criterio di arresto è quindi conservativo
+    -------------------------------------------
+    Restituisce:
+    - tr, tempi, x_mediano, v_mediano come deriva_flusso, per tutte le particelle simulate
+    - dizionario con 'N', 'blocchi', 'media', 'errore_standard', 'stimatore' ('media' o, in campo non
+      uniforme, 'mediana'), 'stima' ed 'errore_stima' (media ed errore standard oppure mediana ed errore di
+      intervallo_mediana), 'errore_relativo' (della stima), 'teorica' (mediana delle velocità teoriche in
+      campo non uniforme), 'scarto_relativo' (dalla stima), 'tempo' [s] e 'arresto' ('errore', 'scarto',
+      'particelle' o 'tempo')
+    """
+    if errore_relativo is None and scarto is None:
+        raise ValueError("Indicare almeno un criterio di arresto fra errore_relativo e scarto.")
+    blocco = max(2, int(blocco))
+    if seme is None:
+        seme = np.random.SeedSequence().entropy
+    from statistics import NormalDist
+    z = NormalDist().inv_cdf(0.5 + livello / 2)
+    inizio = time.perf_counter()
+    mediane = not isinstance(modello_campo(E0, B0, grad), CampoUniforme) #confronto robusto (statistica_vdrift)
+    parti, velocita_tutte, teoriche_tutte = [], [], []
+    n, media, M2 = 0, 0.0, 0.0
+    arresto = 'particelle'
+    #un solo gruppo di processi per tutti i blocchi, per non avviarlo a ogni blocco
+    esecutore = ProcessPoolExecutor(max_workers=min(processi, blocco)) if processi > 1 else None
+    try:
+        while n < N_massimo:
+            k = len(parti)
+            n_blocco = min(blocco, N_massimo - n)
+            x_blocco = None if x0 is None else np.reshape(x0, (-1, 3))[n:n + n_blocco]
+            risultato = statistica_parallela([(E0, B0, grad)], particella, n_blocco, passi, x0=x_blocco, processi=processi,
+                                             seme=[seme, k], integratore=integratore, frazione=frazione,
+                                             tolleranza=tolleranza, campionamento=campionamento,
+                                             esecutore=esecutore)[0][:4]
+            parti.append(risultato)
+            velocita = np.linalg.norm(vel_drift(risultato[0], risultato[1]), axis=1)
+            teoriche_tutte.append(np.linalg.norm(sum(derive_particelle(risultato[2], risultato[3], particella, grad, E0, B0)), axis=1))
+            velocita_tutte.append(velocita)
+            n, media, M2 = aggiorna_momenti(n, media, M2, velocita)
+            errore = np.sqrt(M2 / (n - 1) / n) if n > 1 else np.inf
+            if mediane:
+                teorica = np.median(np.concatenate(teoriche_tutte))
+                simulata, errore_confronto, _ = intervallo_mediana(np.concatenate(velocita_tutte), livello)
+            else:
+                teorica = np.mean(np.concatenate(teoriche_tutte))
+                simulata, errore_confronto = media, errore
+            if len(parti) >= 2: #almeno due blocchi prima di valutare l'errore
+                if errore_relativo is not None and errore_confronto <= errore_relativo * abs(simulata):
+                    arresto = 'errore'
+                    break
+                if scarto is not None and teorica != 0:
+                    basso = (simulata - z * errore_confronto - teorica) / teorica
+                    alto = (simulata + z * errore_confronto - teorica) / teorica
+                    if (-scarto <= basso and alto <= scarto) or alto < -scarto or basso > scarto:
+                        arresto = 'scarto'
+                        break
+            if tempo_massimo is not None and time.perf_counter() - inizio >= tempo_massimo:
+                arresto = 'tempo'
+                break
+    finally:
+        if esecutore is not None:
+            esecutore.shutdown()
+
+    #traiettorie e tempi hanno le particelle sul secondo asse, gli stati mediani sul primo
+    tr, tempi, x_mediano, v_mediano = (np.concatenate([p[i] for p in parti], axis=1 if i < 2 else 0) for i in range(4))
+    informazioni = {
+        'N': n,
+        'blocchi': len(parti),
+        'media': media,
+        'errore_standard': errore,
+        'stimatore': 'mediana' if mediane else 'media',
+        'stima': simulata,
+        'errore_stima': errore_confronto,
+        'errore_relativo': errore_confronto / abs(simulata) if simulata != 0 else np.nan,
+        'teorica': teorica,
+        'scarto_relativo': (simulata - teorica) / teorica if teorica != 0 else np.nan,
+        'tempo': time.perf_counter() - inizio,
+        'arresto': arresto
+    }
+    return tr, tempi, x_mediano, v_mediano, informazioni
+
+#Scansione di parametri di campo e di specie
+
+assi_scansione = ('Ex', 'Ey', 'Ez', 'E', 'B', 'pendenza', 'particella') #parametri ammessi nella griglia
+
+def scansione_parametri(griglia, N, passi, particella, E0=(0, 0, 0), B0=(0, 0, 0.0001), grad='0', seme=None,
+                        integratore=None, frazione=0.0001):
+    """
+    Calcola la velocità di drift simulata e quella teorica su tutti i punti di una griglia di parametri
+    con una sola simulazione a memoria costante: ciascun punto riceve N particelle con le stesse
+    condizioni iniziali e le particelle di tutti i punti avanzano insieme come un unico insieme, con
+    campi, massa e carica diversi da particella a particella. La griglia è il prodotto cartesiano dei
+    valori indicati per ciascun asse; i parametri non indicati hanno i valori di E0, B0, grad e particella.
+    In campo uniforme l'integratore automatico è la soluzione esatta, per cui il costo non dipende dai passi.
+    La velocità teorica di ogni particella è quella di derive_particelle, dallo stato al passo mediano;
+    con la legge lineare, che attraversa B = 0, i punti sono riassunti dalle mediane invece che dalle
+    medie, come in statistica_vdrift.
+    -------------------------------------------
+    Parametri:
+    - griglia : dizionario {asse: lista di valori}, con assi fra 'Ex', 'Ey', 'Ez' (componenti di E [V/m]),
+      'E' (vettori [V/m]), 'B' (in campo uniforme vettori oppure moduli di Bz, per le leggi lineari Bz
+      in x = 0 [T]), 'pendenza' (dBz/dx [T/m] della legge lineare) e 'particella' (sigle o elementi
+      della classe Particella)
+    - N : numero di particelle per punto della griglia
+    - passi : numero di iterazioni
+    - particella : elemento della classe omonima (se non è un asse della griglia)
+    - E0 : campo elettrico [V/m]
+    - B0 : campo magnetico uniforme [T] (con grad '0')
+    - grad : '0' per il campo uniforme oppure una delle leggi lineari predefinite; con l'asse
+      'pendenza' il campo è sempre lineare
+    - seme : seme delle condizioni iniziali
+    - integratore, frazione : come per avanzamento
+    -------------------------------------------
+    Restituisce:
+    - dizionario con 'assi' (lista di coppie (asse, valori)) e, come array con una dimensione per asse,
+      'simulata' (media dei moduli delle velocità di drift), 'errore_standard', 'teorica' (media dei
+      moduli delle velocità teoriche), 'scarto_relativo', oltre a 'vettori' e 'vettori_teorici' (velocità
+      medie, con un'ultima dimensione di 3 componenti) e 'N'; con la legge lineare medie ed errori
+      standard sono sostituiti da mediane ed errori di intervallo_mediana
+    """
+    for asse in griglia:
+        if asse not in assi_scansione:
+            raise ValueError(f"Asse non valido: {asse}. Inserire uno fra {', '.join(assi_scansione)}.")
+    assi = [(asse, list(valori)) for asse, valori in griglia.items()]
+    forma = tuple(len(valori) for _, valori in assi)
+    punti = np.indices(forma).reshape(len(forma), -1) #indici di ciascun punto lungo ogni asse
+    G = punti.shape[1]
+    valori = {asse: [lista[i] for i in indici] for (asse, lista), indici in zip(assi, punti)}
+
+    lineare = grad != '0' or 'pendenza' in griglia
+    if lineare:
+        if grad in coefficienti_gradiente:
+            B_base, pendenza_base = coefficienti_gradiente[grad]
+        elif grad == '0':
+            B_base, pendenza_base = np.asarray(B0, dtype=float)[2], 0.0
+        else:
+            raise ValueError("La scansione supporta il campo uniforme e le leggi lineari predefinite.")
+    E = np.tile(np.asarray(E0, dtype=float), (G, 1))
+    if 'E' in valori:
+        E = np.array(valori['E'], dtype=float)
+    for c, asse in enumerate(('Ex', 'Ey', 'Ez')):
+        if asse in valori:
+            E[:, c] = valori[asse]
+    if lineare:
+        B = np.array(valori.get('B', [B_base] * G), dtype=float)
+        pendenza = np.array(valori.get('pendenza', [pendenza_base] * G), dtype=float)
+    else:
+        B = np.array([[0, 0, b] if np.ndim(b) == 0 else b for b in valori.get('B', [B0] * G)], dtype=float)
+    specie = [particella_da_sigla(p) if isinstance(p, str) else p for p in valori.get('particella', [particella] * G)]
+
+    #ogni punto ripetuto per le sue N particelle
+    rng = np.random.default_rng(seme)
+    v0 = np.tile(velocita_montecarlo(N, rng), (G, 1))
+    x0 = np.tile(posizioni_montecarlo(N, rng), (G, 1))
+    insieme = insieme_particelle([specie[g] for g in np.repeat(np.arange(G), N)])
+    E, B = np.repeat(E, N, axis=0), np.repeat(B, N, axis=0)
+    campo = CampoLineare(B, np.repeat(pendenza, N), E) if lineare else CampoUniforme(B, E)
+
+    tr, tempi, x_mediano, v_mediano = deriva_flusso(E, B, x0, v0, insieme, passi, G * N, campo, integratore, frazione)
+    vettori = np.reshape(vel_drift(np.reshape(tr, (2, G * N, 3)), np.reshape(tempi, (2, G * N))), (G, N, 3))
+    teoriche = np.reshape(sum(derive_particelle(x_mediano, v_mediano, insieme, campo)), (G, N, 3))
+    velocita = np.linalg.norm(vettori, axis=2)
+    if lineare: #statistiche robuste rispetto alle particelle vicine a B = 0
+        simulata, errore = np.array([intervallo_mediana(valori)[:2] for valori in velocita]).T
+        teorica = np.median(np.linalg.norm(teoriche, axis=2), axis=1)
+        vettori, teoriche = np.median(vettori, axis=1), np.median(teoriche, axis=1)
+    else:
+        simulata = np.mean(velocita, axis=1)
+        teorica = np.mean(np.linalg.norm(teoriche, axis=2), axis=1)
+        errore = np.std(velocita, axis=1) / np.sqrt(N - 1) if N > 1 else np.full(G, np.nan)
+        vettori, teoriche = np.mean(vettori, axis=1), np.mean(teoriche, axis=1)
+
+    return {
+        'assi': assi,
+        'N': N,
+        'simulata': simulata.reshape(forma),
+        'errore_standard': errore.reshape(forma),
+        'teorica': teorica.reshape(forma),
+        'scarto_relativo': ((simulata - teorica) / teorica).reshape(forma),
+        'vettori': vettori.reshape(forma + (3,)),
+        'vettori_teorici': teoriche.reshape(forma + (3,))
+    }
+
+@cronometrato('mappa_vdrift')
+def mappa_vdrift(scansione, salva=None):
+    """
+    Rappresenta il risultato di scansione_parametri: con un asse la velocità di drift simulata (con
+    l'errore standard) e quella teorica in funzione del parametro, con due assi le mappe della velocità
+    simulata e dello scarto relativo da quella teorica.
+    -------------------------------------------
+    Parametri:
+    - scansione : dizionario restituito da scansione_parametri
+    - salva : se diverso da None, percorso del file in cui salvare la figura invece di mostrarla
+    """
+    import matplotlib.pyplot as plt
+    assi = scansione['assi']
+    if len(assi) not in (1, 2):
+        raise ValueError("La mappa si può rappresentare solo per scansioni su uno o due assi.")
+
+    def coordinate(valori):
+        #valori numerici sull'asse, altrimenti posizioni con le etichette dei valori
+        if all(np.ndim(valore) == 0 and not isinstance(valore, (str, Particella)) for valore in valori):
+            return np.array(valori, dtype=float), None
+        return np.arange(len(valori)), [getattr(valore, 'singolare', str(valore)) for valore in valori]
+
+    if len(assi) == 1:
+        nome, valori = assi[0]
+        x, etichette = coordinate(valori)
+        fig = plt.figure(figsize=(9, 6))
+        plt.errorbar(x, scansione['simulata'], yerr=scansione['errore_standard'], fmt='o', color='royalblue',
+                     label=f"Simulata ({scansione['N']} particelle per punto)")
+        plt.plot(x, scansione['teorica'], '-', color='green', label='Teorica')
+        if etichette is not None:
+            plt.xticks(x, etichette)
+        plt.xlabel(nome)
+        plt.ylabel('Velocità di deriva (m/s)')
+        plt.title('Velocità di deriva in funzione del parametro')
+        plt.legend()
+        plt.grid(True, linestyle='--', alpha=0.7)
+    else:
+        (nome_x, valori_x), (nome_y, valori_y) = assi
+        x, etichette_x = coordinate(valori_x)
+        y, etichette_y = coordinate(valori_y)
+        fig, (sinistra, destra) = plt.subplots(1, 2, figsize=(14, 6))
+        for grafico, dati, titolo, mappa_colori in ((sinistra, scansione['simulata'], 'Velocità di deriva simulata (m/s)', 'viridis'),
+                                                    (destra, scansione['scarto_relativo'], 'Scarto relativo dalla velocità teorica', 'coolwarm')):
+            limite = np.nanmax(np.abs(dati)) if mappa_colori == 'coolwarm' else None
+            immagine = grafico.pcolormesh(x, y, dati.T, shading='nearest', cmap=mappa_colori,
+                                          vmin=-limite if limite else None, vmax=limite)
+            fig.colorbar(immagine, ax=grafico)
+            grafico.set_title(titolo)
+            grafico.set_xlabel(nome_x)
+            grafico.set_ylabel(nome_y)
+            if etichette_x is not None:
+                grafico.set_xticks(x, etichette_x)
+            if etichette_y is not None:
+                grafico.set_yticks(y, etichette_y)
+    mostra_o_salva(fig, salva)
+
 #Funzioni di statistica delle velocità di drift
 
+@cronometrato('vel_drift')
 def vel_drift (tr, dt):
     """
     Identifica la velocità netta di drift come differenza fra i vettori posizione
@@ -462,26 +2582,125 @@ def vel_drift (tr, dt):
     -------------------------------------------
     Parametri:
     - tr : matrice dei vettori posizione (traiettoria)
-    - dt : matrice degli intervalli temporali
+    - dt : matrice degli intervalli temporali, oppure array se comuni a tutte le particelle
     -------------------------------------------
     Resistuisce:
     - v : vettore velocità di drift
     """
-    if len(dt.shape) == 1: #caso di singola particella con dt array
-        delta_t = np.sum(dt)
+    if len(dt.shape) == 1: #caso di singola particella, o di dt comune a tutte le particelle (dt_globale)
+        delta_t = np.sum(dt, dtype=float) #somma in doppia precisione anche per tempi in float32
         delta_x = tr[-1]-tr[0]
         v = delta_x/delta_t
 
     else: #caso di N particelle con dt matrice
-        delta_t = np.sum(dt, axis=0)  
+        delta_t = np.sum(dt, axis=0, dtype=float)
         delta_x = tr[-1] - tr[0]  
         v = delta_x / delta_t[:, None]
 
     return v
 
+def intervallo_mediana(valori, livello=0.95):
+    """
+    Mediana di un campione con il suo intervallo di confidenza non parametrico, dato dalle statistiche
+    d'ordine di posto N/2 ± z sqrt(N)/2 (approssimazione gaussiana della binomiale): a differenza
+    dell'errore standard della media non dipende dalle code della distribuzione.
+    -------------------------------------------
+    Parametri:
+    - valori : array dei valori
+    - livello : livello di confidenza dell'intervallo
+    -------------------------------------------
+    Restituisce:
+    - mediana, errore (semiampiezza dell'intervallo divisa per z, confrontabile con un errore standard)
+      e intervallo (basso, alto)
+    """
+    ordinati = np.sort(np.ravel(valori))
+    N = len(ordinati)
+    mediana = np.median(ordinati)
+    from statistics import NormalDist
+    z = NormalDist().inv_cdf(0.5 + livello / 2)
+    if N < 2:
+        return mediana, np.nan, (np.nan, np.nan)
+    semiampiezza = z * np.sqrt(N) / 2
+    basso = ordinati[max(0, int(np.floor(N / 2 - semiampiezza)))]
+    alto = ordinati[min(N - 1, int(np.ceil(N / 2 + semiampiezza)) - 1)]
+
+    return mediana, (alto - basso) / (2 * z), (basso, alto)
+
+@cronometrato('statistica_vdrift')
+def statistica_vdrift (tr, dt, vel_teo=None, livello=0.95):
+    """
+    Statistica delle velocità di drift di tutte le particelle, calcolata in forma vettoriale a partire
+    da vel_drift: media dei vettori e dei moduli, deviazione standard, errore standard della media,
+    intervallo di confidenza gaussiano e, se è data la velocità teorica, lo scarto da questa.
+    Le velocità teoriche delle singole particelle contengono il fattore 1/|B|^2 e con le leggi che
+    attraversano B = 0 poche particelle vicine allo zero ne dominerebbero la media: in questo caso il
+    confronto è fra la mediana simulata e la mediana teorica, con l'intervallo di intervallo_mediana.
+    -------------------------------------------
+    Parametri:
+    - tr : array delle traiettorie (anche solo posizioni iniziali e finali)
+    - dt : intervalli temporali restituiti con le traiettorie
+    - vel_teo : array velocità teorica [m/s], oppure matrice Nx3 delle velocità teoriche delle singole
+      particelle (facoltativo)
+    - livello : livello di confidenza dell'intervallo (default 0.95)
+    -------------------------------------------
+    Restituisce:
+    - dizionario con le velocità di drift ('vettori', Nx3, e 'velocita', moduli) e le grandezze statistiche
+      dei moduli: 'media', 'deviazione_standard', 'errore_standard', 'intervallo', oltre a 'media_vettore';
+      con vel_teo anche 'teorica' (modulo), 'scarto', 'scarto_relativo', 'scarto_sigma' (in unità di errore
+      standard) e 'scarto_vettore' (modulo della differenza fra media dei vettori e velocità teorica);
+      con velocità teoriche per particella 'teorica' è la mediana dei loro moduli, gli scarti sono calcolati
+      dalla mediana simulata ('mediana', con 'errore_mediana') e sono aggiunti 'teorica_media' (media dei
+      moduli teorici, non robusta), 'scarto_particelle' (scarti relativi delle singole particelle, in
+      modulo) e 'scarto_mediano'; 'confronto' indica quale grandezza ('media' o 'mediana') è confrontata
+    """
+    vettori = np.atleast_2d(vel_drift(tr, dt))
+    velocita = np.linalg.norm(vettori, axis=1)
+    N = len(velocita)
+    media = np.mean(velocita)
+    sigma = np.std(velocita)
+    errore = sigma / np.sqrt(N - 1) if N > 1 else np.nan #equivalente alla deviazione campionaria diviso sqrt(N)
+    from statistics import NormalDist
+    z = NormalDist().inv_cdf(0.5 + livello / 2) #quantile gaussiano, senza importare scipy
+    statistica = {
+        'vettori': vettori,
+        'velocita': velocita,
+        'N': N,
+        'media_vettore': np.mean(vettori, axis=0),
+        'media': media,
+        'deviazione_standard': sigma,
+        'errore_standard': errore,
+        'livello': livello,
+        'intervallo': (media - z * errore, media + z * errore)
+    }
+    if vel_teo is not None:
+        vel_teo = np.asarray(vel_teo)
+        simulata, errore_confronto, vettore = media, errore, statistica['media_vettore']
+        statistica['confronto'] = 'media'
+        if vel_teo.ndim == 2: #una velocità teorica per particella
+            teoriche = np.linalg.norm(vel_teo, axis=1)
+            statistica['scarto_particelle'] = np.linalg.norm(vettori - vel_teo, axis=1) / teoriche
+            statistica['scarto_mediano'] = np.median(statistica['scarto_particelle'])
+            statistica['teorica_media'] = np.mean(teoriche)
+            statistica['mediana'], statistica['errore_mediana'], _ = intervallo_mediana(velocita, livello)
+            simulata, errore_confronto = statistica['mediana'], statistica['errore_mediana']
+            vettore = np.median(vettori, axis=0)
+            statistica['confronto'] = 'mediana'
+            vel_teo = np.median(vel_teo, axis=0)
+            teorica = np.median(teoriche)
+        else:
+            teorica = np.linalg.norm(vel_teo)
+        statistica['teorica'] = teorica
+        statistica['scarto'] = simulata - teorica
+        statistica['scarto_relativo'] = (simulata - teorica) / teorica if teorica != 0 else np.nan
+        statistica['scarto_sigma'] = (simulata - teorica) / errore_confronto if errore_confronto > 0 else np.nan
+        statistica['scarto_vettore'] = np.linalg.norm(vettore - np.asarray(vel_teo))
+
+    return statistica
+
 # Grafico di distribuzione delle velocità
 
-def istogramma_vdrift(tr, dt, E, B, vel_teo, particella):
+@cronometrato('istogramma_vdrift')
+def istogramma_vdrift(tr, dt, E, B, vel_teo, particella, salva=None):
     """
     Rappresenta un istogramma che mostra la distribuzione delle velocità di drift tenendo conto della loro
     media e deviazione standard.
@@ -489,26 +2708,35 @@ def istogramma_vdrift(tr, dt, E, B, vel_teo, particella):
     Parametri:
     - tr : array delle traiettorie restituite dalla simulazione con N particelle
     - dt : passo temporale della simulazione
-    - E : char che identifica un tipo di campo elettrico per il sottotitolo
-    - B : char che identifica un tipo di campo magnetico per il sottotitolo
+    - E : char che identifica un tipo di campo elettrico per il sottotitolo (o descrizione libera)
+    - B : char che identifica un tipo di campo magnetico per il sottotitolo (o descrizione libera)
     - vel_teo : array velocità teorica [m/s]
     - particella : elemento della classe omonima
+    - salva : se diverso da None, percorso del file in cui salvare la figura invece di mostrarla
+    -------------------------------------------
+    Restituisce:
+    - dizionario della statistica delle velocità (si veda statistica_vdrift)
     """
-    plt.figure(figsize=(10, 6))
-    vel = vel_drift(tr, dt)
-    velocita = []
-    for vj in vel:
-        velocita = np.append(velocita, np.linalg.norm(vj))
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(10, 6))
+    statistica = statistica_vdrift(tr, dt, vel_teo)
+    velocita = statistica['velocita']
     n, bins, p = plt.hist(velocita, bins='auto', density=True, alpha=0.6, color='royalblue')
-    mu = np.mean(velocita)
+    mu = statistica['media']
     plt.axvline(mu, color='red', linewidth=2, label=f'Velocità media: {mu:.2e} m/s')
-    sigma = np.std(velocita)
+    sigma = statistica['deviazione_standard']
     x_vals = np.linspace(min(bins), max(bins), 300)
-    plt.plot(x_vals, norm.pdf(x_vals, mu, sigma), 'r-', lw=2, label='Distribuzione gaussiana')
+    gaussiana = np.exp(-(x_vals - mu)**2 / (2 * sigma**2)) / (sigma * np.sqrt(2 * np.pi))
+    plt.plot(x_vals, gaussiana, 'r-', lw=2, label='Distribuzione gaussiana')
 
     #Confronto grafico con la velocità teorica
-    teorica = np.linalg.norm(vel_teo)
-    plt.axvline(teorica, color='green', linewidth=2, label=f'Velocità teorica: {teorica:.2e} m/s')
+    teorica = statistica['teorica']
+    if statistica.get('confronto') == 'mediana': #velocità teoriche per particella: confronto fra mediane
+        mediana = statistica['mediana']
+        plt.axvline(mediana, color='orange', linestyle='--', linewidth=2, label=f'Velocità mediana: {mediana:.2e} m/s')
+        plt.axvline(teorica, color='green', linewidth=2, label=f'Velocità teorica mediana: {teorica:.2e} m/s')
+    else:
+        plt.axvline(teorica, color='green', linewidth=2, label=f'Velocità teorica: {teorica:.2e} m/s')
     
     descrizioni_E = {
         "1": "E = (1; 1; 0) × 10⁻² V/m",
@@ -522,63 +2750,217 @@ def istogramma_vdrift(tr, dt, E, B, vel_teo, particella):
         "32": "B (x) = 10⁻² + 2 × 10⁻² x (T)",
         "33": "B (x) = - 5 × 10⁻⁴ - 8 × 10⁻⁴ x (T)"
     }
-    sottotitolo = f"{descrizioni_E[E]}; {descrizioni_B[B]}"
+    sottotitolo = f"{descrizioni_E.get(E, E)}; {descrizioni_B.get(B, B)}"
     plt.suptitle(sottotitolo, fontsize=12, color="gray")
 
-    N = dt.shape[1]
-    plt.xlabel(f'Velocità di deriva (m/s) di {N} {particella.plurale}')
+    plt.xlabel(f'Velocità di deriva (m/s) di {statistica["N"]} {particella.plurale}')
     plt.ylabel('Densità di probabilità')
     plt.title('Distribuzione della velocità di deriva')
     plt.legend()
     plt.grid(True, linestyle='--', alpha=0.7)
-    plt.show()
+    mostra_o_salva(fig, salva)
+
+    return statistica
 
 # Velocità di deriva teoriche
 
+@cronometrato('teorica_exb')
 def teorica_exb(E0, B0):
     """
     Calcola la velocità del drift E x B.
     -------------------------------------------
     Parametri:
-    - E0 : array campo elettrico [V/m]
-    - B0 : array campo magnetico [T]
+    - E0 : array campo elettrico [V/m] (oppure matrice Nx3, un vettore per particella)
+    - B0 : array campo magnetico [T] (oppure matrice Nx3)
     """
-    intB = np.linalg.norm(B0) ** 2
+    intB = np.linalg.norm(B0, axis=-1, keepdims=True) ** 2
     velteorica = np.cross(E0, B0) / intB
     return velteorica
 
-def teorica_grad (tr, particella, grad):
+#Confronto fra integratori
+
+def confronto_integratori(E0, B0, x0, v0, particella, periodi=6, frazioni=(0.0001, 0.001, 0.01)):
     """
-    Calcola la velocità del drift di gradiente magnetico ortogonale.
+    Confronta gli integratori disponibili in campi E, B uniformi simulando le stesse particelle per
+    un numero intero di periodi di Larmor con diverse frazioni del periodo come dt.
+    La deriva energetica è la variazione relativa media dell'energia cinetica nel sistema che si muove
+    con la velocità di drift (in cui il moto è una pura rotazione e l'energia si conserva); l'errore
+    sulla deriva è lo scarto medio fra la velocità di vel_drift e quella di teorica_exb, relativo a quest'ultima.
+    -------------------------------------------
+    Parametri:
+    - E0 : array campo elettrico [V/m] (diverso da 0)
+    - B0 : array campo magnetico uniforme [T]
+    - x0, v0 : matrici Nx3 di posizioni e velocità iniziali
+    - particella : elemento della classe omonima
+    - periodi : numero di periodi di Larmor simulati
+    - frazioni : frazioni del periodo di Larmor da provare come dt
+    -------------------------------------------
+    Restituisce:
+    - lista di tuple (integratore, frazione, passi, deriva energetica, errore relativo sulla deriva)
+    """
+    teorica = np.asarray(teorica_exb(E0, B0))
+    risultati = []
+    for nome in integratori:
+        for frazione in frazioni:
+            passi = int(round(periodi / frazione)) + 1
+            tempo = np.zeros(np.shape(x0)[0])
+            for j, x, v, dt in passi_avanzamento(E0, B0, x0, v0, particella, passi, "0", nome, frazione):
+                if j == 0:
+                    x_iniziale, v_iniziale = x, v
+                tempo += dt
+            vel = (x - x_iniziale) / tempo[:, None]
+            w_iniziale, w_finale = v_iniziale - teorica, v - teorica #velocità nel sistema del drift
+            energia = np.mean(np.abs(np.sum(w_finale**2, axis=1) / np.sum(w_iniziale**2, axis=1) - 1))
+            errore = np.mean(np.linalg.norm(vel - teorica, axis=1)) / np.linalg.norm(teorica)
+            risultati.append((nome, frazione, passi, energia, errore))
+
+    return risultati
+
+def confronto_precisione(E0, B0, x0, v0, particella, passi, integratore='eulero', frazione=0.0001):
+    """
+    Misura la perdita di accuratezza della modalità compatta di avanzamento (float32, tempi comuni)
+    rispetto alla doppia precisione in campi E, B uniformi, simulando le stesse particelle nei due modi:
+    per entrambi riporta lo scarto relativo della velocità di drift media da quella di teorica_exb,
+    insieme alla massima differenza relativa fra le velocità di drift delle singole particelle, alla
+    memoria occupata da traiettorie e tempi e al tempo di esecuzione.
+    -------------------------------------------
+    Parametri:
+    - E0 : array campo elettrico [V/m] (diverso da 0)
+    - B0 : array campo magnetico uniforme [T]
+    - x0, v0 : matrici Nx3 di posizioni e velocità iniziali
+    - particella : elemento della classe omonima
+    - passi : numero di iterazioni
+    - integratore, frazione : come per avanzamento
+    -------------------------------------------
+    Restituisce:
+    - dizionario con 'scarto_doppia' e 'scarto_singola' (scarti relativi dalla velocità teorica),
+      'differenza_relativa', 'memoria_doppia' e 'memoria_singola' [byte], 'tempo_doppia' e 'tempo_singola' [s]
+    """
+    teorica = teorica_exb(E0, B0)
+    N = np.shape(x0)[0]
+    risultato, vettori = {}, {}
+    for nome, compatto in (('doppia', False), ('singola', True)):
+        inizio = time.perf_counter()
+        tr, tempi = avanzamento(E0, B0, x0, v0, particella, passi, N, '0', integratore=integratore, frazione=frazione,
+                                compatto=compatto)
+        risultato['tempo_' + nome] = time.perf_counter() - inizio
+        statistica = statistica_vdrift(tr, tempi, teorica)
+        vettori[nome] = statistica['vettori']
+        risultato['scarto_' + nome] = statistica['scarto_relativo']
+        risultato['memoria_' + nome] = tr.nbytes + tempi.nbytes
+    risultato['differenza_relativa'] = np.max(np.linalg.norm(vettori['singola'] - vettori['doppia'], axis=1) /
+                                              np.linalg.norm(vettori['doppia'], axis=1))
+
+    return risultato
+
+def stato_mediano (tr, particella, grad, frazione=0.0001):
+    """
+    Ricostruisce posizioni e velocità al passo mediano di una traiettoria completa, con la velocità
+    stimata come differenza finita fra il passo mediano e il precedente.
     -------------------------------------------
     Parametri:
     - tr : array traiettoria
     - particella : elemento della classe omonima
-    - grad : char che identifica il tipo di gradiente
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - frazione : frazione del periodo di Larmor usata come dt nella simulazione
     """
     posizione_mediana = tr.shape[0] // 2  #indice del valore centrale della traiettoria
-    x_media = tr[posizione_mediana, :, 0]  
-    x_precedente = tr[posizione_mediana - 1, :, 0]  
-    B_mediano = np.array([gradiente(grad, xi)[2] for xi in x_media])
-    dt = np.array([0.0001*periodo_larmor(particella, [0, 0, Bi]) for Bi in B_mediano])
-    v_mediana_x = (x_media - x_precedente) / dt 
-    v_mediana_y = (tr[posizione_mediana, :, 1] - tr[posizione_mediana - 1, :, 1]) / dt
+    x_media = tr[posizione_mediana]
+    x_precedente = tr[posizione_mediana - 1]
+    B_mediano = modello_campo([0, 0, 0], [0, 0, 0], grad).B(x_media)
+    dt = frazione * periodo_larmor(particella, B_mediano)
+    v_media = (x_media - x_precedente) / dt[:, None]
 
-    #Derivate prime che compaiono nella formula della velocità
-    if grad == "1":
-        k = 0.00005 
-    elif grad == "2":
-        k = 0.02
-    elif grad == "3":
-        k = -0.0008
+    return x_media, v_media
 
-    v_ortogonale_media = np.mean(np.sqrt(v_mediana_x**2 + v_mediana_y**2)) 
+def teorica_grad (tr, particella, grad, frazione=0.0001):
+    """
+    Calcola la velocità del drift di gradiente magnetico ortogonale.
+    -------------------------------------------
+    Parametri:
+    - tr : array traiettoria
+    - particella : elemento della classe omonima
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - frazione : frazione del periodo di Larmor usata come dt nella simulazione
+    """
+    x_media, v_media = stato_mediano(tr, particella, grad, frazione)
+    return teorica_grad_stato(x_media, v_media, particella, grad)
+
+@cronometrato('teorica_grad_stato')
+def teorica_grad_stato (x, v, particella, grad, per_particella=False):
+    """
+    Calcola la velocità del drift di gradiente magnetico ortogonale a partire dallo stato
+    (posizioni e velocità) delle particelle in un istante, senza bisogno della traiettoria.
+    -------------------------------------------
+    Parametri:
+    - x : matrice Nx3 delle posizioni [m]
+    - v : matrice Nx3 delle velocità [m/s]
+    - particella : elemento della classe omonima
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - per_particella : se True restituisce invece la matrice Nx3 delle velocità delle singole
+      particelle, ciascuna con la propria velocità ortogonale (si veda derive_particelle)
+    """
+    if per_particella:
+        return derive_particelle(x, v, particella, grad)[1]
+    campo = modello_campo([0, 0, 0], [0, 0, 0], grad)
+    B_mediano = campo.B(x)
+    intB = np.linalg.norm(B_mediano, axis=1)
+    gradB = campo.gradiente_modulo(x) #gradiente analitico del modulo di B
 
-    y = (particella.m * v_ortogonale_media ** 2) / (2 * particella.q * B_mediano ** 2)  
+    b = B_mediano / intB[:, None] #direzione del campo
+    v_ortogonale = np.sqrt(np.sum(v**2, axis=1) - np.sum(v * b, axis=1)**2)
+    v_ortogonale_media = np.mean(v_ortogonale) 
+
+    return np.mean(deriva_gradiente(B_mediano, gradB, v_ortogonale_media ** 2, particella), axis=0)
+
+def deriva_gradiente (B, gradB, v_ortogonale_quadro, particella):
+    """
+    Velocità del drift di gradiente di ciascuna particella: m v_ort^2 / (2 q |B|^3) (B x grad|B|).
+    -------------------------------------------
+    Parametri:
+    - B : matrice Nx3 del campo magnetico [T]
+    - gradB : matrice Nx3 del gradiente del modulo di B [T/m]
+    - v_ortogonale_quadro : quadrato della velocità ortogonale a B (scalare o array di N valori) [m^2/s^2]
+    - particella : elemento della classe omonima
+    """
+    intB = np.linalg.norm(B, axis=1)
+    y = (particella.m * v_ortogonale_quadro) / (2 * particella.q * intB ** 3)
 
-    return [0, np.mean(y * k), 0]
+    return y[:, None] * np.cross(B, gradB)
 
-def teorica_both (tr, particella, grad, E0):
+def derive_particelle (x, v, particella, grad, E0=(0, 0, 0), B0=(0, 0, 0)):
+    """
+    Velocità di deriva teoriche E x B e di gradiente di ogni particella, calcolate insieme per tutte
+    le particelle dallo stato in un istante qualsiasi (le condizioni iniziali o lo stato al passo
+    mediano di deriva_flusso), senza la traiettoria. Lo stato è portato nelle variabili del centro
+    guida (centro_guida_iniziale): i campi sono valutati nel centro guida invece che nella posizione
+    istantanea, e la velocità ortogonale di ciascuna particella è quella nel sistema del drift E x B,
+    ricavata dal momento magnetico. Le velocità contengono il fattore 1/|B|^2 e divergono per le
+    particelle vicine a B = 0, per cui dell'insieme va usata una statistica robusta come la mediana.
+    -------------------------------------------
+    Parametri:
+    - x : matrice Nx3 delle posizioni [m]
+    - v : matrice Nx3 delle velocità [m/s]
+    - particella : elemento della classe omonima
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - E0 : array campo elettrico [V/m]
+    - B0 : campo magnetico uniforme [T] (usato solo se grad è '0')
+    -------------------------------------------
+    Restituisce:
+    - v_exb, v_grad : matrici Nx3 delle velocità di deriva E x B e di gradiente [m/s]
+    """
+    campo = modello_campo(E0, B0, grad)
+    x = np.reshape(np.asarray(x, dtype=float), (-1, 3))
+    v = np.reshape(np.asarray(v, dtype=float), (-1, 3))
+    R, _, mu = centro_guida_iniziale(x, v, campo, particella)
+    B = campo.B(R)
+    v_ortogonale_quadro = 2 * mu * np.linalg.norm(B, axis=1) / particella.m #mu conservato
+    v_exb = teorica_exb(campo.E(R), B)
+    v_grad = deriva_gradiente(B, campo.gradiente_modulo(R), v_ortogonale_quadro, particella)
+
+    return v_exb, v_grad
+
+def teorica_both (tr, particella, grad, E0, frazione=0.0001):
     """
     Calcola la velocità del drift generale dove è presente sia campo elettrico uniforme
     che una legge di dipendenza spaziale ortogonale del campo magnetico. In particolare la
@@ -587,17 +2969,34 @@ def teorica_both (tr, particella, grad, E0):
     Parametri:
     - tr : array traiettoria
     - particella : elemento della classe omonima
-    - grad : char che identifica il tipo di gradiente
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
     - E0 : array campo elettrico [V/m]
+    - frazione : frazione del periodo di Larmor usata come dt nella simulazione
     """
+    x_media, v_media = stato_mediano(tr, particella, grad, frazione)
+    return teorica_both_stato(x_media, v_media, particella, grad, E0)
 
-    posizione_mediana = tr.shape[0]//2
-    x_media = tr[posizione_mediana, :, 0]
-    B_mediano = np.array([gradiente(grad, xi) for xi in x_media])
-    B_medio_vettore = np.array([0, 0, np.mean(B_mediano[:, 2])]) 
+@cronometrato('teorica_both_stato')
+def teorica_both_stato (x, v, particella, grad, E0, per_particella=False):
+    """
+    Come teorica_both, ma a partire dallo stato delle particelle in un istante.
+    -------------------------------------------
+    Parametri:
+    - x : matrice Nx3 delle posizioni [m]
+    - v : matrice Nx3 delle velocità [m/s]
+    - particella : elemento della classe omonima
+    - grad : char che identifica il tipo di gradiente, oppure oggetto Campo
+    - E0 : array campo elettrico [V/m]
+    - per_particella : se True restituisce invece la matrice Nx3 delle velocità delle singole
+      particelle, somma delle proprie velocità E x B e di gradiente (si veda derive_particelle)
+    """
+    if per_particella:
+        return sum(derive_particelle(x, v, particella, grad, E0))
+    B_mediano = modello_campo(E0, [0, 0, 0], grad).B(x)
+    B_medio_vettore = np.mean(B_mediano, axis=0) 
 
     v_soloexb = teorica_exb(E0, B_medio_vettore)
-    v_solograd = teorica_grad(tr, particella, grad)
+    v_solograd = teorica_grad_stato(x, v, particella, grad)
 
     return v_soloexb + v_solograd
 
@@ -14,13 +14,10 @@
 #####################################################
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-import sys
-import scipy
 import sys,os
 import argparse
-import mod 
+import json
+import mod #le librerie grafiche sono importate da mod solo quando servono
 
 #Campi di default
 E_def = [0.01, 0.01, 0] #V/m
@@ -28,6 +25,10 @@ B_def = [0, 0, 0.0001] #T
 E_def2 = [-0.02, -0.05, 0] #V/m
 B_def2 = [0, 0, -0.0003] #T
 E_def3 = [10, 4, 0] #V/m
+PERIODI_DEF = 6 #periodi di Larmor simulati nelle modalità -t e -stat
+ADIABATICO_MASSIMO = 0.05 #massimo rapporto mediano fra raggio di Larmor e lunghezza di scala del campo con --centroguida
+PARSER_DEFAULT = {'integratore': None, 'frazione': 0.0001, 'processi': 1, 'decimazione': 1,
+                  'passi_checkpoint': 10000, 'cache_massima': 1024, 'blocco': 50, 'N_massimo': 10000} #default di argparse
 
 def parse_arguments():
     """
@@ -35,7 +36,7 @@ def parse_arguments():
     """
     parser = argparse.ArgumentParser(description="Simulazione del moto di particelle in campi elettrici e magnetici.")
     
-    parser.add_argument("-c", "--configurazione", choices=['exb', 'grad', 'both'], required=True,
+    parser.add_argument("-c", "--configurazione", choices=['exb', 'grad', 'both'],
                         help="Specifica la configurazione della simulazione, con scelte possibili: 'exb', per regime con E e con B uniforme; 'grad' per regime senza E e con B variabile, 'both' per regime con E e con B variabile.")
 
     parser.add_argument("-s", "--singola", action="store_true",
@@ -49,18 +50,396 @@ def parse_arguments():
     
     parser.add_argument("-stat", "--statistica", action="store_true",
                         help="Studia statisticamente la velocità di deriva per un campione adeguato di particelle con velocità iniziale casuale e per diverse configurazioni di E e B.")
+
+    parser.add_argument("-d", "--decimazione", type=int, default=PARSER_DEFAULT['decimazione'],
+                        help="Registra nelle traiettorie (-s, -m, -t) solo un passo ogni DECIMAZIONE, per ridurre la memoria occupata (default 1).")
+
+    parser.add_argument("-i", "--integratore", choices=list(mod.integratori), default=PARSER_DEFAULT['integratore'],
+                        help="Metodo di integrazione del moto: 'eulero', 'boris', 'rk4' o 'esatto' (soluzione analitica, solo in campo uniforme). Di default 'esatto' nella configurazione exb ed 'eulero' in presenza di gradiente.")
+
+    parser.add_argument("-f", "--frazione", type=float, default=PARSER_DEFAULT['frazione'],
+                        help="Passo temporale come frazione del periodo di Larmor (default 0.0001). Nelle modalità -t e -stat il numero di passi è scelto per coprire sempre lo stesso numero di periodi.")
+
+    parser.add_argument("--jit", action="store_true",
+                        help="Usa per -s, -m e -t il nucleo compilato con Numba (integratori eulero e boris), se installato.")
+
+    parser.add_argument("-g", "--dtglobale", action="store_true",
+                        help="Modalità -t: fa avanzare tutte le particelle con lo stesso dt (il minore), con tempi comuni a tutte.")
+
+    parser.add_argument("--compatto", action="store_true",
+                        help="Modalità -s, -m e -t: stato, traiettorie e tempi in singola precisione (float32), con i tempi memorizzati una volta per campione in campo uniforme, per dimezzare la memoria occupata; con -c exb --confronto misura la perdita di accuratezza rispetto alla doppia precisione.")
+
+    parser.add_argument("-p", "--processi", type=int, default=PARSER_DEFAULT['processi'],
+                        help="Numero di processi su cui distribuire le simulazioni di -stat (default 1).")
+
+    parser.add_argument("--seme", type=int, default=None,
+                        help="Seme per le condizioni iniziali casuali, per rendere riproducibili i risultati.")
+
+    parser.add_argument("--tolleranza", type=float, default=None,
+                        help="Modalità -stat: stima la deriva dal centro guida mediato su ogni girazione, fermando ogni particella quando l'errore relativo scende sotto la tolleranza. Affidabile solo in campi adiabatici: altrimenti è stampato un avviso.")
+
+    parser.add_argument("--errore", type=float, default=None,
+                        help="Modalità -stat: numero di particelle adattivo; le particelle sono simulate a blocchi finché l'errore relativo della velocità di drift media (mediana in campo non uniforme, come per --scarto) non scende sotto ERRORE.")
+
+    parser.add_argument("--scarto", type=float, default=None,
+                        help="Modalità -stat: numero di particelle adattivo; le particelle sono simulate a blocchi finché l'intervallo di confidenza dello scarto relativo dalla velocità teorica non è tutto entro ±SCARTO o tutto fuori.")
+
+    parser.add_argument("--blocco", type=int, default=PARSER_DEFAULT['blocco'],
+                        help="Particelle per blocco del campione adattivo di --errore e --scarto (default 50).")
+
+    parser.add_argument("--nmassimo", dest="N_massimo", type=int, default=PARSER_DEFAULT['N_massimo'],
+                        help="Numero massimo di particelle del campione adattivo (default 10000).")
+
+    parser.add_argument("--tempomassimo", dest="tempo_massimo", type=float, default=None,
+                        help="Tempo di calcolo massimo in secondi per ciascuna configurazione del campione adattivo.")
+
+    parser.add_argument("--campionamento", choices=list(mod.campionamenti), default=None,
+                        help="Modalità -m, -t e -stat: metodo di campionamento delle condizioni iniziali: 'casuale', 'stratificato' (ipercubo latino), 'halton' o 'sobol' (sequenze a bassa discrepanza), per ridurre la varianza della deriva media a parità di particelle.")
+
+    parser.add_argument("--distribuzione", choices=list(mod.distribuzioni), default=None,
+                        help="Modalità -m, -t e -stat: distribuzione delle velocità iniziali, 'uniforme' (default) o 'maxwelliana'.")
+
+    parser.add_argument("--antitetico", action="store_true",
+                        help="Modalità -m, -t e -stat: genera le particelle a coppie con la stessa posizione e velocità opposte (v, -v).")
+
+    parser.add_argument("--centroguida", action="store_true",
+                        help="Modalità -stat: integra le equazioni del centro guida invece delle orbite complete, per lo stesso tempo (--passi per -f periodi di Larmor); con --confronto verifica il modello sulle orbite. Richiede una configurazione adiabatica (rapporto mediano fra raggio di Larmor e lunghezza di scala del campo non oltre 0.05, come per gli elettroni nelle leggi predefinite) e termina con un errore altrimenti; non è compatibile con --tolleranza, --checkpoint, --errore, --scarto e --processi.")
+
+    parser.add_argument("--checkpoint", default=None,
+                        help="Modalità -stat: cartella in cui salvare periodicamente lo stato delle simulazioni; rilanciando lo stesso comando (con lo stesso --seme) le simulazioni riprendono dal salvataggio, e con --passi maggiore vengono prolungate.")
+
+    parser.add_argument("--passicheckpoint", dest="passi_checkpoint", type=int, default=PARSER_DEFAULT['passi_checkpoint'],
+                        help="Ogni quanti passi aggiornare i salvataggi di --checkpoint (default 10000).")
+
+    parser.add_argument("--cache", default=None,
+                        help="Modalità -t e -stat: cartella della cache su disco dei risultati; una simulazione con gli stessi parametri e le stesse condizioni iniziali (o lo stesso --seme) viene letta dalla cache invece di essere ripetuta.")
+
+    parser.add_argument("--cachemassima", dest="cache_massima", type=float, default=PARSER_DEFAULT['cache_massima'],
+                        help="Dimensione massima della cache in MiB (default 1024): oltre questa sono eliminati i risultati usati meno di recente.")
+
+    parser.add_argument("--archivio", default=None,
+                        help="Modalità -t: scrive traiettorie e tempi nei file ARCHIVIO_tr.npy e ARCHIVIO_tempi.npy mappati in memoria invece che in RAM (in modalità batch accanto agli altri risultati di ciascuna esecuzione), per simulazioni più grandi della memoria disponibile.")
+
+    parser.add_argument("--confronto", action="store_true",
+                        help="Solo con -c exb: confronta gli integratori riportando la deriva energetica e l'errore sulla velocità di drift rispetto a quella teorica; con --centroguida confronta invece il modello del centro guida con le orbite complete e con --compatto la singola con la doppia precisione.")
+
+    parser.add_argument("--profilo", "--profile", dest="profilo", nargs='?', const='profilo.json', default=None,
+                        help="Misura tempo di orologio e numero di chiamate di ciascuna fase (campo, dt, passo dell'integratore, analisi, grafici), stampa il riepilogo alla fine e lo scrive nel file JSON indicato (default profilo.json).")
+
+    parser.add_argument("--progresso", action="store_true",
+                        help="Mostra durante le simulazioni lunghe il passo raggiunto, i passi al secondo e il tempo restante stimato.")
+
+    #modalità batch, senza input da terminale né finestre
+
+    parser.add_argument("--batch", action="store_true",
+                        help="Esegue -t o -stat senza input da terminale, prendendo i parametri dalle opzioni seguenti o da un file di configurazione e salvando i risultati su disco.")
+
+    parser.add_argument("--config", default=None,
+                        help="File di configurazione JSON o TOML per la modalità batch (implica --batch); una lista 'sweep' di variazioni dei parametri avvia una esecuzione per ciascuna.")
+
+    parser.add_argument("--particella", choices=['e', 'ae', 'p', 'ap'], default=None,
+                        help="Modalità batch: specie della particella.")
+
+    parser.add_argument("-N", "--numero", type=int, default=None,
+                        help="Modalità batch: numero di particelle.")
+
+    parser.add_argument("--passi", type=int, default=None,
+                        help="Numero di passi delle modalità -t e -stat e della modalità batch (default tale da coprire 6 periodi di Larmor).")
+
+    parser.add_argument("--gradiente", choices=['0', '1', '2', '3'], default=None,
+                        help="Modalità batch: tipo di gradiente magnetico ('0' per campo uniforme).")
+
+    parser.add_argument("--campoE", type=float, nargs=3, default=None, metavar=('EX', 'EY', 'EZ'),
+                        help="Modalità batch: componenti del campo elettrico [V/m].")
+
+    parser.add_argument("--campoB", type=float, nargs=3, default=None, metavar=('BX', 'BY', 'BZ'),
+                        help="Modalità batch: componenti del campo magnetico uniforme [T].")
+
+    parser.add_argument("--mappa", default=None,
+                        help="Modalità batch: file .npy o .npz con la mappa del campo B su griglia regolare, usata al posto di --gradiente.")
+
+    parser.add_argument("--mappaE", default=None,
+                        help="Modalità batch: file .npy con la mappa del campo E sulla stessa griglia di --mappa.")
+
+    parser.add_argument("--uscita", default=None,
+                        help="Modalità batch: cartella in cui scrivere risultati e grafici (default 'risultati').")
  
     args = parser.parse_args()
 
     #controlli
 
-    if not args.configurazione:
+    if args.config is not None:
+        args.batch = True
+
+    if args.batch and (args.singola or args.multipla):
+        print("\nErrore: le modalità -s e -m sono interattive e non sono disponibili con --batch.\n")
+        sys.exit(1)
+
+    if args.checkpoint is not None and args.seme is None and not args.batch:
+        print("\nAttenzione: senza --seme le condizioni iniziali cambiano ad ogni avvio e i salvataggi di --checkpoint non possono essere ripresi.\n")
+
+    if args.centroguida:
+        ignorate = [nome for nome, valore in (('--tolleranza', args.tolleranza), ('--checkpoint', args.checkpoint),
+                                              ('--errore', args.errore), ('--scarto', args.scarto)) if valore is not None]
+        if args.processi != PARSER_DEFAULT['processi']:
+            ignorate.append('--processi')
+        if ignorate:
+            print(f"\nErrore: le opzioni {', '.join(ignorate)} non sono disponibili con --centroguida.\n")
+            sys.exit(1)
+
+    if not args.configurazione and not args.batch:
         print("\nErrore: l'argomento -c/--configurazione è obbligatorio.\n")
         print("Utilizzare -h per vedere l'elenco delle opzioni disponibili.\n")
         sys.exit(1)
 
     return args
 
+def deriva_configurazione(E0, B0, grad, particella, N, x0, seme, passi, args):
+    """
+    Esegue la simulazione a memoria costante di una configurazione della modalità statistica,
+    distribuita sul numero di processi richiesto; le velocità iniziali sono generate dai processi.
+    Con --cache il risultato di una simulazione già eseguita con gli stessi parametri è letto dal disco.
+    -------------------------------------------
+    Parametri:
+    E0, B0, grad : campi e tipo di gradiente della configurazione
+    particella : elemento della classe omonima
+    N : numero di particelle (massimo, con --errore o --scarto)
+    x0 : posizioni iniziali, oppure None per generarle dal seme insieme alle velocità
+    seme : seme delle velocità iniziali
+    passi : numero di iterazioni (massimo, con --tolleranza)
+    args : argomenti di argparse
+    """
+    campionamento = campionamento_scelto(args.campionamento, args.distribuzione, args.antitetico)
+    extra = () if campionamento is None else (campionamento,) #chiavi della cache invariate senza campionamento
+    #nella chiave solo le opzioni che cambiano il risultato: non il numero di processi, né --jit e --compatto,
+    #che -stat non usa, né le opzioni ignorate dal metodo scelto
+    if args.centroguida:
+        opzioni = ('centroguida',)
+    elif args.errore is not None or args.scarto is not None:
+        opzioni = (args.integratore, args.tolleranza, args.errore, args.scarto, args.blocco, args.tempo_massimo)
+    else:
+        opzioni = (args.integratore, args.tolleranza)
+    parametri = ('deriva_configurazione', E0, B0, grad, particella, N, x0, seme, passi, args.frazione, *opzioni, *extra)
+    return memorizzato(args.cache, args.cache_massima, parametri,
+                       lambda: simula_configurazione(E0, B0, grad, particella, N, x0, seme, passi, args))
+
+def simula_configurazione(E0, B0, grad, particella, N, x0, seme, passi, args):
+    """
+    Calcolo di deriva_configurazione, con gli stessi parametri.
+    """
+    campionamento = campionamento_scelto(args.campionamento, args.distribuzione, args.antitetico)
+    if args.centroguida:
+        return simula_centro_guida(E0, B0, grad, particella, N, x0, seme, passi, args.frazione, args.confronto, campionamento)
+    if args.errore is not None or args.scarto is not None:
+        return campione_adattivo(E0, B0, grad, particella, x0, seme, passi, args.errore, args.scarto, args.blocco, N,
+                                 args.tempo_massimo, args.processi, args.integratore, args.frazione, args.tolleranza,
+                                 campionamento)
+    risultato = mod.statistica_parallela([(E0, B0, grad)], particella, N, passi, x0=x0, processi=args.processi, seme=seme,
+                                         integratore=args.integratore, frazione=args.frazione, tolleranza=args.tolleranza,
+                                         checkpoint=args.checkpoint, passi_checkpoint=args.passi_checkpoint,
+                                         campionamento=campionamento)[0]
+    if args.tolleranza is not None: #stima dal centro guida
+        errore, passi_usati = risultato[4], risultato[5]
+        senza_retta = np.isnan(errore[:, 0])
+        print(f"Centro guida: {np.mean(passi_usati):.0f} passi medi su {passi}, errore medio per particella "
+              f"{np.nanmean(np.linalg.norm(errore, axis=1)) if not np.all(senza_retta) else np.nan:.2e} m/s")
+        if np.any(senza_retta):
+            print(f"Centro guida: {np.sum(senza_retta)} particelle con meno di 3 girazioni, deriva stimata dagli estremi")
+        avviso_tolleranza(E0, B0, grad, particella, risultato[2], risultato[3])
+    return risultato[:4]
+
+def avviso_tolleranza(E0, B0, grad, particella, x, v):
+    """
+    Avverte che con --tolleranza la stima dal centro guida non è affidabile se il rapporto mediano
+    fra raggio di Larmor e lunghezza di scala del campo supera ADIABATICO_MASSIMO: le orbite non
+    girano attorno a un centro guida che deriva in modo regolare, e il criterio di arresto può
+    fermare le particelle su una stima che non è ancora una velocità di drift.
+    -------------------------------------------
+    Parametri:
+    E0, B0, grad : campi e tipo di gradiente della configurazione
+    particella : elemento della classe omonima
+    x, v : matrici Nx3 di posizioni e velocità delle particelle simulate
+    """
+    adiabatico = np.median(mod.parametro_adiabatico(x, v, mod.modello_campo(E0, B0, grad), particella))
+    if adiabatico > ADIABATICO_MASSIMO:
+        print(f"Attenzione: con --tolleranza la deriva è stimata dal centro guida, ma il rapporto mediano fra raggio di "
+              f"Larmor e lunghezza di scala del campo è {adiabatico:.2e} (massimo {ADIABATICO_MASSIMO}): le orbite non "
+              f"sono adiabatiche e la stima e il criterio di arresto non sono affidabili. Omettere --tolleranza per la "
+              f"stima dagli estremi della traiettoria.")
+
+def campione_adattivo(E0, B0, grad, particella, x0, seme, passi, errore, scarto, blocco, N_massimo, tempo_massimo,
+                      processi, integratore, frazione, tolleranza, campionamento=None):
+    """
+    Studio statistico con numero di particelle adattivo (mod.statistica_adattiva): stampa quante
+    particelle sono state usate e perché il campione si è fermato.
+    -------------------------------------------
+    Parametri:
+    E0, B0, grad, particella, x0, seme, passi : come per deriva_configurazione (x0 può essere None)
+    errore, scarto, blocco, N_massimo, tempo_massimo : criteri di arresto e dimensioni del campione
+    processi, integratore, frazione, tolleranza : opzioni della simulazione
+    campionamento : tupla di mod.condizioni_iniziali per le condizioni iniziali, oppure None
+    -------------------------------------------
+    Restituisce:
+    tr, tempi, x_mediano, v_mediano per le particelle simulate
+    """
+    *risultato, info = mod.statistica_adattiva(E0, B0, grad, particella, passi, errore, scarto, blocco, N_massimo,
+                                               tempo_massimo, x0=x0, processi=processi, seme=seme, integratore=integratore,
+                                               frazione=frazione, tolleranza=tolleranza, campionamento=campionamento)
+    if tolleranza is not None:
+        avviso_tolleranza(E0, B0, grad, particella, risultato[2], risultato[3])
+    motivi = {'errore': 'errore relativo raggiunto', 'scarto': 'scarto dalla teoria risolto',
+              'particelle': 'raggiunto il numero massimo di particelle', 'tempo': 'raggiunto il tempo massimo'}
+    print(f"Campione adattivo: {info['N']} particelle in {info['blocchi']} blocchi ({info['tempo']:.1f} s), errore relativo "
+          f"della {info['stimatore']} {info['errore_relativo']:.2%}, scarto dalla teoria {info['scarto_relativo']:+.2%}; "
+          f"{motivi[info['arresto']]}.")
+    return tuple(risultato)
+
+def simula_centro_guida(E0, B0, grad, particella, N, x0, seme, passi, frazione, confronto=False, campionamento=None):
+    """
+    Versione di deriva_configurazione con le equazioni del centro guida (mod.avanzamento_centro_guida),
+    per lo stesso tempo simulato dalle orbite complete: passi*frazione periodi di Larmor nella posizione
+    iniziale di ciascuna particella. Solleva ValueError se il rapporto mediano fra raggio di Larmor e
+    lunghezza di scala del campo supera ADIABATICO_MASSIMO, dove il modello non è applicabile, e con
+    confronto verifica il modello rispetto all'integrazione completa delle orbite su un sottoinsieme
+    di particelle.
+    -------------------------------------------
+    Parametri:
+    E0, B0, grad, particella, N, x0, seme : come per deriva_configurazione (x0 può essere None)
+    passi, frazione : passi e frazione del periodo di Larmor delle orbite complete equivalenti
+    confronto : se True stampa il confronto con le orbite complete
+    campionamento : tupla di mod.condizioni_iniziali per le condizioni iniziali, oppure None
+    """
+    if campionamento is None:
+        rng = np.random.default_rng(seme)
+        v0 = mod.velocita_montecarlo(N, rng)
+        if x0 is None:
+            x0 = mod.posizioni_montecarlo(N, rng)
+    else:
+        x_campione, v0 = mod.condizioni_iniziali(N, *campionamento, rng=seme)
+        x0 = x_campione if x0 is None else x0
+    campo = mod.modello_campo(E0, B0, grad)
+    adiabatico = np.median(mod.parametro_adiabatico(x0, v0, campo, particella))
+    if adiabatico > ADIABATICO_MASSIMO:
+        raise ValueError(f"Il modello del centro guida richiede un raggio di Larmor piccolo rispetto alla lunghezza di scala "
+                         f"del campo, ma il loro rapporto mediano è {adiabatico:.2e} (massimo {ADIABATICO_MASSIMO}). "
+                         f"Usare il centro guida con particelle più leggere (ad esempio elettroni) o un campo più uniforme, "
+                         f"oppure simulare le orbite complete.")
+    durata = passi * frazione * mod.periodo_larmor(particella, campo.B(x0))
+    tr, tempi, x_finale, v_finale, passi_usati = mod.avanzamento_centro_guida(E0, B0, x0, v0, particella, durata, N, grad)
+    print(f"Centro guida: {np.mean(passi_usati):.0f} passi medi, raggio di Larmor / lunghezza di scala = {adiabatico:.2e}")
+    if confronto:
+        n = min(N, 20)
+        verifica = mod.confronto_centro_guida(E0, B0, x0[:n], v0[:n], particella, grad)
+        print(f"Confronto con le orbite complete (boris) su {n} particelle: errore relativo mediano "
+              f"{np.median(verifica['errore_relativo']):.2e}, massimo {np.max(verifica['errore_relativo']):.2e}; "
+              f"tempo {verifica['tempo_orbite']:.2f} s contro {verifica['tempo_centro_guida']:.3f} s")
+    return tr, tempi, x_finale, v_finale
+
+def traiettorie_configurazione(E0, B0, x0, v0, particella, passi, N, grad, args):
+    """
+    Simula le traiettorie della modalità -t con le opzioni della riga di comando, leggendole dalla
+    cache con --cache se la stessa simulazione è già stata eseguita. Con --archivio le traiettorie
+    sono scritte su disco e la cache non è usata.
+    -------------------------------------------
+    Parametri:
+    E0, B0, x0, v0, particella, passi, N, grad : come per mod.avanzamento
+    args : argomenti di argparse
+    -------------------------------------------
+    Restituisce:
+    traiettorie e tempi come mod.avanzamento
+    """
+    calcola = lambda: mod.avanzamento(E0, B0, x0, v0, particella, passi, N, grad, decimazione=args.decimazione,
+                                      integratore=args.integratore, frazione=args.frazione, jit=args.jit,
+                                      dt_globale=args.dtglobale, archivio=args.archivio, compatto=args.compatto)
+    if args.archivio is not None:
+        return calcola()
+    parametri = ('avanzamento', E0, B0, x0, v0, particella, passi, N, grad, args.decimazione, args.integratore,
+                 args.frazione, args.dtglobale, args.compatto, args.jit)
+    return memorizzato(args.cache, args.cache_massima, parametri, calcola)
+
+def memorizzato(cache, cache_massima, parametri, calcola):
+    """
+    Esegue calcola() oppure, se è indicata una cartella di cache, ne legge il risultato dalla cache
+    quando è già stato calcolato con gli stessi parametri (si veda mod.risultato_memorizzato).
+    -------------------------------------------
+    Parametri:
+    cache : cartella della cache, oppure None
+    cache_massima : dimensione massima della cache [MiB]
+    parametri : parametri da cui dipende il risultato
+    calcola : funzione senza argomenti che esegue il calcolo
+    """
+    if cache is None:
+        return calcola()
+    risultato, trovato = mod.risultato_memorizzato(cache, parametri, calcola, cache_massima * 2**20)
+    if trovato:
+        print(f"Risultato letto dalla cache {cache}.")
+    return risultato
+
+def campionamento_scelto(metodo, distribuzione, antitetico):
+    """
+    Tupla (metodo, distribuzione, antitetico) di mod.condizioni_iniziali per le opzioni di campionamento
+    indicate, oppure None se non ne è indicata nessuna (campionamento uniforme di mod.velocita_montecarlo).
+    -------------------------------------------
+    Parametri:
+    metodo, distribuzione : chiavi di mod.campionamenti e mod.distribuzioni, oppure None per il default
+    antitetico : se True le velocità sono generate a coppie antitetiche
+    """
+    if metodo is None and distribuzione is None and not antitetico:
+        return None
+    return (metodo or 'casuale', distribuzione or 'uniforme', bool(antitetico))
+
+def condizioni_casuali(N, campionamento, seme):
+    """
+    Posizioni e velocità iniziali casuali di N particelle, generate da un generatore inizializzato con
+    seme: con mod.condizioni_iniziali se è indicato un campionamento, altrimenti con
+    mod.posizioni_montecarlo e mod.velocita_montecarlo.
+    -------------------------------------------
+    Parametri:
+    N : numero di particelle
+    campionamento : tupla restituita da campionamento_scelto, oppure None
+    seme : seme del generatore (None per condizioni diverse ad ogni avvio)
+    """
+    rng = np.random.default_rng(seme)
+    if campionamento is None:
+        return mod.posizioni_montecarlo(N, rng), mod.velocita_montecarlo(N, rng)
+    return mod.condizioni_iniziali(N, *campionamento, rng=rng)
+
+def campione_statistica(args):
+    """
+    Numero di particelle della modalità -stat: 300, oppure con --errore o --scarto il massimo del
+    campione adattivo; stampa la descrizione dello studio.
+    -------------------------------------------
+    Parametri:
+    args: argomenti di argparse
+    """
+    if args.errore is None and args.scarto is None:
+        N = 300 #campione adeguato di particelle
+        print(f'Studio statistico della velocità di drift su {N} particelle nei campi di default.')
+        return N
+    print(f'Studio statistico della velocità di drift nei campi di default, con un campione adattivo di al più {args.N_massimo} particelle.')
+    return args.N_massimo
+
+def stampa_statistica(statistica):
+    """
+    Stampa il riassunto della statistica delle velocità di drift restituita da mod.statistica_vdrift.
+    -------------------------------------------
+    Parametri:
+    statistica: dizionario della statistica
+    """
+    basso, alto = statistica['intervallo']
+    print(f"Velocità media: {statistica['media']:.4e} ± {statistica['errore_standard']:.1e} m/s "
+          f"(deviazione standard {statistica['deviazione_standard']:.2e} m/s, intervallo al {statistica['livello']:.0%}: "
+          f"[{basso:.4e}, {alto:.4e}] m/s)")
+    if statistica.get('confronto') == 'mediana': #velocità teoriche per particella, con code dovute a B ~ 0
+        print(f"Velocità mediana: {statistica['mediana']:.4e} ± {statistica['errore_mediana']:.1e} m/s; "
+              f"velocità teorica mediana: {statistica['teorica']:.4e} m/s (media {statistica['teorica_media']:.2e} m/s), "
+              f"scarto relativo {statistica['scarto_relativo']:+.2%} ({statistica['scarto_sigma']:+.1f} errori)")
+    elif 'teorica' in statistica:
+        print(f"Velocità teorica: {statistica['teorica']:.4e} m/s, scarto relativo {statistica['scarto_relativo']:+.2%} "
+              f"({statistica['scarto_sigma']:+.1f} errori standard)")
+    if 'scarto_mediano' in statistica:
+        print(f"Scarto relativo mediano delle singole particelle dalla propria velocità teorica: {statistica['scarto_mediano']:.2%}")
+
 def funzioni(args):
     """
     Associa agli argomenti di argparse le funzioni corrispondenti del mod.
@@ -69,6 +448,9 @@ def funzioni(args):
     args: argomenti di argparse
     """
 
+    passi_def = int(round(PERIODI_DEF / args.frazione)) if args.passi is None else args.passi #60000 passi con la frazione di default
+    campionamento = campionamento_scelto(args.campionamento, args.distribuzione, args.antitetico)
+
     #Configurazione E X B : B uniforme, E diverso da 0.
     
     if args.configurazione == 'exb':
@@ -87,7 +469,7 @@ def funzioni(args):
             v0 = mod.inserimento_coppie()
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi N della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, '0')
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, '0', decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, 0, dt)
 
         if args.multipla :
@@ -99,55 +481,81 @@ def funzioni(args):
             E0 = [Ex, Ey, 0]
             B0 = [0, 0, Bz]
             N = int(input ('Inserire il numero di particelle con cui avviare la simulazione: '))
-            v0= mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
+            x_casuali, v0 = condizioni_casuali(N, campionamento, args.seme)
+            x0 = mod.scelta_posizione(N, x0=x_casuali) #posizioni campionate insieme alle velocità
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, '0')
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, '0', decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, 0, dt)
         
         if args.traiettorie :
 
-            print('Traiettorie di un numero fornito di particelle nei campi di default (60000 passi):')
+            print(f'Traiettorie di un numero fornito di particelle nei campi di default ({passi_def} passi):')
             print('E = [1, 1, 0] *10^(-2) V/m')
             print('B = [0, 0, 1] *10^(-4) T')
             N = int(input('Fornire il numero di particelle da visualizzare:'))
             particella = mod.inserimento_particella()
-            x0 = mod.posizioni_montecarlo(N)
-            v0 = mod.velocita_montecarlo(N)
-            tr, dt = mod.avanzamento(E_def, B_def, x0, v0, particella, 60000, N, '0')
+            x0, v0 = condizioni_casuali(N, campionamento, args.seme)
+            tr, dt = traiettorie_configurazione(E_def, B_def, x0, v0, particella, passi_def, N, '0', args)
             mod.grafico2d (tr, E_def, B_def, particella, 0, dt)
 
         if args.statistica : 
             
-            N = 300 #campione adeguato di particelle
-            print(f'Studio statistico della velocità di drift su {N} particelle nei campi di default.')
+            N = campione_statistica(args)
             particella = mod.inserimento_particella()
-            v0 = mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
-            tr1, dt1 = mod.avanzamento(E_def, B_def, x0, v0, particella, 60000, N, '0')
+            x0 = mod.scelta_posizione(N, x0=None) #posizioni casuali generate con le velocità, dal seme
+            seme = args.seme if args.seme is not None else np.random.SeedSequence().entropy #stesse velocità per tutte le configurazioni
+            tr1, dt1, _, _ = deriva_configurazione(E_def, B_def, '0', particella, N, x0, seme, passi_def, args)
             #mod.grafico2d (tr1, E_def, B_def, particella, 0, dt1)
             teorica = mod.teorica_exb(E_def, B_def)
-            mod.istogramma_vdrift(tr1, dt1, '1', '1', teorica, particella)
+            stampa_statistica(mod.istogramma_vdrift(tr1, dt1, '1', '1', teorica, particella))
             while True:
                 risposta = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                 if (risposta=='1'):
-                    tr2, dt2 = mod.avanzamento(E_def2, B_def, x0, v0, particella, 60000, N, '0')
+                    tr2, dt2, _, _ = deriva_configurazione(E_def2, B_def, '0', particella, N, x0, seme, passi_def, args)
                     #mod.grafico2d (tr2, E_def2, B_def, particella, 0, dt2)
                     teorica2 = mod.teorica_exb(E_def2, B_def)
-                    mod.istogramma_vdrift(tr2, dt2, '2', '1', teorica2, particella)
+                    stampa_statistica(mod.istogramma_vdrift(tr2, dt2, '2', '1', teorica2, particella))
                     risposta2 = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                     if (risposta2=='1'):
-                        tr3, dt3 = mod.avanzamento(E_def, B_def2, x0, v0, particella, 60000, N, '0')
+                        tr3, dt3, _, _ = deriva_configurazione(E_def, B_def2, '0', particella, N, x0, seme, passi_def, args)
                         #mod.grafico2d (tr3, E_def, B_def2, particella, 0, dt3)
                         teorica3 = mod.teorica_exb(E_def, B_def2)
-                        mod.istogramma_vdrift(tr3, dt3, '1', '2', teorica3, particella)
+                        stampa_statistica(mod.istogramma_vdrift(tr3, dt3, '1', '2', teorica3, particella))
                         break
                     else:
                         break 
                 else:
                     break          
        
+        if args.confronto and args.compatto and not args.centroguida :
+
+            print('Confronto fra singola e doppia precisione nei campi di default:')
+            print('E = [1, 1, 0] *10^(-2) V/m')
+            print('B = [0, 0, 1] *10^(-4) T')
+            particella = mod.inserimento_particella()
+            N = 20
+            x0 = mod.posizioni_montecarlo(N)
+            v0 = mod.velocita_montecarlo(N)
+            confronto = mod.confronto_precisione(E_def, B_def, x0, v0, particella, passi_def, args.integratore, args.frazione)
+            for nome in ('doppia', 'singola'):
+                print(f"{nome:>8} precisione: scarto dalla velocità teorica {confronto['scarto_' + nome]:+.3e}, "
+                      f"memoria {confronto['memoria_' + nome] / 2**20:.1f} MiB, tempo {confronto['tempo_' + nome]:.2f} s")
+            print(f"Massima differenza relativa fra le velocità di drift delle singole particelle: {confronto['differenza_relativa']:.2e}")
+
+        if args.confronto and not args.centroguida and not args.compatto :
+
+            print('Confronto fra gli integratori nei campi di default:')
+            print('E = [1, 1, 0] *10^(-2) V/m')
+            print('B = [0, 0, 1] *10^(-4) T')
+            particella = mod.inserimento_particella()
+            N = 20
+            x0 = mod.posizioni_montecarlo(N)
+            v0 = mod.velocita_montecarlo(N)
+            print(f"{'integratore':>12} {'frazione':>10} {'passi':>8} {'deriva energetica':>18} {'errore deriva':>14}")
+            for nome, frazione, passi, energia, errore in mod.confronto_integratori(E_def, B_def, x0, v0, particella, PERIODI_DEF):
+                print(f'{nome:>12} {frazione:>10.0e} {passi:>8d} {energia:>18.2e} {errore:>14.2e}')
+
     #Configurazione grad : B dipendente dalla posizione, E assente.
 
     if args.configurazione == 'grad':
@@ -165,7 +573,7 @@ def funzioni(args):
             v0 = mod.inserimento_coppie()
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi N della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, var)
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, var, decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, var, dt)
 
         if args.multipla :
@@ -173,48 +581,46 @@ def funzioni(args):
             print('Inserire i parametri della simulazione.')
             var = mod.scelta_gradiente()
             N = int(input ('Inserire il numero di particelle con cui avviare la simulazione: '))
-            v0= mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
+            x_casuali, v0 = condizioni_casuali(N, campionamento, args.seme)
+            x0 = mod.scelta_posizione(N, x0=x_casuali) #posizioni campionate insieme alle velocità
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, var)
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, var, decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, var, dt)            
         
         if args.traiettorie :
 
-            print('Traiettorie di un numero fornito di particelle nei campi di default (60000 passi):')
+            print(f'Traiettorie di un numero fornito di particelle nei campi di default ({passi_def} passi):')
             N = int(input('Fornire il numero di particelle da visualizzare:'))
-            x0 = mod.posizioni_montecarlo(N)
-            v0 = mod.velocita_montecarlo(N)
+            x0, v0 = condizioni_casuali(N, campionamento, args.seme)
             particella = mod.inserimento_particella()
             var = mod.scelta_gradiente()
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, 60000, N, var)
+            tr, dt = traiettorie_configurazione(E0, B0, x0, v0, particella, passi_def, N, var, args)
             mod.grafico2d (tr, E0, B0, particella, var, dt)
 
         if args.statistica : 
             
-            N = 300 #campione adeguato di particelle
-            print(f'Studio statistico della velocità di drift su {N} particelle nei campi di default.')
+            N = campione_statistica(args)
             particella = mod.inserimento_particella()
-            v0 = mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
-            tr1, dt1 = mod.avanzamento(E0, B0, x0, v0, particella, 60000, N, '1')
+            x0 = mod.scelta_posizione(N, x0=None) #posizioni casuali generate con le velocità, dal seme
+            seme = args.seme if args.seme is not None else np.random.SeedSequence().entropy #stesse velocità per tutte le configurazioni
+            tr1, dt1, xm1, vm1 = deriva_configurazione(E0, B0, '1', particella, N, x0, seme, passi_def, args)
             #mod.grafico2d (tr1, E0, B0, particella, 1, dt1)
-            teorica = mod.teorica_grad(tr1, particella, '1')
-            mod.istogramma_vdrift(tr1, dt1, '3', '31', teorica, particella)
+            teorica = mod.teorica_grad_stato(xm1, vm1, particella, '1', per_particella=True)
+            stampa_statistica(mod.istogramma_vdrift(tr1, dt1, '3', '31', teorica, particella))
             while True:
                 risposta = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                 if (risposta=='1'):
-                    tr2, dt2 = mod.avanzamento(E0, B0, x0, v0, particella, 60000, N, '2')
+                    tr2, dt2, xm2, vm2 = deriva_configurazione(E0, B0, '2', particella, N, x0, seme, passi_def, args)
                     #mod.grafico2d (tr2, E0, B0, particella, 2, dt2)
-                    teorica2 = mod.teorica_grad(tr2, particella, '2')
-                    mod.istogramma_vdrift(tr2, dt2, '3', '32', teorica2, particella)
+                    teorica2 = mod.teorica_grad_stato(xm2, vm2, particella, '2', per_particella=True)
+                    stampa_statistica(mod.istogramma_vdrift(tr2, dt2, '3', '32', teorica2, particella))
                     risposta2 = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                     if (risposta2 =='1'):
-                        tr3, dt3 = mod.avanzamento(E0, B0, x0, v0, particella, 60000, N, '3')
+                        tr3, dt3, xm3, vm3 = deriva_configurazione(E0, B0, '3', particella, N, x0, seme, passi_def, args)
                         #mod.grafico2d (tr3, E0, B0, particella, 3, dt3)
-                        teorica3 = mod.teorica_grad(tr3, particella, '3')
-                        mod.istogramma_vdrift(tr3, dt3, '3', '33', teorica3, particella)
+                        teorica3 = mod.teorica_grad_stato(xm3, vm3, particella, '3', per_particella=True)
+                        stampa_statistica(mod.istogramma_vdrift(tr3, dt3, '3', '33', teorica3, particella))
                         break
                     else:
                         break
@@ -240,7 +646,7 @@ def funzioni(args):
             v0 = mod.inserimento_coppie()
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi N della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, var)
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, 1, var, decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, var, dt)
 
         if args.multipla :
@@ -251,59 +657,391 @@ def funzioni(args):
             Ey = float(input('Inserire la componente y del campo elettrico E [V/m]: '))
             E0 = [Ex, Ey, 0]
             N = int(input ('Inserire il numero di particelle con cui avviare la simulazione: '))
-            v0= mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
+            x_casuali, v0 = condizioni_casuali(N, campionamento, args.seme)
+            x0 = mod.scelta_posizione(N, x0=x_casuali) #posizioni campionate insieme alle velocità
             particella = mod.inserimento_particella()
             passi = int(input('Inserire il numero di passi N della simulazione: '))
-            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, var)
+            tr, dt = mod.avanzamento(E0, B0, x0, v0, particella, passi, N, var, decimazione=args.decimazione, integratore=args.integratore, frazione=args.frazione, jit=args.jit, dt_globale=args.dtglobale, compatto=args.compatto)
             mod.grafico2d (tr, E0, B0, particella, var, dt)       
         
         if args.traiettorie :
 
-            print('Traiettorie di un numero fornito di particelle nei campi di default (60000 passi):')
+            print(f'Traiettorie di un numero fornito di particelle nei campi di default ({passi_def} passi):')
             N = int(input('Fornire il numero di particelle da visualizzare:'))
-            x0 = mod.posizioni_montecarlo(N)
-            v0 = mod.velocita_montecarlo(N)
+            x0, v0 = condizioni_casuali(N, campionamento, args.seme)
             particella = mod.inserimento_particella()
             var = mod.scelta_gradiente()
-            tr, dt = mod.avanzamento(E_def, B0, x0, v0, particella, 60000, N, var)
+            tr, dt = traiettorie_configurazione(E_def, B0, x0, v0, particella, passi_def, N, var, args)
             mod.grafico2d (tr, E_def, B0, particella, var, dt)
 
         if args.statistica : 
             
-            N = 300 #campione adeguato di particelle
-            print(f'Studio statistico della velocità di drift su {N} particelle nei campi di default.')
+            N = campione_statistica(args)
             particella = mod.inserimento_particella()
-            v0 = mod.velocita_montecarlo(N)
-            x0 = mod.scelta_posizione(N)
-            tr1, dt1 = mod.avanzamento(E_def, B0, x0, v0, particella, 60000, N, '1')
+            x0 = mod.scelta_posizione(N, x0=None) #posizioni casuali generate con le velocità, dal seme
+            seme = args.seme if args.seme is not None else np.random.SeedSequence().entropy #stesse velocità per tutte le configurazioni
+            tr1, dt1, xm1, vm1 = deriva_configurazione(E_def, B0, '1', particella, N, x0, seme, passi_def, args)
             #mod.grafico2d (tr1, E_def, B0, particella, '1', dt1)
-            teorica = mod.teorica_both(tr1, particella, '1', E_def)
-            mod.istogramma_vdrift(tr1, dt1, '1', '31', teorica, particella)
+            teorica = mod.teorica_both_stato(xm1, vm1, particella, '1', E_def, per_particella=True)
+            stampa_statistica(mod.istogramma_vdrift(tr1, dt1, '1', '31', teorica, particella))
             while True:
                 risposta = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                 if (risposta=='1'):
-                    tr2, dt2 = mod.avanzamento(E_def2, B0, x0, v0, particella, 60000, N, '2')
+                    tr2, dt2, xm2, vm2 = deriva_configurazione(E_def2, B0, '2', particella, N, x0, seme, passi_def, args)
                     #mod.grafico2d (tr2, E_def2, B0, particella, '2', dt2)
-                    teorica2 = mod.teorica_both(tr1, particella, '2', E_def2)
-                    mod.istogramma_vdrift(tr1, dt1, '2', '32', teorica2, particella)
+                    teorica2 = mod.teorica_both_stato(xm2, vm2, particella, '2', E_def2, per_particella=True)
+                    stampa_statistica(mod.istogramma_vdrift(tr2, dt2, '2', '32', teorica2, particella))
                     risposta2 = input('Digitare 1 per continuare con la configurazione successiva, altro per uscire: ')
                     if (risposta2 =='1'):
-                        tr3, dt3 = mod.avanzamento(E_def, B0, x0, v0, particella, 60000, N, '3')
+                        tr3, dt3, xm3, vm3 = deriva_configurazione(E_def, B0, '3', particella, N, x0, seme, passi_def, args)
                         #mod.grafico2d (tr3, E_def, B0, particella, '3', dt3)
-                        teorica3 = mod.teorica_both(tr1, particella, '3', E_def)
-                        mod.istogramma_vdrift(tr3, dt3, '1', '33', teorica3, particella)   
+                        teorica3 = mod.teorica_both_stato(xm3, vm3, particella, '3', E_def, per_particella=True)
+                        stampa_statistica(mod.istogramma_vdrift(tr3, dt3, '1', '33', teorica3, particella))
                         break
                     else:
                         break 
                 else:
                     break
 
+#Modalità batch
+
+def carica_configurazione(percorso):
+    """
+    Legge un file di configurazione JSON o TOML (riconosciuto dall'estensione .toml).
+    -------------------------------------------
+    Parametri:
+    percorso: percorso del file
+    """
+    if percorso.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError: #Python precedente alla 3.11
+            import tomli as tomllib
+        with open(percorso, 'rb') as file:
+            return tomllib.load(file)
+    with open(percorso) as file:
+        return json.load(file)
+
+def parametri_esecuzione(base, variazione):
+    """
+    Completa i parametri di una esecuzione batch: la variazione dello sweep prevale sui parametri
+    comuni, e quelli mancanti prendono i valori di default della configurazione scelta.
+    -------------------------------------------
+    Parametri:
+    base: dizionario dei parametri comuni
+    variazione: dizionario dei parametri della singola esecuzione
+    """
+    par = dict(base)
+    par.update(variazione)
+    par.setdefault('configurazione', 'exb')
+    if par['configurazione'] not in ('exb', 'grad', 'both'):
+        raise ValueError(f"Configurazione non valida: {par['configurazione']}. Inserire una fra exb, grad, both.")
+    default = {
+        'exb': ('0', E_def, B_def),
+        'grad': ('1', [0, 0, 0], [0, 0, 0]),
+        'both': ('1', E_def, [0, 0, 0])
+    }
+    grad, E0, B0 = default[par['configurazione']]
+    par.setdefault('gradiente', grad)
+    par['gradiente'] = str(par['gradiente'])
+    par.setdefault('E', E0)
+    par.setdefault('B', B0)
+    par.setdefault('modalita', 'statistica')
+    par.setdefault('particella', 'p')
+    par.setdefault('N', 300)
+    par.setdefault('seme', None)
+    par.setdefault('integratore', None) #scelta automatica di mod.scelta_integratore
+    par.setdefault('frazione', 0.0001)
+    par.setdefault('processi', 1)
+    par.setdefault('decimazione', 1)
+    par.setdefault('jit', False)
+    par.setdefault('dt_globale', False)
+    par.setdefault('tolleranza', None)
+    par.setdefault('centro_guida', False)
+    par.setdefault('passi', int(round(PERIODI_DEF / par['frazione'])))
+    par.setdefault('mappa', None)
+    par.setdefault('checkpoint', None)
+    par.setdefault('passi_checkpoint', 10000)
+    par.setdefault('cache', None)
+    par.setdefault('cache_massima', 1024)
+    par.setdefault('archivio', False)
+    par.setdefault('compatto', False)
+    par.setdefault('griglia', None)
+    par.setdefault('errore', None)
+    par.setdefault('scarto', None)
+    par.setdefault('blocco', 50)
+    par.setdefault('N_massimo', 10000)
+    par.setdefault('tempo_massimo', None)
+    par.setdefault('campionamento', None)
+    par.setdefault('distribuzione', None)
+    par.setdefault('antitetico', False)
+    if par['modalita'] not in ('statistica', 'traiettorie', 'scansione'):
+        raise ValueError(f"Modalità non valida: {par['modalita']}. Inserire una fra statistica, traiettorie, scansione.")
+    if par['modalita'] == 'scansione' and not par['griglia']:
+        raise ValueError("La modalità scansione richiede la chiave 'griglia' con i valori di almeno un parametro.")
+    if par['centro_guida']:
+        ignorate = [chiave for chiave in ('tolleranza', 'checkpoint', 'errore', 'scarto') if par[chiave] is not None]
+        if par['processi'] != 1:
+            ignorate.append('processi')
+        if ignorate:
+            raise ValueError(f"Le chiavi {', '.join(ignorate)} non sono disponibili con centro_guida.")
+
+    return par
+
+def valori_griglia(valori):
+    """
+    Valori di un asse della griglia di scansione: una lista, oppure un dizionario con 'inizio', 'fine'
+    e 'punti' per valori equispaziati.
+    -------------------------------------------
+    Parametri:
+    valori: lista o dizionario letto dal file di configurazione
+    """
+    if isinstance(valori, dict):
+        return list(np.linspace(valori['inizio'], valori['fine'], valori['punti']))
+    return list(valori)
+
+def esegui_scansione(par, prefisso, particella):
+    """
+    Esegue in modalità batch la scansione della griglia di parametri 'griglia' con mod.scansione_parametri,
+    scrivendo in prefisso.npz le mappe delle velocità di drift simulate e teoriche e in prefisso.png il
+    loro grafico (per griglie di uno o due assi).
+    -------------------------------------------
+    Parametri:
+    par: dizionario completo dei parametri (si veda parametri_esecuzione)
+    prefisso: percorso dei file di uscita senza estensione
+    particella: elemento della classe omonima
+    -------------------------------------------
+    Restituisce:
+    dizionario riassuntivo dell'esecuzione
+    """
+    griglia = {asse: valori_griglia(valori) for asse, valori in par['griglia'].items()}
+    scansione = mod.scansione_parametri(griglia, par['N'], par['passi'], particella, par['E'], par['B'], par['gradiente'],
+                                        seme=par['seme'], integratore=par['integratore'], frazione=par['frazione'])
+    np.savez(prefisso + '.npz', **{asse: np.array(valori, dtype=str if asse == 'particella' else float)
+                                   for asse, valori in griglia.items()},
+             **{chiave: scansione[chiave] for chiave in ('simulata', 'errore_standard', 'teorica', 'scarto_relativo',
+                                                         'vettori', 'vettori_teorici')})
+    if len(griglia) <= 2:
+        mod.mappa_vdrift(scansione, salva=prefisso + '.png')
+    scarto = np.abs(scansione['scarto_relativo'])
+    return {
+        'parametri': par,
+        'punti': int(scarto.size),
+        'scarto_relativo_mediano': float(np.nanmedian(scarto)),
+        'scarto_relativo_massimo': float(np.nanmax(scarto)),
+        'file': os.path.basename(prefisso)
+    }
+
+def esegui_simulazione(par, prefisso):
+    """
+    Esegue una simulazione batch e ne scrive i risultati in prefisso.npz e il grafico in prefisso.png.
+    In modalità 'statistica' i dati sono le velocità di drift con la velocità teorica e l'istogramma,
+    in modalità 'scansione' le mappe delle velocità di drift su una griglia di parametri (esegui_scansione),
+    in modalità 'traiettorie' le traiettorie con i tempi e il grafico nel piano xy (con la chiave
+    'archivio' traiettorie e tempi sono scritti durante la simulazione in prefisso_tr.npy e prefisso_tempi.npy).
+    -------------------------------------------
+    Parametri:
+    par: dizionario completo dei parametri (si veda parametri_esecuzione)
+    prefisso: percorso dei file di uscita senza estensione
+    -------------------------------------------
+    Restituisce:
+    dizionario riassuntivo dell'esecuzione
+    """
+    particella = mod.particella_da_sigla(par['particella'])
+    if par['modalita'] == 'scansione':
+        return esegui_scansione(par, prefisso, particella)
+    E0, B0, grad, N = par['E'], par['B'], par['gradiente'], par['N']
+    descrizione_E = f"E = ({E0[0]:g}; {E0[1]:g}; {E0[2]:g}) V/m"
+    descrizione_B = f"B = ({B0[0]:g}; {B0[1]:g}; {B0[2]:g}) T" if grad == '0' else '3' + grad
+    if par['mappa'] is not None:
+        grad = mod.carica_campo(par['mappa'], origine=par.get('origine_mappa'), passo=par.get('passo_mappa'),
+                                percorso_E=par.get('mappa_E'), E0=E0)
+        descrizione_B = f"B da {os.path.basename(par['mappa'])}"
+
+    #la cache e i salvataggi servono solo se le condizioni iniziali sono riproducibili
+    cache = par['cache']
+    if (cache is not None or par['checkpoint'] is not None) and par['seme'] is None:
+        print("Attenzione: senza seme le condizioni iniziali cambiano ad ogni avvio: la cache non viene usata e i salvataggi non possono essere ripresi.")
+        cache = None
+    parametri = ('esegui_simulazione', grad, {chiave: valore for chiave, valore in par.items()
+                                             if chiave not in ('cache', 'cache_massima', 'checkpoint', 'passi_checkpoint', 'processi')})
+
+    adattivo = par['errore'] is not None or par['scarto'] is not None
+    campionamento = campionamento_scelto(par['campionamento'], par['distribuzione'], par['antitetico'])
+    if par['modalita'] == 'statistica':
+        if par['centro_guida']:
+            risultato = memorizzato(cache, par['cache_massima'], parametri,
+                                    lambda: simula_centro_guida(E0, B0, grad, particella, N, None, par['seme'], par['passi'],
+                                                                par['frazione'], campionamento=campionamento))
+        elif adattivo:
+            risultato = memorizzato(cache, par['cache_massima'], parametri,
+                                    lambda: campione_adattivo(E0, B0, grad, particella, None, par['seme'], par['passi'],
+                                                              par['errore'], par['scarto'], par['blocco'], par['N_massimo'],
+                                                              par['tempo_massimo'], par['processi'], par['integratore'],
+                                                              par['frazione'], par['tolleranza'], campionamento))
+        else:
+            risultato = memorizzato(cache, par['cache_massima'], parametri,
+                                    lambda: mod.statistica_parallela([(E0, B0, grad)], particella, N, par['passi'],
+                                                                     processi=par['processi'], seme=par['seme'],
+                                                                     integratore=par['integratore'], frazione=par['frazione'],
+                                                                     tolleranza=par['tolleranza'], checkpoint=par['checkpoint'],
+                                                                     passi_checkpoint=par['passi_checkpoint'],
+                                                                     campionamento=campionamento)[0])
+            if par['tolleranza'] is not None:
+                avviso_tolleranza(E0, B0, grad, particella, risultato[2], risultato[3])
+        tr, tempi, xm, vm = risultato[:4]
+        if grad == '0':
+            teorica = mod.teorica_exb(E0, B0)
+        elif np.linalg.norm(E0) == 0:
+            teorica = mod.teorica_grad_stato(xm, vm, particella, grad, per_particella=True)
+        else:
+            teorica = mod.teorica_both_stato(xm, vm, particella, grad, E0, per_particella=True)
+        statistica = mod.istogramma_vdrift(tr, tempi, descrizione_E, descrizione_B, teorica, particella, salva=prefisso + '.png')
+        np.savez(prefisso + '.npz', vel_drift=statistica['vettori'], teorica=teorica, tr=tr, tempi=tempi)
+    else:
+        x0, v0 = condizioni_casuali(N, campionamento, par['seme'])
+        archivio = prefisso if par['archivio'] else None
+        calcola = lambda: mod.avanzamento(E0, B0, x0, v0, particella, par['passi'], N, grad, decimazione=par['decimazione'],
+                                          integratore=par['integratore'], frazione=par['frazione'], jit=par['jit'],
+                                          dt_globale=par['dt_globale'], archivio=archivio, compatto=par['compatto'])
+        tr, tempi = calcola() if archivio is not None else memorizzato(cache, par['cache_massima'], parametri, calcola)
+        teorica = mod.teorica_exb(E0, B0) if grad == '0' else None
+        statistica = mod.statistica_vdrift(tr, tempi, teorica)
+        if archivio is not None: #traiettorie e tempi già su disco in prefisso_tr.npy e prefisso_tempi.npy
+            np.savez(prefisso + '.npz', vel_drift=statistica['vettori'])
+        else:
+            np.savez(prefisso + '.npz', tr=tr, tempi=tempi, vel_drift=statistica['vettori'])
+        mod.grafico2d(tr, E0, B0, particella, grad, tempi, salva=prefisso + '.png')
+
+    riepilogo = {
+        'parametri': par,
+        'velocita_media': float(statistica['media']),
+        'deviazione_standard': float(statistica['deviazione_standard']),
+        'errore_standard': float(statistica['errore_standard']),
+        'intervallo_confidenza': [float(estremo) for estremo in statistica['intervallo']],
+        'velocita_teorica': None if teorica is None else float(statistica['teorica']),
+        'file': os.path.basename(prefisso)
+    }
+    if par['modalita'] == 'statistica' and adattivo and not par['centro_guida']:
+        riepilogo['N_usate'] = int(statistica['N'])
+    elif par['modalita'] == 'statistica' and par['tolleranza'] is not None and not par['centro_guida']:
+        riepilogo['passi_medi'] = float(np.mean(risultato[5]))
+        riepilogo['errore_medio_particella'] = float(np.nanmean(np.linalg.norm(risultato[4], axis=1)))
+        riepilogo['senza_retta'] = int(np.sum(np.isnan(risultato[4][:, 0]))) #particelle con la deriva dagli estremi
+    if teorica is not None:
+        riepilogo['scarto_relativo'] = float(statistica['scarto_relativo'])
+        riepilogo['scarto_sigma'] = float(statistica['scarto_sigma'])
+    if 'scarto_mediano' in statistica:
+        riepilogo['scarto_mediano_particelle'] = float(statistica['scarto_mediano'])
+    if statistica.get('confronto') == 'mediana': #scarti calcolati dalla mediana simulata
+        riepilogo['velocita_mediana'] = float(statistica['mediana'])
+    return riepilogo
+
+def esegui_batch(args):
+    """
+    Modalità batch: combina file di configurazione e opzioni da riga di comando (che prevalgono),
+    esegue una simulazione per ciascuna voce dello sweep e scrive nella cartella di uscita i risultati
+    e un riepilogo.json, senza input da terminale e con il backend non interattivo di matplotlib.
+    -------------------------------------------
+    Parametri:
+    args: argomenti di argparse
+    """
+    import matplotlib
+    matplotlib.use('Agg') #nessuna finestra: le figure vengono solo salvate
+
+    base = carica_configurazione(args.config) if args.config is not None else {}
+    variazioni = base.pop('sweep', [{}])
+
+    #opzioni da riga di comando, solo se indicate esplicitamente
+    opzioni = {
+        'configurazione': args.configurazione,
+        'particella': args.particella,
+        'N': args.numero,
+        'passi': args.passi,
+        'seme': args.seme,
+        'gradiente': args.gradiente,
+        'E': args.campoE,
+        'B': args.campoB,
+        'tolleranza': args.tolleranza,
+        'errore': args.errore,
+        'scarto': args.scarto,
+        'tempo_massimo': args.tempo_massimo,
+        'campionamento': args.campionamento,
+        'distribuzione': args.distribuzione,
+        'mappa': args.mappa,
+        'mappa_E': args.mappaE,
+        'checkpoint': args.checkpoint,
+        'cache': args.cache,
+        'uscita': args.uscita
+    }
+    if args.traiettorie:
+        opzioni['modalita'] = 'traiettorie'
+    if args.statistica:
+        opzioni['modalita'] = 'statistica'
+    if args.jit:
+        opzioni['jit'] = True
+    if args.dtglobale:
+        opzioni['dt_globale'] = True
+    if args.centroguida:
+        opzioni['centro_guida'] = True
+    if args.archivio is not None:
+        opzioni['archivio'] = True
+    if args.compatto:
+        opzioni['compatto'] = True
+    if args.antitetico:
+        opzioni['antitetico'] = True
+    for nome in ('integratore', 'frazione', 'processi', 'decimazione', 'passi_checkpoint', 'cache_massima', 'blocco', 'N_massimo'):
+        if getattr(args, nome) != PARSER_DEFAULT[nome]:
+            opzioni[nome] = getattr(args, nome)
+    base.update({chiave: valore for chiave, valore in opzioni.items() if valore is not None})
+
+    cartella = base.pop('uscita', 'risultati')
+    os.makedirs(cartella, exist_ok=True)
+    riepilogo = []
+    for i, variazione in enumerate(variazioni):
+        par = parametri_esecuzione(base, variazione)
+        nome = par.pop('nome', f'esecuzione_{i:03d}')
+        print(f"Esecuzione {i + 1}/{len(variazioni)}: {nome}")
+        riepilogo.append(esegui_simulazione(par, os.path.join(cartella, nome)))
+
+    with open(os.path.join(cartella, 'riepilogo.json'), 'w') as file:
+        json.dump(riepilogo, file, indent=2)
+
+def scrivi_profilo(percorso):
+    """
+    Stampa il riepilogo dei tempi per fase registrati da mod.profilo e lo scrive in un file JSON.
+    -------------------------------------------
+    Parametri:
+    percorso: file JSON del rapporto
+    """
+    rapporto = mod.profilo.rapporto()
+    print(f"\nTempi per fase (totale {rapporto['tempo_totale']:.2f} s; le fasi annidate sono comprese in quelle esterne):")
+    for fase, dati in rapporto['fasi'].items():
+        print(f"{fase:<28}{dati['tempo']:10.3f} s{dati['frazione']:8.1%}{dati['chiamate']:10d} chiamate"
+              f"{dati['tempo_per_chiamata'] * 1e6:12.1f} µs/chiamata")
+    with open(percorso, 'w') as file:
+        json.dump(rapporto, file, indent=2)
+    print(f"Rapporto dei tempi scritto in {percorso}")
+
 # Main del programma
 
 def main():
     args = parse_arguments()
-    funzioni(args)
+    if args.seme is not None:
+        np.random.seed(args.seme) #rende riproducibili anche le posizioni casuali generate nel main
+    mod.profilo.attivo = args.profilo is not None
+    mod.profilo.progresso = args.progresso
+    try:
+        if args.batch:
+            esegui_batch(args)
+        else:
+            funzioni(args)
+    except ValueError as errore: #parametri non applicabili rilevati durante l'esecuzione
+        print(f"\nErrore: {errore}\n")
+        sys.exit(1)
+    finally: #il rapporto è scritto anche se l'esecuzione è interrotta
+        if args.profilo is not None:
+            scrivi_profilo(args.profilo)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,87 @@
+#Test delle funzioni del modulo mod, da eseguire con pytest
+
+import numpy as np
+import mod
+
+def condizioni(N=8, seme=0):
+    rng = np.random.default_rng(seme)
+    return mod.posizioni_montecarlo(N, rng), mod.velocita_montecarlo(N, rng)
+
+def test_compatto_passi_in_singola_precisione(monkeypatch):
+    #campo elettrico, campo magnetico, dt e risultato di ogni passo di Eulero e di Boris in float32
+    x0, v0 = condizioni()
+    tipi = []
+    for nome in ('eulero', 'boris'):
+        def registrato(x, v, dt, campo, B, particella, passo=mod.integratori[nome]):
+            tipi.extend([campo.E(x).dtype, B.dtype, dt.dtype])
+            x_nuova, v_nuova = passo(x, v, dt, campo, B, particella)
+            tipi.extend([x_nuova.dtype, v_nuova.dtype])
+            return x_nuova, v_nuova
+        monkeypatch.setitem(mod.integratori, nome, registrato)
+    for grad in ('0', '2'):
+        for integratore in ('eulero', 'boris'):
+            for _, x, v, _ in mod.passi_avanzamento([0.01, 0.01, 0], [0, 0, 1e-4], x0, v0, mod.particelle['e'], 5, grad,
+                                                    integratore, precisione=np.float32):
+                assert x.dtype == v.dtype == np.float32
+    assert len(tipi) > 0 and all(tipo == np.float32 for tipo in tipi)
+
+def test_campo_elettrico_conserva_precisione():
+    campo = mod.modello_campo([0.01, 0.01, 0], [0, 0, 0], '1')
+    assert campo.E(np.zeros((4, 3))).dtype == np.float64
+    singola = campo.con_campo_elettrico(campo.E0, np.float32)
+    assert singola.E0.dtype == singola.E(np.zeros((4, 3))).dtype == np.float32
+    assert campo.E0.dtype == np.float64 #l'originale non cambia
+
+def test_teoriche_d_insieme_invariate():
+    #teorica_grad e teorica_both restituiscono le formule d'insieme originali, non statistiche per particella
+    x0, v0 = condizioni(6, 1)
+    particella = mod.particelle['p']
+    E0 = [0.01, 0.01, 0]
+    tr, _ = mod.avanzamento(E0, [0, 0, 0], x0, v0, particella, 201, 6, '2', integratore='eulero')
+    mediano = tr.shape[0] // 2
+    x_media, x_precedente = tr[mediano, :, 0], tr[mediano - 1, :, 0]
+    B_mediano = mod.gradiente('2', x_media)[2]
+    dt = 0.0001 * mod.periodo_larmor(particella, np.column_stack((0 * B_mediano, 0 * B_mediano, B_mediano)))
+    v_x, v_y = (x_media - x_precedente) / dt, (tr[mediano, :, 1] - tr[mediano - 1, :, 1]) / dt
+    v_ortogonale_media = np.mean(np.sqrt(v_x**2 + v_y**2))
+    y = particella.m * v_ortogonale_media**2 / (2 * particella.q * B_mediano**2)
+    attesa_grad = np.array([0, np.mean(y * 0.02), 0])
+    attesa_both = mod.teorica_exb(E0, [0, 0, np.mean(B_mediano)]) + attesa_grad
+    assert np.allclose(mod.teorica_grad(tr, particella, '2'), attesa_grad, rtol=1e-9, atol=0)
+    assert np.allclose(mod.teorica_both(tr, particella, '2', E0), attesa_both, rtol=1e-9, atol=0)
+
+def test_teoriche_per_particella():
+    x, v = condizioni(6, 2)
+    particella = mod.particelle['e']
+    E0 = [0.01, 0.01, 0]
+    v_exb, v_grad = mod.derive_particelle(x, v, particella, '1', E0)
+    assert np.array_equal(mod.teorica_grad_stato(x, v, particella, '1', per_particella=True),
+                          mod.derive_particelle(x, v, particella, '1')[1])
+    assert np.array_equal(mod.teorica_both_stato(x, v, particella, '1', E0, per_particella=True), v_exb + v_grad)
+
+def test_statistica_indipendente_dai_processi():
+    #blocchi che tagliano i gruppi di PARTICELLE_SEME e più processi che gruppi danno le stesse particelle
+    N = mod.PARTICELLE_SEME + 36
+    configurazioni = [([0, 0, 0], [0, 0, 1e-4], '2')]
+    riferimento = mod.statistica_parallela(configurazioni, mod.particelle['e'], N, 50, seme=7, frazione=0.01)[0]
+    for processi in (3, 5):
+        risultato = mod.statistica_parallela(configurazioni, mod.particelle['e'], N, 50, processi=processi, seme=7,
+                                             frazione=0.01)[0]
+        assert np.array_equal(risultato[0], riferimento[0]) and np.array_equal(risultato[2], riferimento[2])
+
+def test_centro_guida_girazioni_misurate():
+    #con 1/frazione non intero le girazioni non durano un numero intero di passi: la deriva E x B resta esatta
+    x0, v0 = condizioni(20)
+    E0, B0 = np.array([0.01, 0.02, 0]), np.array([0, 0, 1e-4])
+    tr, tempi, _, _, errore, _ = mod.deriva_centro_guida(E0, B0, x0, v0, mod.particelle['p'], 600, 20, '0', 'boris', 1 / 137.5)
+    teorica = mod.teorica_exb(E0, B0)
+    assert np.max(np.linalg.norm(mod.vel_drift(tr, tempi) - teorica, axis=1)) < 3e-3 * np.linalg.norm(teorica)
+    assert not np.any(np.isnan(errore))
+
+def test_scelta_posizione(monkeypatch):
+    #scelta B: posizioni già campionate restituite come sono, None lasciato al chiamante, altrimenti generate
+    x_casuali, _ = condizioni(5)
+    monkeypatch.setattr('builtins.input', lambda *_: 'B')
+    assert mod.scelta_posizione(5, x0=x_casuali) is x_casuali
+    assert mod.scelta_posizione(5, x0=None) is None
+    assert mod.scelta_posizione(5, rng=np.random.default_rng(0)).shape == (5, 3)